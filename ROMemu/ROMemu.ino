@@ -9,7 +9,7 @@ ToDo: - implement host isolation control to disable non-tristate signals
         generation too. Not sure this is really useful.
 */
 
-#define VERSION "v0.11.4"
+#define VERSION "v0.12.0"
 
 #define SERIALBUFSIZE         90
 char serialBuffer[SERIALBUFSIZE];
@@ -30,6 +30,16 @@ byte setBufPointer = 0;
 #define RELAYDELAY 100L
 unsigned int lastEndAddress = 0;
 
+// binary transfer mode: STX, length, address MSB, address LSB, data, CRC MSB, CRC LSB
+#define STX 0x02
+#define ACK 0x06
+#define NAK 0x15
+#define MAXFRAMEDATA 56      // frame of 62 bytes fits in the 64 byte receive buffer
+#define FRAMETIMEOUT 100L    // ms between the bytes of a frame
+#define BINARYIDLE 5000L     // ms without data before returning to command mode
+bool binaryMode = 0;
+unsigned long lastByteTime = 0;
+
 unsigned int addressOffset = 0;
 
 bool echo = 0;
@@ -51,7 +61,11 @@ void setup() {
 
 
 void loop() {
-  commandCollector();
+  if (binaryMode) {
+    binaryCollector();
+  } else {
+    commandCollector();
+  }
 }  
  
 void commandCollector() {
@@ -163,6 +177,10 @@ void commandInterpreter() {
     case ';':
       generateHexIntelRecords();
       break;
+    case 'X':
+    case 'x':
+      enterBinaryMode();
+      break;
     default:
       Serial.print(bufByte);
       Serial.print(" ");
@@ -189,6 +207,7 @@ void usage() {
   Serial.println(F(" O             - Toggle echo"));
   Serial.println(F(" R[0|1]        - Switch the RESET relay"));
   Serial.println(F(" S1ccnnnndddd..ddss - accepts Motorola Exorciser S1 record"));
+  Serial.println(F(" X             - Binary transfer mode, until an empty frame"));
   Serial.println(F("Test commands:"));  
   Serial.println(F(" A             - test 32 kByte RAM with 00h, 55h. AAh and FFh patterns"));
   Serial.println(F(" Bpp           - blink pin p (in hex)"));
@@ -542,6 +561,91 @@ void hexIntelInterpreter() {
    }
 }
 
+// X - switch to binary transfer mode. Frames are acknowledged with ACK
+// or NAK; an empty frame or BINARYIDLE ms without data ends the mode.
+void enterBinaryMode() {
+  Serial.println(F("Binary mode Ok."));
+  binaryMode = 1;
+  lastByteTime = millis();
+}
+
+void leaveBinaryMode() {
+  binaryMode = 0;
+  clearSerialBuffer();
+  setBufPointer = 0;
+}
+
+void binaryCollector() {
+  if (Serial.available() == 0) {
+    if (millis() - lastByteTime > FRAMETIMEOUT && setBufPointer > 0) {
+      Serial.write(NAK);                  // incomplete frame
+      setBufPointer = 0;
+    }
+    if (millis() - lastByteTime > BINARYIDLE) {
+      leaveBinaryMode();
+    }
+    return;
+  }
+  byte inByte = Serial.read();
+  lastByteTime = millis();
+  if (setBufPointer == 0) {
+    if (inByte == STX) {                  // skip everything between frames
+      serialBuffer[setBufPointer++] = inByte;
+    }
+    return;
+  }
+  serialBuffer[setBufPointer++] = inByte;
+  if (setBufPointer == 2 && inByte > MAXFRAMEDATA) {
+    Serial.write(NAK);
+    setBufPointer = 0;
+    return;
+  }
+  if (setBufPointer > 2 && setBufPointer == (byte)serialBuffer[1] + 6) {
+    binaryInterpreter();
+    setBufPointer = 0;
+  }
+}
+
+void binaryInterpreter() {
+  byte count = serialBuffer[1];
+  unsigned int crc = 0xFFFF;
+  byte i;
+  for (i = 1; i < count + 4; i++) {
+    crc = crc16Update(crc, serialBuffer[i]);
+  }
+  unsigned int crcReceived = ((byte)serialBuffer[count + 4] << 8) + (byte)serialBuffer[count + 5];
+  if (crc != crcReceived) {
+    Serial.write(NAK);
+    return;
+  }
+  if (count == 0) {                       // end frame
+    leaveBinaryMode();
+    Serial.write(ACK);
+    return;
+  }
+  unsigned int baseAddress = ((byte)serialBuffer[2] << 8) + (byte)serialBuffer[3];
+  onlineWriteMode();
+  for (i = 0; i < count; i++) {
+    writeByte(baseAddress + i - addressOffset, serialBuffer[i + 4]);
+  }
+  offlineMode();
+  Serial.write(ACK);
+}
+
+// CRC-16/CCITT, polynomial 1021h, start value FFFFh
+unsigned int crc16Update(unsigned int crc, byte data) {
+  byte i;
+  crc ^= (unsigned int)data << 8;
+  for (i = 0; i < 8; i++) {
+    if (crc & 0x8000) {
+      crc = (crc << 1) ^ 0x1021;
+    } else {
+      crc = crc << 1;
+    }
+  }
+  return crc;
+}
+
 // S1ccnnnndddd..ddss or S9030000FC end record
 void motoExorciserS1Interpreter() {
   unsigned int count;
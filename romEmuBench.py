@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+#
+# Benchmarks of the transfers between the host and the ROM Emulator.
+#
+# Every run starts the simulator of romEmuSim.py on a pseudo-terminal,
+# at 9600 baud and at the other line speeds asked for, and measures the
+# upload (records, repacked records, binary frames and the fill/copy
+# plan), the dump, the K checksum, the verify and the terminal receive
+# loop with a set of generated images: dense code, sparse blocks, mostly
+# padding and fragmented short records. The results (bytes/s, records/s
+# and wall time) are appended to a JSON lines file, and compared with the
+# previous run in that file.
+#
+# The simulator moves the bytes at the speed of the serial line and
+# models the busy time of N, C and K, but writes records to its RAM
+# without delay, so at high speeds the record figures are those of the
+# host side and the protocol, while the fill/copy plan includes the time
+# the firmware spends filling and copying.
+#
+#   Usage: python3 romEmuBench.py [--baud 9600 115200] [--size 4096] [--output bench.jsonl]
+
+import argparse
+import codecs
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import romEmuConnect
+import romEmuDump
+import romEmuImage
+import romEmuPlan
+import romEmuSim
+import romEmuUpload
+import romEmuVerify
+
+LF = "\r\n"
+RESULTFILE = os.path.join(os.path.expanduser("~"), ".romemu", "bench.jsonl")
+DEFAULTBAUDS = [9600, 115200]
+DEFAULTSIZE = 4096
+
+IMAGES = ['dense', 'sparse', 'padding', 'fragmented']
+UPLOADS = ['records', 'repack', 'binary', 'fillcopy']
+
+
+def makeImage(kind, size, seed=1):
+    """A generated image of about size bytes below 8000h."""
+    rng = random.Random(seed)
+
+    def code(count):
+        return bytes(rng.getrandbits(8) for i in range(count))
+
+    image = romEmuImage.RomImage()
+    if kind == 'dense':
+        image.setBytes(0, code(size))
+    elif kind == 'sparse':
+        # blocks of 256 bytes spread over the RAM
+        blocks = max(1, size // 256)
+        for block in range(blocks):
+            image.setBytes(block * (romEmuVerify.RAMSIZE // blocks), code(256))
+    elif kind == 'padding':
+        # some code, a table repeated, the rest FFh padding
+        table = code(64)
+        data = code(size // 8) + table + b"\xFF" * (size // 2) + table + table
+        image.setBytes(0, data + b"\x00" * max(0, size - len(data)))
+    elif kind == 'fragmented':
+        # records of 1 to 8 bytes with small gaps between them
+        address = 0
+        loaded = 0
+        while loaded < size and address < romEmuVerify.RAMSIZE - 8:
+            count = rng.randint(1, 8)
+            image.setBytes(address, code(count))
+            loaded += count
+            address += count + rng.randint(1, 16)
+    else:
+        raise ValueError("unknown image kind " + kind)
+    return image
+
+
+class BenchResult:
+    """One measured case."""
+
+    def __init__(self, case, baud, image, dataBytes, records, seconds, ok=True):
+        self.case = case
+        self.baud = baud
+        self.image = image
+        self.dataBytes = dataBytes
+        self.records = records
+        self.seconds = seconds
+        self.ok = ok
+
+    def key(self):
+        return "{}/{}/{}".format(self.case, self.image or "-", self.baud)
+
+    def bytesPerSecond(self):
+        return self.dataBytes / self.seconds if self.seconds > 0 else 0.0
+
+    def recordsPerSecond(self):
+        return self.records / self.seconds if self.seconds > 0 else 0.0
+
+    def asDict(self):
+        return {"case": self.case, "baud": self.baud, "image": self.image, "dataBytes": self.dataBytes,
+                "records": self.records, "seconds": round(self.seconds, 4), "ok": self.ok,
+                "bytesPerSecond": round(self.bytesPerSecond(), 1),
+                "recordsPerSecond": round(self.recordsPerSecond(), 2)}
+
+
+# cases
+
+def benchUpload(ser, image, mode):
+    """Upload image as records, repacked records, binary frames or with the fill/copy plan."""
+    records = romEmuImage.uploadRecords(image, repack=mode == 'repack')
+    start = time.monotonic()
+    if mode == 'fillcopy':
+        result = romEmuPlan.planUpload(image).upload(ser, out=lambda text: None)
+    else:
+        result = romEmuUpload.sendRecords(ser, records, out=lambda text: None, binary=mode == 'binary')
+    seconds = time.monotonic() - start
+    return len(image), result.records, seconds, not (result.errors or result.timeouts)
+
+
+def benchDump(ser, size):
+    start = time.monotonic()
+    ok = True
+    for chunk in range(0, size, romEmuDump.CHUNKSIZE):
+        ok = ok and romEmuDump.readChunk(ser, chunk, min(chunk + romEmuDump.CHUNKSIZE, size)) is not None
+    return size, size // 16, time.monotonic() - start, ok
+
+
+def benchChecksum(ser):
+    start = time.monotonic()
+    checksum = romEmuUpload.queryChecksum(ser, 0, romEmuVerify.RAMSIZE - 1)
+    return romEmuVerify.RAMSIZE, 1, time.monotonic() - start, checksum is not None
+
+
+def benchVerify(ser, image):
+    """Verify image, after loading it untimed."""
+    romEmuUpload.sendRecords(ser, romEmuImage.uploadRecords(image), out=lambda text: None)
+    start = time.monotonic()
+    result = romEmuVerify.verify(ser, image, out=lambda text: None)
+    return len(image), result.checksums + result.dumps, time.monotonic() - start, result.ok()
+
+
+def benchIngest(ser, size):
+    """
+    The receive loop of the terminal (the reader of the port scheduler
+    and TerminalFrame.OnReceive): read what is waiting, decode it and
+    queue it, for a D dump of size bytes.
+    """
+    decoder = codecs.getincrementaldecoder('UTF-8')('replace')
+    parts = []
+    lines = 0
+    start = time.monotonic()
+    ser.write(("D0000-%04X" % size + LF).encode())
+    idle = 0
+    while lines < size // 16 + 1 and idle < 2:
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            idle += 1
+            continue
+        text = decoder.decode(data.replace(b'\r\n', b'\n')).replace('\r', '')
+        parts.append(text)
+        lines += text.count('\n')
+    seconds = time.monotonic() - start
+    ser.read(ser.in_waiting)            # the empty line at the end
+    return size, lines, seconds, lines >= size // 16
+
+
+# suite
+
+def openSimulator(baud):
+    runner, port = romEmuSim.startSimulator(baud=baud, fill=0xFF)
+    ser, connection = romEmuConnect.connect(port)
+    return runner, ser
+
+
+def runSuite(bauds, size, images=IMAGES, uploads=UPLOADS, out=print):
+    results = []
+
+    def record(case, baud, imageName, measured):
+        result = BenchResult(case, baud, imageName, *measured)
+        results.append(result)
+        out(formatResult(result))
+
+    for baud in bauds:
+        runner, ser = openSimulator(baud)
+        try:
+            for imageName in images:
+                image = makeImage(imageName, size)
+                for mode in uploads:
+                    record("upload-" + mode, baud, imageName, benchUpload(ser, image, mode))
+            record("dump", baud, None, benchDump(ser, size))
+            record("checksum", baud, None, benchChecksum(ser))
+            record("verify", baud, 'dense', benchVerify(ser, makeImage('dense', size)))
+            record("ingest", baud, None, benchIngest(ser, size))
+        finally:
+            ser.close()
+            runner.close()
+    return results
+
+
+def formatResult(result, previous=None):
+    text = "{:<18} {:<11} {:>7} {:>9.0f} B/s {:>8.1f} rec/s {:>8.2f} s{}".format(
+        result.case, result.image or "", result.baud or "max", result.bytesPerSecond(),
+        result.recordsPerSecond(), result.seconds, "" if result.ok else "  FAILED")
+    if previous is not None and previous.get("seconds"):
+        text += "  {:+.0f}%".format(100.0 * (result.seconds - previous["seconds"]) / previous["seconds"])
+    return text
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def loadRuns(path):
+    runs = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return runs
+
+
+def saveRun(path, results, size):
+    run = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "revision": gitRevision(),
+           "python": platform.python_version(), "host": platform.node(), "size": size,
+           "results": [result.asDict() for result in results]}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(run) + "\n")
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ROMemu transfers on the simulator")
+    parser.add_argument("--baud", type=int, nargs='+', default=DEFAULTBAUDS,
+                        help="simulated line speeds, 0 for no limit (default: 9600 115200)")
+    parser.add_argument("--size", type=int, default=DEFAULTSIZE, help="bytes per image (default %(default)s)")
+    parser.add_argument("--images", nargs='+', choices=IMAGES, default=IMAGES)
+    parser.add_argument("--uploads", nargs='+', choices=UPLOADS, default=UPLOADS)
+    parser.add_argument("--output", default=RESULTFILE, help="results file (default %(default)s)")
+    parser.add_argument("--no-save", action="store_true", help="do not append the results to the file")
+    args = parser.parse_args()
+
+    runs = [run for run in loadRuns(args.output) if run.get("size") == args.size]
+    previous = {}
+    if runs:
+        previous = {"{}/{}/{}".format(r["case"], r["image"] or "-", r["baud"]): r for r in runs[-1]["results"]}
+        print("Compared with the run of {} ({})".format(runs[-1]["time"], runs[-1].get("revision") or "?"))
+
+    results = runSuite(args.baud, args.size, args.images, args.uploads, out=lambda text: None)
+    print("{:<18} {:<11} {:>7} {:>13} {:>14} {:>10}".format("case", "image", "baud", "data", "records",
+                                                               "time"))
+    for result in results:
+        print(formatResult(result, previous.get(result.key())))
+    if not args.no_save:
+        saveRun(args.output, results, args.size)
+        print("Results appended to " + args.output)
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
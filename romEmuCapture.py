@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+#
+# Serial session capture for the ROM Emulator.
+#
+# Every chunk written to or read from the port is logged with its time,
+# so a session on another bench can be replayed with romEmuReplay.py.
+# The log is binary and compact: a header, then per chunk
+#
+#   delay    4 bytes, microseconds since the previous chunk
+#   dir      1 byte, TX (host to emulator) or RX
+#   length   2 bytes
+#   data     length bytes
+#
+# all little endian. The header holds the baud rate and the wall clock
+# time of the start, for the report.
+#
+#   Usage: python3 romEmuCapture.py <captureFile>     (lists the chunks)
+
+import argparse
+import struct
+import sys
+import threading
+import time
+
+MAGIC   = b"ROMEMUCP"
+VERSION = 1
+HEADER  = struct.Struct("<8sBId")      # magic, version, baud rate, start (time.time())
+CHUNK   = struct.Struct("<IBH")        # delay in us, direction, length
+
+TX = 0
+RX = 1
+DIRECTIONS = ("TX", "RX")
+MAXDELAY = 0xFFFFFFFF
+MAXCHUNK = 0xFFFF
+
+
+class CaptureError(ValueError):
+    """Not a capture file, or a truncated one."""
+
+
+class CaptureWriter:
+    """Writes a capture file; sent() and received() may be called from any thread."""
+
+    def __init__(self, path, baudrate=0):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, baudrate, time.time()))
+        self.start = time.monotonic()
+        self.last = 0                   # us since the start, of the previous chunk
+        self.lock = threading.Lock()
+
+    def record(self, direction, data):
+        with self.lock:
+            if self.file is None:
+                return
+            now = int((time.monotonic() - self.start) * 1e6)
+            for index in range(0, len(data), MAXCHUNK):
+                part = data[index:index + MAXCHUNK]
+                delay = min(max(now - self.last, 0), MAXDELAY)
+                self.last += delay
+                self.file.write(CHUNK.pack(delay, direction, len(part)) + bytes(part))
+
+    def sent(self, data):
+        self.record(TX, data)
+
+    def received(self, data):
+        self.record(RX, data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class CapturePort:
+    """
+    A serial port that logs its traffic to a CaptureWriter. Everything
+    else is passed to the port.
+    """
+
+    def __init__(self, ser, capture):
+        self.__dict__['ser'] = ser
+        self.__dict__['capture'] = capture
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.ser, name, value)
+
+    def write(self, data):
+        self.capture.sent(data)
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.capture.received(data)
+        return data
+
+    def readline(self):
+        data = self.ser.readline()
+        if data:
+            self.capture.received(data)
+        return data
+
+
+class Capture:
+    """A capture file read back: chunks of (seconds since the start, direction, data)."""
+
+    def __init__(self, baudrate, started, chunks):
+        self.baudrate = baudrate
+        self.started = started
+        self.chunks = chunks
+
+    def bytes(self, direction):
+        return sum(len(data) for seconds, chunkDirection, data in self.chunks if chunkDirection == direction)
+
+    def duration(self):
+        return self.chunks[-1][0] if self.chunks else 0.0
+
+    def stream(self, direction):
+        return b"".join(data for seconds, chunkDirection, data in self.chunks if chunkDirection == direction)
+
+    def summary(self):
+        return "Captured {} at {} baud: {} chunks, {} bytes sent, {} received in {:.2f} s".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)), self.baudrate or "?",
+            len(self.chunks), self.bytes(TX), self.bytes(RX), self.duration())
+
+
+def readCapture(path):
+    """Read a capture file; raises CaptureError."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if len(raw) < HEADER.size:
+        raise CaptureError("too short for a capture file")
+    magic, version, baudrate, started = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise CaptureError("not a capture file")
+    if version != VERSION:
+        raise CaptureError("capture version {} is not supported".format(version))
+    chunks = []
+    offset = HEADER.size
+    micros = 0
+    while offset < len(raw):
+        if offset + CHUNK.size > len(raw):
+            raise CaptureError("truncated at byte {}".format(offset))
+        delay, direction, length = CHUNK.unpack_from(raw, offset)
+        offset += CHUNK.size
+        if direction not in (TX, RX) or offset + length > len(raw):
+            raise CaptureError("truncated or damaged at byte {}".format(offset - CHUNK.size))
+        micros += delay
+        chunks.append((micros / 1e6, direction, raw[offset:offset + length]))
+        offset += length
+    return Capture(baudrate, started, chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List a ROM Emulator session capture",
+                                     usage="python3 romEmuCapture.py <captureFile>")
+    parser.add_argument("captureFile")
+    args = parser.parse_args()
+    try:
+        capture = readCapture(args.captureFile)
+    except (OSError, CaptureError) as e:
+        print(args.captureFile + ": " + str(e))
+        return 1
+    print(capture.summary())
+    for seconds, direction, data in capture.chunks:
+        print("%12.6f %s %5d %r" % (seconds, DIRECTIONS[direction], len(data), data))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
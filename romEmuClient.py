@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+#
+# asyncio client for the ROM Emulator command set.
+#
+# Every command is a coroutine that returns the parsed reply. Commands
+# are pipelined: they are sent as soon as the firmware has room for them
+# (at most window commands and INFLIGHTBYTES bytes unanswered) and the
+# replies, which come back in order, are matched to them. Commands that
+# keep the firmware busy for a while (D, ;, G, K, N and C) are sent on an
+# empty line, as the firmware does not read its input while it runs them
+# and D stops at the first byte received.
+#
+#   async def main():
+#       client = RomEmuClient('/dev/ttyACM0')
+#       await client.open()
+#       result = await client.upload(records)
+#       checksum = await client.checksum(0x0000, 0x07FF)
+#       await client.close()
+
+import asyncio
+import collections
+import threading
+
+import serial
+
+import romEmuConnect
+import romEmuImage
+import romEmuUpload
+import romEmuVerify
+
+LF = "\n"               # '\r' is ignored with echo off and a terminator with echo on
+BANNERTIMEOUT = 3.0
+REPLYTIMEOUT  = 5.0
+QUIETTIME     = 0.5     # seconds without a line that end a late reply after a timeout
+DUMPCHARS     = 5       # characters of D, ; and G output per byte, with margin
+
+RecordReply = collections.namedtuple('RecordReply', 'address ok')
+Checksum    = collections.namedtuple('Checksum', 'start end sum andOr')
+Modify      = collections.namedtuple('Modify', 'address old new')
+
+
+class RomEmuError(Exception):
+    """No reply, or a reply that does not fit the command."""
+
+
+# reply parsers: generators that receive the reply lines and return the result
+
+def recordReply():
+    line = yield
+    kind = romEmuUpload.classifyReply(line)
+    if kind is None:
+        raise RomEmuError("unexpected reply: " + line)
+    address = None
+    if kind == romEmuUpload.REPLY_OK:
+        address = int(line.split()[0], 16)
+    elif kind == romEmuUpload.REPLY_SUMCHECK:
+        address = int(line.split()[3], 16)
+    return RecordReply(address, kind == romEmuUpload.REPLY_OK)
+
+
+def oneLine():
+    line = yield
+    return line
+
+
+def offsetReply():
+    line = yield
+    match = romEmuConnect.OFFSETREPLY.match(line)
+    if match is None:
+        raise RomEmuError("unexpected reply: " + line)
+    return int(match.group(1), 16)
+
+
+def checksumReply():
+    line = yield
+    checksum = romEmuUpload.parseChecksumReply(line)
+    if checksum is None:
+        raise RomEmuError("unexpected reply: " + line)
+    return Checksum(*checksum)
+
+
+def modifyReply():
+    line = yield
+    # M:aaaa-oo > nn
+    try:
+        address, values = line[2:].split("-")
+        old, new = values.split(" > ")
+        return Modify(int(address, 16), int(old, 16), int(new, 16))
+    except ValueError:
+        raise RomEmuError("unexpected reply: " + line)
+
+
+def fillReply():
+    line = yield
+    if not line.startswith("N:"):
+        raise RomEmuError("unexpected reply: " + line)
+    line = yield
+    if line.startswith("Error"):
+        raise RomEmuError(line)
+    while not romEmuConnect.OFFSETREPLY.match(line):    # the F after the fill
+        line = yield
+    return None
+
+
+def copyReply():
+    line = yield
+    while not line.endswith("bytes copied"):
+        line = yield
+    return int(line.split()[-3].rstrip("h"), 16)
+
+
+def dumpReply(first, count):
+    yield                               # header ssss-eeee
+    data = {}
+    line = yield
+    while line:
+        parsed = romEmuVerify.parseDumpLine(line)
+        if parsed is not None:
+            data[parsed[0]] = parsed[1]
+        line = yield
+    try:
+        return b"".join(data[first + 16 * i] for i in range(count))
+    except KeyError:
+        raise RomEmuError("incomplete dump")
+
+
+def recordsReply(count, endLine=None):
+    yield                               # header ssss-eeee
+    data = bytearray()
+    for i in range(count):
+        line = yield
+        try:
+            address, chunk = romEmuImage.parseRecord(line)
+        except (TypeError, ValueError):
+            raise RomEmuError("bad record: " + line)
+        data += chunk
+    if endLine is not None:
+        yield
+    return bytes(data)
+
+
+class _Pending:
+    def __init__(self, command, parser, size, exclusive, future):
+        self.command = command
+        self.parser = parser
+        self.size = size
+        self.exclusive = exclusive
+        self.future = future
+        self.echoPending = True
+
+
+class RomEmuClient:
+    """Pipelined asyncio access to a ROM Emulator on a serial port."""
+
+    def __init__(self, port, baudrate=9600, window=romEmuUpload.DEFAULTWINDOW, timeout=REPLYTIMEOUT):
+        self.port = port
+        self.baudrate = baudrate
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.serial = None
+        self.version = None
+        self.echoOn = False
+        self.unsolicited = collections.deque(maxlen=100)
+        self._pending = collections.deque()
+        self._inFlightBytes = 0
+        self._loop = None
+        self._room = None
+        self._sendLock = None
+        self._banner = None
+        self._alive = threading.Event()
+        self._thread = None
+        self._lastLine = 0.0
+
+    async def open(self, waitBanner=True):
+        """Open the port (which resets the board) and wait until the firmware runs."""
+        self._loop = asyncio.get_running_loop()
+        self._room = asyncio.Event()
+        self._sendLock = asyncio.Lock()
+        self._banner = self._loop.create_future()
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=0.1)
+        self._alive.set()
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+        if waitBanner:
+            try:
+                self.version = await asyncio.wait_for(self._banner, BANNERTIMEOUT)
+            except asyncio.TimeoutError:
+                raise RomEmuError("no ROMemu banner on " + self.port)
+            # the F is answered as soon as setup() is done
+            await self.getOffset()
+
+    async def close(self):
+        self._alive.clear()
+        if self._thread is not None:
+            await self._loop.run_in_executor(None, self._thread.join)
+            self._thread = None
+        if self.serial is not None:
+            self.serial.close()
+        self._fail(RomEmuError("client closed"))
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    # transport
+
+    def _reader(self):
+        buffer = b""
+        while self._alive.is_set():
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except serial.SerialException as e:
+                self._loop.call_soon_threadsafe(self._fail, RomEmuError(str(e)))
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                text = line.decode('ascii', 'replace').rstrip("\r")
+                self._loop.call_soon_threadsafe(self._onLine, text)
+
+    def _onLine(self, line):
+        self._lastLine = self._loop.time()
+        if not self._pending:
+            if line.startswith("ROMemu ") and not self._banner.done():
+                self._banner.set_result(line.split()[1])
+            self.unsolicited.append(line)
+            return
+        pending = self._pending[0]
+        if self.echoOn and pending.echoPending and line == pending.command:
+            pending.echoPending = False
+            return
+        try:
+            pending.parser.send(line)
+        except StopIteration as done:
+            self._retire(pending)
+            if not pending.future.done():
+                pending.future.set_result(done.value)
+        except RomEmuError as e:
+            self._retire(pending)
+            if not pending.future.done():
+                pending.future.set_exception(e)
+        except Exception:
+            self._retire(pending)
+            if not pending.future.done():
+                pending.future.set_exception(RomEmuError("unexpected reply to {}: {}".format(
+                    pending.command, line)))
+
+    def _retire(self, pending):
+        self._pending.popleft()
+        self._inFlightBytes -= pending.size
+        self._room.set()
+
+    def _fail(self, error):
+        while self._pending:
+            pending = self._pending.popleft()
+            if not pending.future.done():
+                pending.future.set_exception(error)
+        self._inFlightBytes = 0
+        if self._room is not None:
+            self._room.set()
+
+    def _canSend(self, size, exclusive):
+        if not self._pending:
+            return True
+        if exclusive or self._pending[-1].exclusive:
+            return False
+        return len(self._pending) < self.window and self._inFlightBytes + size <= romEmuUpload.INFLIGHTBYTES
+
+    def outputTime(self, size):
+        """Seconds the firmware needs to send size bytes of dump output."""
+        return size * DUMPCHARS * 10.0 / self.baudrate
+
+    async def _drain(self, limit):
+        """
+        Wait until the line is quiet, at most limit seconds (a dump of the
+        whole RAM): the rest of a reply that came too late goes to
+        unsolicited, not to the next command.
+        """
+        end = self._loop.time() + limit
+        while self._loop.time() < end:
+            await asyncio.sleep(QUIETTIME)
+            if self._loop.time() - self._lastLine >= QUIETTIME:
+                return
+
+    async def command(self, command, parser=None, exclusive=False, sync=None, busy=0.0):
+        """
+        Send command; with a parser, wait for the reply and return what
+        the parser makes of it. Commands are sent in the order of the calls.
+        sync is a command sent right after it, for firmware that replies
+        before it is done; busy is added to the reply timeout.
+        """
+        wire = command + LF + (sync + LF if sync else "")
+        size = len(wire)
+        async with self._sendLock:
+            while not self._canSend(size, exclusive):
+                self._room.clear()
+                await self._room.wait()
+            echoPending = self.echoOn
+            if parser is None:
+                if not self.echoOn:
+                    self.serial.write(wire.encode())
+                    return None
+                parser = oneLine()              # the echo is the only reply
+                echoPending = False
+            next(parser)
+            future = self._loop.create_future()
+            pending = _Pending(command, parser, size, exclusive, future)
+            pending.echoPending = echoPending
+            self._pending.append(pending)
+            self._inFlightBytes += size
+            self.serial.write(wire.encode())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout + busy)
+        except asyncio.TimeoutError:
+            self._fail(RomEmuError("no reply to " + command))
+            future.exception()                  # retrieved, raised below
+            async with self._sendLock:
+                await self._drain(self.timeout + self.outputTime(romEmuVerify.RAMSIZE))
+            raise RomEmuError("no reply to " + command)
+
+    # commands
+
+    async def writeRecord(self, record):
+        """Send a hex-intel or S1 record; data records return a RecordReply."""
+        if romEmuUpload.expectsReply(record):
+            return await self.command(record, recordReply())
+        return await self.command(record)
+
+    async def upload(self, records):
+        """Send all records pipelined; returns a romEmuUpload.UploadResult."""
+        result = romEmuUpload.UploadResult()
+        records = [r.strip() for r in records if r.strip()]
+        start = self._loop.time()
+        replies = await asyncio.gather(*(self.writeRecord(r) for r in records), return_exceptions=True)
+        for record, reply in zip(records, replies):
+            result.records += 1
+            result.dataBytes += romEmuUpload.recordDataSize(record)
+            result.wireBytes += len(record) + len(LF)
+            if isinstance(reply, RomEmuError):
+                result.timeouts += 1
+            elif isinstance(reply, Exception):
+                raise reply
+            elif reply is not None and not reply.ok:
+                result.errors += 1
+        result.elapsed = self._loop.time() - start
+        return result
+
+    async def dump(self, start, end):
+        """RAM from start up to (not including) end, read with D."""
+        first, last = start & ~0x0F, (end + 0x0F) & ~0x0F
+        data = await self.command("D%04X-%04X" % (first, last & 0xFFFF),
+                                  dumpReply(first, (last - first) // 16), exclusive=True,
+                                  busy=self.outputTime(last - first))
+        return data[start - first:end - first]
+
+    async def dumpHex(self, start, end):
+        """RAM from start up to end, read as hex-intel records with ;."""
+        count = (end - start + 15) // 16
+        data = await self.command(";%04X-%04X" % (start, end), recordsReply(count), exclusive=True,
+                                  busy=self.outputTime(end - start))
+        return data[:end - start]
+
+    async def dumpS1(self, start, end):
+        """RAM from start up to end, read as S1 records with G."""
+        count = (end - start + 15) // 16
+        data = await self.command("G%04X-%04X" % (start, end), recordsReply(count, "S9030000FC"),
+                                  exclusive=True, busy=self.outputTime(end - start))
+        return data[:end - start]
+
+    async def checksum(self, start, end):
+        """K over start-end (inclusive); returns a Checksum."""
+        return await self.command("K%04X-%04X" % (start, end), checksumReply(), exclusive=True)
+
+    async def modify(self, address, value):
+        """M; returns a Modify with the old and the read back value."""
+        return await self.command("M%04X-%02X" % (address, value), modifyReply())
+
+    async def fill(self, start, end, value):
+        """
+        N: fill start-end (inclusive) with value. The firmware replies
+        before it fills, so an F follows and its reply ends the command.
+        """
+        if start > end:
+            raise ValueError("negative range")
+        await self.command("N%04X-%04X:%02X" % (start, end, value), fillReply(), exclusive=True, sync="F",
+                           busy=(end - start + 1) * romEmuUpload.FILLTIME)
+
+    async def copy(self, start, end, target):
+        """C: copy start-end (inclusive) to target; returns the number of bytes copied."""
+        if start > end:
+            raise ValueError("negative range")
+        if start == 0 and target <= start:
+            raise ValueError("the firmware does not return from a copy down from 0000")
+        return await self.command("C%04X-%04X-%04X" % (start, end, target), copyReply(), exclusive=True,
+                                  busy=(end - start + 1) * romEmuUpload.COPYTIME)
+
+    async def setOffset(self, offset):
+        """F: set the address offset subtracted from record addresses."""
+        await self.command("F%04X" % offset, oneLine())
+
+    async def getOffset(self):
+        return await self.command("F", offsetReply())
+
+    async def relay(self, on=None):
+        """R: switch the reset relay, or return its state (True: on) when on is None."""
+        if on is None:
+            line = await self.command("R", oneLine())
+            return line.strip() == "0"          # the relay pin is active low
+        await self.command("R1" if on else "R0", oneLine())
+        return on
+
+    async def echo(self, on):
+        """O: switch the echo of the firmware on or off."""
+        if on == self.echoOn:
+            return
+        if on:
+            await self.command("O", oneLine())
+            self.echoOn = True
+        else:
+            self.echoOn = False                 # only the echo of the O itself comes back
+            await self.command("O", oneLine())
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+# Connecting to the ROM Emulator.
+#
+# The Arduino resets when DTR is asserted, which the OS does when the port
+# is opened. setup() then waits 0.5 s, prints the "ROMemu vX" banner and
+# waits another second before loop() reads commands. Instead of sleeping
+# for the worst case, connect() waits for the banner and then sends an F
+# (show the address offset) probe: the firmware answers it as soon as
+# loop() runs. The reply also shows the offset and, with the echo of the
+# F, whether echo is on.
+#
+# With reset=False the board is kept running: the probe is sent at once,
+# and HUPCL is cleared so DTR stays asserted when the port is closed, and
+# the next open does not reset the board either. A board that still
+# resets (the first time, or another program dropped DTR) is handled as
+# with reset=True. With reset=True DTR is pulsed, as it may have been left
+# asserted by such a connection. When no banner comes within GRACETIME
+# (no auto-reset, or HUPCL not honoured) the board is probed while the
+# banner wait goes on, so a board that kept running answers at once.
+
+import re
+import time
+
+import serial
+
+import romEmuUpload
+
+LF = "\n"               # '\r' is a second terminator with echo on
+BANNERTIMEOUT = 3.0     # reset, delay(500) and the banner, with margin
+GRACETIME     = 1.0     # wait for a banner before probing a board that may not have reset
+SETUPTIME     = 1.0     # delay(1000) at the end of setup()
+PROBETIMEOUT  = 0.5
+RESETPULSE    = 0.05
+QUIETTIME     = 0.05    # the output of an earlier probe follows its reply at once
+
+OFFSETREPLY = re.compile(r"^F([0-9A-Fa-f]{4})$")
+
+try:
+    import termios
+except ImportError:
+    termios = None
+
+
+class ConnectError(Exception):
+    """No ROMemu answers on the port."""
+
+
+class Connection:
+    """What connect() found out about the emulator."""
+
+    def __init__(self, port):
+        self.port = port
+        self.version = None         # from the banner; None when the board did not reset
+        self.reset = False          # the board reset on this connect
+        self.offset = None          # address offset (F) reported by the probe
+        self.echo = False           # echo was on; connect() switches it off
+        self.elapsed = 0.0
+
+    def summary(self):
+        return "ROMemu {} on {}, {}ready in {:.2f} s".format(
+            self.version or "(version not known, no reset)", self.port, "reset, " if self.reset else "",
+            self.elapsed)
+
+
+def setHangup(ser, on):
+    """
+    Set HUPCL: drop DTR when ser is closed. Without it DTR stays asserted
+    and the next open does not reset the board.
+    """
+    if termios is None:
+        return
+    try:
+        attributes = termios.tcgetattr(ser.fileno())
+        if on:
+            attributes[2] |= termios.HUPCL
+        else:
+            attributes[2] &= ~termios.HUPCL
+        termios.tcsetattr(ser.fileno(), termios.TCSANOW, attributes)
+    except (termios.error, OSError):
+        pass
+
+
+def pulseDtr(ser):
+    """Reset the board, also when DTR was still asserted from an earlier connection."""
+    try:
+        ser.dtr = False
+        time.sleep(RESETPULSE)
+        ser.dtr = True
+    except (OSError, serial.SerialException):
+        pass                        # no modem lines, e.g. a pseudo-terminal
+
+
+def probe(ser, connection, timeout=PROBETIMEOUT, leaveBinary=False):
+    """
+    Send F and wait for its reply; True when the firmware answered. A
+    banner on the way means the board reset: that is noted in connection.
+    With leaveBinary an empty frame goes first, to end a binary mode left
+    on by an interrupted upload; in text mode it is a bad command.
+    """
+    old = ser.timeout
+    ser.timeout = timeout
+    deadline = time.monotonic() + timeout
+    try:
+        # the LF first ends whatever was left in the command buffer
+        frame = romEmuUpload.binaryFrame(0, b'') if leaveBinary else b''
+        ser.write(frame + (LF + "F" + LF).encode())
+        while time.monotonic() < deadline:
+            raw = ser.readline()
+            if not raw:
+                return False
+            line = raw.decode('ascii', 'replace').strip().lstrip(chr(romEmuUpload.ACK))
+            if line == "F":
+                connection.echo = True
+                continue
+            if line.startswith("ROMemu "):
+                connection.version = line.split()[1]
+                connection.reset = True
+                return False            # the probe went to the bootloader
+            match = OFFSETREPLY.match(line)
+            if match:
+                connection.offset = int(match.group(1), 16)
+                return True
+        return False
+    finally:
+        ser.timeout = old
+
+
+def waitBanner(ser, connection, timeout=BANNERTIMEOUT):
+    old = ser.timeout
+    ser.timeout = 0.1
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            line = ser.readline().decode('ascii', 'replace').strip()
+            if line.startswith("ROMemu "):
+                connection.version = line.split()[1]
+                connection.reset = True
+                return True
+        return False
+    finally:
+        ser.timeout = old
+
+
+def waitReady(ser, connection, reset=True, bannerTimeout=BANNERTIMEOUT):
+    """Wait until the firmware on the open port ser reads commands; raises ConnectError."""
+    start = time.monotonic()
+    if not reset and probe(ser, connection, leaveBinary=True):
+        return                          # it was running
+    deadline = start + bannerTimeout
+    if not connection.reset and not waitBanner(ser, connection, min(GRACETIME, bannerTimeout)):
+        while not connection.reset and time.monotonic() < deadline:
+            if probe(ser, connection, leaveBinary=True):
+                return                  # it did not reset
+    # answered when setup() is done; the reply is the end of the wait
+    if not probe(ser, connection, SETUPTIME + PROBETIMEOUT):
+        raise ConnectError("no ROMemu on " + connection.port)
+
+
+def drain(ser):
+    """Read until the firmware is quiet, the replies to earlier probes included."""
+    old = ser.timeout
+    ser.timeout = QUIETTIME
+    try:
+        while ser.read(256):
+            pass
+    finally:
+        ser.timeout = old
+
+
+def clearOffset(ser, connection):
+    """A board that did not reset keeps the F offset of an earlier session; set it to 0000."""
+    if connection.offset:
+        ser.write(("F0000" + LF).encode())
+        ser.readline()
+        connection.offset = 0
+
+
+def connect(port, baudrate=9600, timeout=2, reset=True, bannerTimeout=BANNERTIMEOUT):
+    """
+    Open port and wait until the emulator is ready, without fixed delays.
+    With reset=False a running board is not reset. Returns (ser, Connection);
+    raises ConnectError when no ROMemu answers, SerialException when the
+    port cannot be opened.
+    """
+    connection = Connection(port)
+    start = time.monotonic()
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = baudrate
+    ser.timeout = timeout
+    if not reset and termios is None:
+        ser.dtr = False             # Windows: not asserted on open, no reset
+    ser.open()
+    try:
+        setHangup(ser, reset)
+        if reset:
+            pulseDtr(ser)
+        waitReady(ser, connection, reset, bannerTimeout)
+        if connection.echo:
+            ser.write(("O" + LF).encode())     # only the echo of the O comes back
+        drain(ser)
+    except (ConnectError, serial.SerialException):
+        ser.close()
+        raise
+    connection.elapsed = time.monotonic() - start
+    return ser, connection
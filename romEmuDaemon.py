@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# Daemon that keeps the serial port of a ROM Emulator open.
+#
+# Opening the port resets the Arduino, after which setup() takes 1.5 s
+# before the firmware reads commands, and only one program can have the
+# port open. The daemon opens the port once and serves the command set on
+# a Unix socket, so build scripts, test harnesses and other tools share
+# the emulator without the reset and the wait on every run.
+#
+# The protocol is one JSON object per line in both directions. A request
+# names an operation and its arguments, the reply holds "ok" and either
+# "result" or "error", plus the lines the operation printed in "log":
+#
+#   {"op": "checksum", "start": 0, "end": 2047}
+#   {"ok": true, "result": [64457, 201], "log": []}
+#
+# Requests of all connections are executed one at a time, in the order
+# they come in. DaemonClient is the client side for Python scripts.
+#
+#   Usage: python3 romEmuDaemon.py [<ttyPort>] [--socket ~/.romemu/romemu.sock]
+#          python3 romEmuDaemon.py --command K0000-7FFF
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import serial
+
+import romEmuConnect
+import romEmuDump
+import romEmuImage
+import romEmuPlan
+import romEmuShadow
+import romEmuUpload
+import romEmuVerify
+
+LF = "\r\n"
+SOCKETPATH = os.path.join(os.path.expanduser("~"), ".romemu", "romemu.sock")
+QUIETTIME  = 0.3        # a raw command is done when the firmware is quiet this long
+
+
+class DaemonError(Exception):
+    """An error reported by the daemon, or no daemon on the socket."""
+
+
+def imageFromRecords(lines):
+    """Read hex-intel or S-record lines, by the first record, into a RomImage."""
+    lines = [line.strip() for line in lines if line.strip()]
+    if lines and lines[0][:1] in ('S', 's'):
+        return romEmuImage.readSRecord(lines)
+    return romEmuImage.readIntelHex(lines)
+
+
+class EmulatorPort:
+    """The serial port of the emulator and the operations on it."""
+
+    def __init__(self, port, baudrate=9600, reset=True):
+        self.port = port
+        self.baudrate = baudrate
+        self.reset = reset
+        self.ser = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        try:
+            self.ser, connection = romEmuConnect.connect(self.port, self.baudrate, reset=self.reset)
+        except romEmuConnect.ConnectError as e:
+            raise DaemonError(str(e))
+        if connection.version is not None:
+            self.version = connection.version
+        romEmuConnect.clearOffset(self.ser, connection)
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def execute(self, request):
+        """Run one request; returns the reply object."""
+        op = request.get("op")
+        handler = getattr(self, "op_" + str(op), None)
+        if handler is None:
+            return {"ok": False, "error": "unknown operation " + str(op), "log": []}
+        log = []
+        with self.lock:
+            try:
+                if self.ser is None:
+                    log.append("Reopening " + self.port)
+                    self.open()
+                result = handler(request, log.append)
+            except serial.SerialException as e:
+                self.close()        # reopened on the next request
+                return {"ok": False, "error": str(e), "log": log}
+            except (DaemonError, ValueError, KeyError, TypeError) as e:
+                return {"ok": False, "error": str(e), "log": log}
+        return {"ok": True, "result": result, "log": log}
+
+    # operations, called with the request and a function for log lines
+
+    def op_version(self, request, out):
+        return self.version
+
+    def op_command(self, request, out):
+        """Send a command line; returns the reply lines up to a quiet period."""
+        timeout = self.ser.timeout
+        self.ser.timeout = request.get("quiet", QUIETTIME)
+        try:
+            self.ser.reset_input_buffer()
+            self.ser.write((request["line"] + LF).encode())
+            lines = []
+            while True:
+                raw = self.ser.readline()
+                if not raw:
+                    return lines
+                lines.append(raw.decode('ascii', 'replace').rstrip("\r\n"))
+        finally:
+            self.ser.timeout = timeout
+
+    def op_upload(self, request, out):
+        """Upload the records in "lines", as romEmuFeed.py does."""
+        lines = request["lines"]
+        offset = request.get("offset", 0)
+        window = max(1, request.get("window", romEmuUpload.DEFAULTWINDOW))
+        self.setOffset(offset)
+        plan = None
+        if request.get("fillCopy"):
+            plan = romEmuPlan.planUpload(imageFromRecords(lines), offset, request.get("repack", False))
+        if request.get("relay"):
+            self.relay(True)
+        try:
+            result = romEmuShadow.deltaUpload(self.ser, lines, romEmuShadow.shadowKey(self.port), offset=offset,
+                                              full=request.get("full", False), window=window, out=out,
+                                              binary=request.get("binary", False), plan=plan)
+        finally:
+            if request.get("relay"):
+                self.relay(False)
+        out(result.summary())
+        return {"records": result.records, "dataBytes": result.dataBytes, "wireBytes": result.wireBytes,
+                "errors": result.errors, "timeouts": result.timeouts, "retransmits": result.retransmits,
+                "elapsed": result.elapsed}
+
+    def op_verify(self, request, out):
+        """Verify the RAM against the records in "lines"; returns the differences."""
+        offset = request.get("offset", 0)
+        self.setOffset(offset)
+        result = romEmuVerify.verify(self.ser, imageFromRecords(request["lines"]), offset, out=out)
+        out(result.summary())
+        if result.failed:
+            raise DaemonError("no reply from the emulator")
+        return result.differences
+
+    def op_checksum(self, request, out):
+        checksum = romEmuUpload.queryChecksum(self.ser, request["start"], request["end"])
+        if checksum is None:
+            raise DaemonError("no reply from the emulator")
+        return checksum
+
+    def op_dump(self, request, out):
+        """Read start up to end; returns the data as hex."""
+        start, end = request["start"], request["end"]
+        command = request.get("command", romEmuDump.HEXCOMMAND)
+        data = bytearray()
+        for chunkStart in range(start, end, romEmuDump.CHUNKSIZE):
+            chunkEnd = min(chunkStart + romEmuDump.CHUNKSIZE, end)
+            for attempt in range(romEmuDump.RETRIES + 1):
+                chunk = romEmuDump.readChunk(self.ser, chunkStart, chunkEnd, command)
+                if chunk is not None:
+                    break
+                out("Retry %04X-%04X" % (chunkStart, chunkEnd))
+            if chunk is None:
+                raise DaemonError("cannot read %04X-%04X" % (chunkStart, chunkEnd))
+            data += chunk
+        return data.hex()
+
+    def op_fill(self, request, out):
+        if not romEmuUpload.fillRange(self.ser, request["start"], request["end"], request["value"]):
+            raise DaemonError("no reply from the emulator")
+
+    def op_copy(self, request, out):
+        if not romEmuUpload.copyRange(self.ser, request["start"], request["end"], request["target"]):
+            raise DaemonError("no reply from the emulator")
+
+    def op_relay(self, request, out):
+        self.relay(request["on"])
+
+    def setOffset(self, offset):
+        """
+        Set F to the offset of a request: another client may have left a
+        different one. Called with the lock held, like every operation.
+        """
+        self.ser.write(("F%04X" % offset + LF).encode())
+        if not self.ser.readline():
+            raise DaemonError("no reply to F%04X" % offset)
+
+    def relay(self, on):
+        self.ser.write(("R1" if on else "R0").encode() + LF.encode())
+        self.ser.readline()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            try:
+                request = json.loads(raw.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError("request is not an object")
+            except ValueError as e:
+                reply = {"ok": False, "error": "bad request: " + str(e), "log": []}
+            else:
+                reply = self.server.emulator.execute(request)
+            self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, emulator):
+        self.emulator = emulator
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+
+
+class DaemonClient:
+    """Connection to a running daemon; every method sends one request."""
+
+    def __init__(self, path=SOCKETPATH):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError as e:
+            self.sock.close()
+            raise DaemonError("no daemon on {}: {}".format(path, e))
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, op, out=None, **arguments):
+        """Send op with its arguments; returns the result, log lines go to out."""
+        arguments["op"] = op
+        self.file.write((json.dumps(arguments) + "\n").encode('utf-8'))
+        self.file.flush()
+        raw = self.file.readline()
+        if not raw:
+            raise DaemonError("the daemon closed the connection")
+        reply = json.loads(raw.decode('utf-8'))
+        if out is not None:
+            for line in reply.get("log", []):
+                out(line)
+        if not reply.get("ok"):
+            raise DaemonError(reply.get("error"))
+        return reply.get("result")
+
+    def version(self):
+        return self.request("version")
+
+    def command(self, line, quiet=QUIETTIME):
+        return self.request("command", line=line, quiet=quiet)
+
+    def upload(self, lines, out=print, **options):
+        return self.request("upload", out=out, lines=list(lines), **options)
+
+    def verify(self, lines, offset=0, out=print):
+        return self.request("verify", out=out, lines=list(lines), offset=offset)
+
+    def checksum(self, start, end):
+        return tuple(self.request("checksum", start=start, end=end))
+
+    def dump(self, start, end, command=romEmuDump.HEXCOMMAND):
+        return bytes.fromhex(self.request("dump", start=start, end=end, command=command))
+
+    def fill(self, start, end, value):
+        self.request("fill", start=start, end=end, value=value)
+
+    def copy(self, start, end, target):
+        self.request("copy", start=start, end=end, target=target)
+
+    def relay(self, on):
+        self.request("relay", on=on)
+
+
+def daemonRunning(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def serve(port, path=SOCKETPATH, reset=True):
+    # checked before the port is opened, which resets the board
+    if os.path.exists(path):
+        if daemonRunning(path):
+            raise DaemonError("a daemon is already serving on " + path)
+        os.remove(path)             # left over from a daemon that stopped
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    emulator = EmulatorPort(port, reset=reset)
+    emulator.open()
+    print("ROMemu {} on {}, serving on {}".format(emulator.version or "(running)", port, path))
+    sys.stdout.flush()
+    server = DaemonServer(path, emulator)
+    os.chmod(path, 0o600)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        emulator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a ROM Emulator port open and serve it on a Unix socket",
+                                     usage="python3 romEmuDaemon.py [<ttyPort>] [options]")
+    parser.add_argument("port", nargs='?', default='/dev/ttyACM0')
+    parser.add_argument("--socket", default=SOCKETPATH, help="socket path (default %(default)s)")
+    parser.add_argument("--no-reset", action="store_true", help="do not reset a running board")
+    parser.add_argument("--command", metavar="LINE",
+                        help="send LINE to the emulator of a running daemon and print the reply")
+    args = parser.parse_args()
+
+    try:
+        if args.command is not None:
+            with DaemonClient(args.socket) as client:
+                print("\n".join(client.command(args.command)))
+            return 0
+        serve(args.port, args.socket, reset=not args.no_reset)
+    except (DaemonError, serial.SerialException) as e:
+        print(str(e))
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+#
+# Read the ROM Emulator RAM into a binary, hex-intel or S-record file.
+#
+# The range is read in chunks with the ; (hex-intel records), G (S1
+# records) or D (dump) command. Records are checked against their
+# checksums as they come in; a D chunk is checked with a K command. A
+# chunk that fails is read again, up to a number of retries. The chunks
+# read so far are kept in <file>.part with the progress in
+# <file>.part.json, so an interrupted dump continues where it stopped.
+#
+#   Usage: python3 romEmuDump.py <file> [<ttyPort>] [--start 0000] [--end 8000]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import romEmuConnect
+import romEmuImage
+import romEmuUpload
+import romEmuVerify
+
+LF = "\r\n"
+
+RAMSIZE      = romEmuVerify.RAMSIZE
+CHUNKSIZE    = 0x400        # about 3 s of ; output at 9600 baud
+RETRIES      = 3
+RECORDSIZE   = 16
+
+HEXCOMMAND  = 'hex'         # ;ssss-eeee
+S1COMMAND   = 's1'          # Gssss-eeee
+DUMPCOMMAND = 'dump'        # Dssss-eeee, checked with K
+
+HEXEXTENSIONS = ('.hex', '.ihx')
+S1EXTENSIONS  = ('.s19', '.s', '.srec', '.mot')
+
+
+def readRecords(ser, start, end, s1=False):
+    """
+    Read start up to (not including) end with ; or G. Returns the data,
+    None on a timeout, a checksum error or an unexpected record.
+    """
+    command = "G" if s1 else ";"
+    ser.write(("%s%04X-%04X" % (command, start, end) + LF).encode())
+    count = (end - start + RECORDSIZE - 1) // RECORDSIZE
+    data = bytearray()
+    header = False
+    ok = True
+    while count:
+        raw = ser.readline()
+        if not raw:
+            return None
+        line = raw.decode('ascii', 'replace').strip()
+        if not header:
+            header = line == "%04X-%04X" % (start, end)
+            continue
+        count -= 1
+        try:
+            record = romEmuImage.parseRecord(line)
+        except ValueError:
+            record = None
+        if record is None or record[0] != start + len(data):
+            ok = False                  # read on to the end of the chunk
+            continue
+        data += record[1]
+    if s1 and not ser.readline():       # S9030000FC
+        return None
+    return bytes(data[:end - start]) if ok else None
+
+
+def readChecked(ser, start, end):
+    """Read start up to end with D and check it with K; None when they do not agree."""
+    data = romEmuVerify.readDump(ser, start, end)
+    if data is None:
+        return None
+    if romEmuUpload.queryChecksum(ser, start, end - 1) != romEmuVerify.expectedChecksum(data):
+        return None
+    return data
+
+
+def readChunk(ser, start, end, command=HEXCOMMAND):
+    if command == DUMPCOMMAND:
+        return readChecked(ser, start, end)
+    return readRecords(ser, start, end, s1=command == S1COMMAND)
+
+
+class DumpResult:
+    """Counters of a dump, filled by dumpToFile()."""
+
+    def __init__(self):
+        self.bytesRead = 0
+        self.chunks = 0
+        self.resumed = 0            # chunks read by an earlier, interrupted dump
+        self.retries = 0
+        self.failed = []            # start addresses of the chunks that could not be read
+        self.elapsed = 0.0
+
+    def ok(self):
+        return not self.failed
+
+    def summary(self):
+        status = "Ok" if self.ok() else "{} chunks failed".format(len(self.failed))
+        return "Dump {}: {} bytes in {} chunks ({} resumed, {} retries) in {:.1f} s".format(
+            status, self.bytesRead, self.chunks, self.resumed, self.retries, self.elapsed)
+
+
+def fileFormat(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in HEXEXTENSIONS:
+        return romEmuImage.INTELHEX
+    if extension in S1EXTENSIONS:
+        return romEmuImage.S1RECORD
+    return romEmuImage.BINARY
+
+
+def writeImage(path, data, address, fmt):
+    """Write data, at address in the file, as fmt."""
+    if fmt == romEmuImage.BINARY:
+        with open(path, 'wb') as f:
+            f.write(data)
+        return
+    image = romEmuImage.RomImage()
+    image.setBytes(address, data)
+    with open(path, 'w') as f:
+        f.write("\n".join(image.records(fmt)) + "\n")
+
+
+def dumpToFile(ser, path, start=0, end=RAMSIZE, fmt=None, base=0, command=HEXCOMMAND,
+               chunkSize=CHUNKSIZE, retries=RETRIES, out=print):
+    """
+    Read the RAM from start up to (not including) end from the emulator
+    on ser into path, as fmt (by extension when None) with the data at
+    base + start. Continues an interrupted dump of the same range.
+    Returns a DumpResult; the file is only written when all chunks are read.
+    """
+    if not 0 <= start < end <= RAMSIZE:
+        raise ValueError("range %04X-%04X is outside the RAM" % (start, end))
+    if fmt is None:
+        fmt = fileFormat(path)
+    partPath = path + ".part"
+    statePath = partPath + ".json"
+    state = {"start": start, "end": end, "chunkSize": chunkSize, "done": []}
+    data = bytearray(end - start)
+    try:
+        with open(statePath, 'r') as f:
+            saved = json.load(f)
+        with open(partPath, 'rb') as f:
+            partData = f.read()
+        if all(saved.get(key) == state[key] for key in ("start", "end", "chunkSize")) and \
+                len(partData) == len(data):
+            state = saved
+            data[:] = partData
+    except (OSError, ValueError):
+        pass
+
+    result = DumpResult()
+    begin = time.monotonic()
+    done = set(state["done"])
+    result.resumed = len(done)
+    if done:
+        out("Resuming, {} chunks already read".format(len(done)))
+    for chunkStart in range(start, end, chunkSize):
+        chunkEnd = min(chunkStart + chunkSize, end)
+        result.chunks += 1
+        if chunkStart in done:
+            result.bytesRead += chunkEnd - chunkStart
+            continue
+        for attempt in range(retries + 1):
+            if attempt:
+                result.retries += 1
+                out("Retry %04X-%04X" % (chunkStart, chunkEnd))
+            chunk = readChunk(ser, chunkStart, chunkEnd, command)
+            if chunk is not None:
+                break
+        if chunk is None:
+            out("Failed %04X-%04X" % (chunkStart, chunkEnd))
+            result.failed.append(chunkStart)
+            continue
+        out("Read %04X-%04X" % (chunkStart, chunkEnd))
+        data[chunkStart - start:chunkEnd - start] = chunk
+        result.bytesRead += len(chunk)
+        done.add(chunkStart)
+        state["done"] = sorted(done)
+        with open(partPath, 'wb') as f:
+            f.write(data)
+        with open(statePath, 'w') as f:
+            json.dump(state, f)
+    result.elapsed = time.monotonic() - begin
+
+    if result.ok():
+        writeImage(path, data, base + start, fmt)
+        for partial in (partPath, statePath):
+            if os.path.exists(partial):
+                os.remove(partial)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read the ROM Emulator RAM into a file",
+                                     usage="python3 romEmuDump.py <file> [<ttyPort>] [options]")
+    parser.add_argument("file", help=".bin, .hex or .s19 file")
+    parser.add_argument("port", nargs='?', default='/dev/ttyACM0')
+    parser.add_argument("--start", type=lambda s: int(s, 16), default=0, help="first address (hex)")
+    parser.add_argument("--end", type=lambda s: int(s, 16), default=RAMSIZE,
+                        help="end address (hex, not included, default 8000)")
+    parser.add_argument("--base", type=lambda s: int(s, 16), default=0,
+                        help="added to the addresses in a hex or S-record file (hex)")
+    parser.add_argument("--format", choices=[romEmuImage.BINARY, romEmuImage.INTELHEX, romEmuImage.S1RECORD],
+                        help="file format (default: by extension)")
+    parser.add_argument("--command", choices=[HEXCOMMAND, S1COMMAND, DUMPCOMMAND], default=HEXCOMMAND,
+                        help="firmware command used to read (default %(default)s)")
+    parser.add_argument("--chunk", type=lambda s: int(s, 16), default=CHUNKSIZE,
+                        help="chunk size (hex, default %X)" % CHUNKSIZE)
+    parser.add_argument("--retries", type=int, default=RETRIES)
+    parser.add_argument("--no-reset", action="store_true", help="do not reset a running board")
+    args = parser.parse_args()
+
+    try:
+        ser, connection = romEmuConnect.connect(args.port, reset=not args.no_reset)
+    except romEmuConnect.ConnectError as e:
+        print(str(e))
+        return 1
+    try:
+        result = dumpToFile(ser, args.file, args.start, args.end, fmt=args.format, base=args.base,
+                            command=args.command, chunkSize=max(RECORDSIZE, args.chunk),
+                            retries=args.retries)
+    except ValueError as e:
+        print(str(e))
+        return 1
+    finally:
+        ser.close()
+    print(result.summary())
+    return 0 if result.ok() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,48 +1,265 @@
 #!/usr/bin/python3
 #
 
-import sys
-import serial
+import argparse
+import atexit
+import os
 import time
 
-port         = '/dev/ttyACM0'
-hexOffsetStr = ""
+import romEmuCapture
+import romEmuConnect
+import romEmuDaemon
+import romEmuImage
+import romEmuPlan
+import romEmuShadow
+import romEmuSpace
+import romEmuTrace
+import romEmuUpload
+import romEmuVerify
+
+parser = argparse.ArgumentParser(
+    usage="python3 romEmuFeed.py <hexFile> [<ttyPort>] [<hexOffset>] [options]")
+parser.add_argument("hexFile")
+parser.add_argument("port", nargs='?', default='/dev/ttyACM0')
+parser.add_argument("hexOffset", nargs='?', default="")
+parser.add_argument("--window", type=int, default=romEmuUpload.DEFAULTWINDOW,
+                    help="records in flight, paced by the firmware replies (default %(default)s)")
+parser.add_argument("--delay", type=float, default=None,
+                    help="use fixed delays of DELAY seconds instead of reply pacing")
+parser.add_argument("--full", action="store_true",
+                    help="send all records, not only those that differ from the last upload")
+parser.add_argument("--repack", action="store_true",
+                    help="merge the data into the longest records the firmware accepts")
+parser.add_argument("--fill-copy", action="store_true",
+                    help="send runs of equal bytes as N and repeated blocks as C commands")
+parser.add_argument("--binary", action="store_true",
+                    help="send binary frames if the firmware supports them (v0.12.0 and later)")
+parser.add_argument("--base", type=lambda s: int(s, 16), default=0,
+                    help="load address (hex) of a binary file (default 0000)")
+parser.add_argument("--eprom", choices=sorted(romEmuSpace.EPROMS, key=len),
+                    help="EPROM type the emulator replaces; only the bytes the CPU sees are sent")
+parser.add_argument("--pod", type=int, choices=sorted(romEmuSpace.PODS),
+                    help="pins of the fitted pod (default: those of --eprom)")
+parser.add_argument("--rom-base", type=lambda s: int(s, 16), default=0,
+                    help="CPU address (hex) of the EPROM socket, sets the offset (default 0000)")
+parser.add_argument("--decode", type=lambda s: int(s, 16), default=None,
+                    help="size (hex) of the range decoded for the socket, where the EPROM is mirrored")
+parser.add_argument("--outside", choices=[romEmuSpace.CLIP, romEmuSpace.REJECT], default=romEmuSpace.CLIP,
+                    help="data the CPU cannot see is left out or rejected (default %(default)s)")
+parser.add_argument("--verify", action="store_true",
+                    help="verify the emulator RAM against the file after the upload")
+parser.add_argument("--verify-only", action="store_true",
+                    help="only verify the emulator RAM against the file, do not upload")
+parser.add_argument("--timing", action="store_true",
+                    help="show the reply latency histogram and where the upload time went")
+parser.add_argument("--trace", metavar="FILE",
+                    help="write the timing of every record to FILE (.json or .csv), implies --timing")
+parser.add_argument("--capture", metavar="FILE",
+                    help="log every byte sent and received to FILE, for romEmuReplay.py")
+parser.add_argument("--watch", action="store_true",
+                    help="stay connected and send the changed records when the file changes")
+parser.add_argument("--no-reset", action="store_true",
+                    help="do not reset the board when it is running, probe it instead")
+parser.add_argument("--daemon", nargs='?', const=romEmuDaemon.SOCKETPATH, metavar="SOCKET",
+                    help="upload through a running romEmuDaemon.py instead of opening the port")
+args = parser.parse_args()
 
-if len(sys.argv) == 1:
-   print("Usage: python3 romEmuFeed.py <hexFile> [<ttyPort>] [<hexOffset>]")
-   exit()
-if len(sys.argv) > 1:
-    hexFile = sys.argv[1]
-if len(sys.argv) > 2:
-    port = sys.argv[2]
-if len(sys.argv) > 3:
-    hexOffsetStr = "F" + sys.argv[3]
+hexFile      = args.hexFile
+port         = args.port
+hexOffsetStr = ""
+if args.hexOffset:
+    hexOffsetStr = "F" + args.hexOffset
 
 LF = "\r\n"
 sendDelay = 0.05
-time.sleep(sendDelay)
+resetDelay = 0.5        # R1/R0 around a watch update
+watchInterval = 0.5     # seconds between the checks of the file
+
+profile = None
+if args.eprom or args.pod:
+    if args.hexOffset:
+        print("The offset follows from --rom-base, do not give <hexOffset> as well")
+        exit(1)
+    try:
+        profile = romEmuSpace.TargetProfile(args.eprom, args.pod, args.rom_base, args.decode)
+    except romEmuSpace.SpaceError as e:
+        print(str(e))
+        exit(1)
+
 
-ser = serial.Serial(port, 9600, timeout=2)  # open serial port
+def loadImage(report=print):
+    """Read the file, mapped on the target profile; returns (image, records, offset)."""
+    image = romEmuImage.loadFile(hexFile, base=args.base)
+    if profile is None:
+        offset = int(args.hexOffset, 16) if args.hexOffset else 0
+        for start, end in romEmuSpace.ramOverflow(image, offset):
+            report("Warning: %X-%X does not fit the 32 kByte RAM and wraps around" % (start, end))
+    else:
+        plan = romEmuSpace.planSpace(image, profile, args.outside)
+        for line in plan.report():
+            report(line)
+        image, offset = plan.image, plan.offset
+    return image, romEmuImage.uploadRecords(image, args.repack), offset
 
-print(ser.readline())
 
-file = open(hexFile, 'r')
-lines = file.readlines()
-file.close()
+try:
+    image, lines, hexOffset = loadImage()
+except (OSError, romEmuImage.ImageError, romEmuSpace.SpaceError) as e:
+    print(hexFile + ": " + str(e))
+    exit(1)
+if profile is not None and hexOffset:
+    hexOffsetStr = "F%04X" % hexOffset
 
-print(ser.readline().strip())
-time.sleep(sendDelay)
+if args.daemon:
+    # the daemon has the port open, no reset and no banner to wait for
+    if args.delay is not None or args.watch or args.timing or args.trace or args.capture:
+        print("--delay, --watch, --timing, --trace and --capture need the port itself, not --daemon")
+        exit(1)
+    try:
+        with romEmuDaemon.DaemonClient(args.daemon) as client:
+            # upload and verify set F themselves, under the lock of the daemon
+            if not args.verify_only:
+                client.upload(lines, offset=hexOffset, full=args.full, window=max(1, args.window),
+                              binary=args.binary, fillCopy=args.fill_copy, repack=args.repack)
+            if (args.verify or args.verify_only) and client.verify(lines, offset=hexOffset):
+                exit(1)
+    except romEmuDaemon.DaemonError as e:
+        print(str(e))
+        exit(1)
+    exit(0)
+
+try:
+    ser, connection = romEmuConnect.connect(port, reset=not args.no_reset)
+except romEmuConnect.ConnectError as e:
+    print(str(e))
+    exit(1)
+print(connection.summary())
+if args.capture:
+    try:
+        capture = romEmuCapture.CaptureWriter(args.capture, ser.baudrate)
+    except OSError as e:
+        print(args.capture + ": " + str(e))
+        exit(1)
+    atexit.register(capture.close)
+    ser = romEmuCapture.CapturePort(ser, capture)
 
 if hexOffsetStr:
     ser.write(str.encode(hexOffsetStr + LF))
     print(ser.readline().strip())
-    time.sleep(sendDelay)
-
-for line in lines:
-    lineStrip = line.strip()
-    if (lineStrip):
-        print(lineStrip)
-        ser.write(str.encode(lineStrip + LF))
-        time.sleep(sendDelay)
-        print(ser.readline().strip())
-        time.sleep(sendDelay)
+else:
+    romEmuConnect.clearOffset(ser, connection)
+
+trace = romEmuTrace.UploadTrace(ser.baudrate) if args.timing or args.trace else None
+loaded = []             # records known to be in the RAM, for --watch
+
+if args.verify_only:
+    pass
+elif args.delay is not None:
+    sendDelay = args.delay
+    sleep = trace.sleep if trace is not None else time.sleep
+    for line in lines:
+        lineStrip = line.strip()
+        if (lineStrip):
+            print(lineStrip)
+            entry = romEmuUpload.timedWrite(ser, str.encode(lineStrip + LF), trace,
+                                            romEmuUpload.recordAddress(lineStrip), 'record',
+                                            romEmuUpload.recordDataSize(lineStrip))
+            sleep(sendDelay)
+            reply = ser.readline().strip()
+            print(reply)
+            romEmuUpload.timedReply(trace, entry,
+                                    romEmuUpload.classifyReply(reply.decode('ascii', 'replace')) or 'noreply')
+            sleep(sendDelay)
+else:
+    plan = romEmuPlan.planUpload(image, hexOffset, args.repack) if args.fill_copy else None
+    result = romEmuShadow.deltaUpload(ser, lines, romEmuShadow.shadowKey(port), offset=hexOffset,
+                                      full=args.full, window=max(1, args.window), binary=args.binary,
+                                      plan=plan, trace=trace)
+    print(result.summary())
+    if not (result.errors or result.timeouts or result.cancelled):
+        loaded = lines
+
+if trace is not None and not args.verify_only:
+    trace.finish()
+    print("\n".join(trace.summary()))
+    if args.trace:
+        trace.save(args.trace)
+        print("Trace written to " + args.trace)
+
+if args.verify or args.verify_only:
+    verifyResult = romEmuVerify.verify(ser, image, offset=hexOffset)
+    print(verifyResult.summary())
+    if not verifyResult.ok():
+        exit(1)
+    loaded = lines
+
+
+def fileStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def setRelay(on):
+    ser.write(("R1" if on else "R0").encode() + LF.encode())
+    ser.readline()
+    time.sleep(resetDelay)
+
+
+def watchFile(loaded):
+    """
+    Wait for changes of the file and send the records that differ from
+    the previous version, with the target board held in reset. loaded
+    are the records known to be in the RAM; the others are sent on the
+    first change.
+    """
+    previous = set(loaded)
+    stamp = fileStamp(hexFile)
+    print("Watching " + hexFile + ", Ctrl-C to stop")
+    while True:
+        time.sleep(watchInterval)
+        newStamp = fileStamp(hexFile)
+        if newStamp is None or newStamp == stamp:
+            continue
+        time.sleep(watchInterval)       # let the build finish writing
+        if fileStamp(hexFile) != newStamp:
+            continue
+        stamp = newStamp
+        try:
+            newImage, newLines = loadImage(report=lambda text: None)[:2]
+        except (OSError, romEmuImage.ImageError, romEmuSpace.SpaceError) as e:
+            print(hexFile + ": " + str(e))
+            continue
+        changed = [line for line in newLines if line not in previous]
+        if not changed:
+            print(time.strftime("%H:%M:%S") + " no changes")
+            continue
+        print(time.strftime("%H:%M:%S") + " {} of {} records changed".format(len(changed), len(newLines)))
+        setRelay(True)
+        result = romEmuUpload.sendRecords(ser, changed, window=max(1, args.window), out=lambda text: None,
+                                          binary=args.binary, offset=hexOffset)
+        if result.garbled:
+            romEmuVerify.repair(ser, newLines, result, hexOffset, window=max(1, args.window), out=print)
+        shadow = romEmuShadow.Shadow(romEmuShadow.shadowKey(port)).load()
+        if result.errors or result.timeouts:
+            previous = set()            # send everything on the next change
+            shadow.invalidate()
+        else:
+            previous = set(newLines)
+            shadow.update(changed, hexOffset)
+            shadow.fingerprint(ser)
+        shadow.save()
+        setRelay(False)
+        print(result.summary())
+        if args.verify:
+            print(romEmuVerify.verify(ser, newImage, offset=hexOffset).summary())
+
+
+if args.watch:
+    try:
+        watchFile(loaded)
+    except KeyboardInterrupt:
+        pass
+    ser.close()
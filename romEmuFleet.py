@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+#
+# Upload to several ROM Emulators at once.
+#
+# Every port gets its own worker thread, which connects with
+# romEmuConnect.py and uploads its image with the reply paced uploader of
+# romEmuUpload.py. Without a port list the USB serial ports are scanned;
+# ports where no ROMemu answers are skipped. A progress
+# table is shown while the uploads run, followed by a pass/fail summary.
+#
+#   Usage: python3 romEmuFleet.py <file> [--ports p1 p2 ...] [--map port=file ...]
+
+import argparse
+import sys
+import threading
+import time
+
+import serial
+import serial.tools.list_ports
+
+import romEmuConnect
+import romEmuImage
+import romEmuPlan
+import romEmuShadow
+import romEmuUpload
+import romEmuVerify
+
+LF = "\r\n"
+REFRESH       = 0.5
+
+
+class PortStatus:
+    """State of one port worker, read by the progress table."""
+
+    def __init__(self, port, path, required=True):
+        self.port = port
+        self.path = path
+        self.required = required    # given by the user, not found by the scan
+        self.state = "waiting"
+        self.version = ""
+        self.sent = 0
+        self.total = 0
+        self.rate = 0.0
+        self.passed = None          # None: skipped, no ROMemu on the port
+        self.message = ""
+
+
+def candidatePorts():
+    """The USB serial ports, where a ROMemu might be connected."""
+    return sorted(info.device for info in serial.tools.list_ports.comports() if info.vid is not None)
+
+
+def flashPort(status, images, args):
+    """
+    Connect, upload and verify one port, runs in a thread per port. Any
+    failure ends up in status, so one device cannot stop the others.
+    """
+    try:
+        status.state = "connect"
+        ser, connection = romEmuConnect.connect(status.port, args.baud, reset=not args.no_reset)
+    except romEmuConnect.ConnectError:
+        status.state = "no ROMemu"
+        status.passed = False if status.required else None
+        return
+    except Exception as e:
+        status.state, status.passed, status.message = "error", False, str(e) or type(e).__name__
+        return
+    try:
+        status.version = connection.version or "running"
+        image, lines = images[status.path]
+        if args.offset:
+            ser.write(("F" + args.offset + LF).encode())
+            ser.readline()
+        else:
+            romEmuConnect.clearOffset(ser, connection)
+        status.state = "upload"
+        status.total = len(lines)
+
+        def progress(result, total):
+            status.sent, status.total = result.records, total
+            status.rate = result.bytesPerSecond()
+
+        offset = int(args.offset, 16) if args.offset else 0
+        plan = romEmuPlan.planUpload(image, offset, args.repack) if args.fill_copy else None
+        result = romEmuShadow.deltaUpload(ser, lines, romEmuShadow.shadowKey(status.port), offset=offset,
+                                          full=args.full, window=args.window, out=lambda text: None,
+                                          progress=progress, binary=args.binary, plan=plan)
+        status.sent = status.total
+        status.rate = result.bytesPerSecond()
+        status.passed = not (result.errors or result.timeouts)
+        status.message = "{} errors, {} timeouts".format(result.errors, result.timeouts)
+        if status.passed and args.verify:
+            status.state = "verify"
+            verifyResult = romEmuVerify.verify(ser, image, offset=offset, out=lambda text: None)
+            status.passed = verifyResult.ok()
+            status.message = verifyResult.summary()
+        status.state = "done"
+    except Exception as e:
+        status.state, status.passed, status.message = "error", False, str(e) or type(e).__name__
+    finally:
+        ser.close()
+
+
+def progressTable(statuses):
+    lines = ["{:<20} {:<9} {:<10} {:>11} {:>8}".format("port", "firmware", "state", "records", "bytes/s")]
+    for status in statuses:
+        lines.append("{:<20} {:<9} {:<10} {:>5}/{:<5} {:>8.0f}".format(
+            status.port, status.version, status.state, status.sent, status.total, status.rate))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload to several ROM Emulators at once")
+    parser.add_argument("file", nargs='?', help="image for every port without a --map entry")
+    parser.add_argument("--ports", nargs='+', help="ports to use (default: scan the USB serial ports)")
+    parser.add_argument("--map", nargs='+', default=[], metavar="PORT=FILE",
+                        help="image per port")
+    parser.add_argument("--offset", default="", help="address offset (hex), sent as F command")
+    parser.add_argument("--baud", type=int, default=9600)
+    parser.add_argument("--no-reset", action="store_true",
+                        help="do not reset boards that are running, probe them instead")
+    parser.add_argument("--window", type=int, default=romEmuUpload.DEFAULTWINDOW)
+    parser.add_argument("--full", action="store_true", help="send all records")
+    parser.add_argument("--repack", action="store_true", help="use the longest records")
+    parser.add_argument("--fill-copy", action="store_true", help="send runs as N and repeated blocks as C")
+    parser.add_argument("--binary", action="store_true", help="send binary frames where supported")
+    parser.add_argument("--verify", action="store_true", help="verify every emulator after the upload")
+    args = parser.parse_args()
+
+    portMap = dict(entry.split("=", 1) for entry in args.map)
+    if args.ports:
+        ports = list(args.ports)
+    elif args.file:
+        ports = candidatePorts()
+    else:
+        ports = []
+    ports += [port for port in portMap if port not in ports]
+    ports = [port for port in ports if portMap.get(port, args.file)]
+    if not ports:
+        print("No ports to upload to")
+        return 1
+
+    images = {}
+    statuses = []
+    for port in ports:
+        path = portMap.get(port, args.file)
+        if path not in images:
+            try:
+                image = romEmuImage.loadFile(path)
+                images[path] = (image, romEmuImage.uploadRecords(image, args.repack))
+            except (OSError, romEmuImage.ImageError) as e:
+                print(path + ": " + str(e))
+                return 1
+        statuses.append(PortStatus(port, path, required=bool(args.ports) or port in portMap))
+
+    start = time.monotonic()
+    workers = [threading.Thread(target=flashPort, args=(status, images, args), daemon=True)
+               for status in statuses]
+    for worker in workers:
+        worker.start()
+    interactive = sys.stdout.isatty()
+    shown = 0
+    while any(worker.is_alive() for worker in workers):
+        time.sleep(REFRESH)
+        if interactive:
+            table = progressTable(statuses)
+            if shown:
+                sys.stdout.write("\x1b[{}A".format(shown))
+            sys.stdout.write("".join(line + "\x1b[K\n" for line in table))
+            sys.stdout.flush()
+            shown = len(table)
+    if not interactive:
+        print("\n".join(progressTable(statuses)))
+
+    print()
+    failed = 0
+    for status in statuses:
+        if status.passed is None:
+            result = "skipped"
+        elif status.passed:
+            result = "PASS"
+        else:
+            result = "FAIL"
+            failed += 1
+        print("{:<20} {:<7} {:<30} {}".format(status.port, result, status.path or "", status.message))
+    print("{} passed, {} failed in {:.1f} s".format(
+        sum(1 for status in statuses if status.passed), failed, time.monotonic() - start))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
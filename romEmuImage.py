@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+#
+# Image model for the ROM Emulator support software.
+#
+# Intel HEX (including extended segment and linear address records),
+# Motorola S1/S2/S3 records and raw binary files are read in one pass
+# into a sparse RomImage: a sorted list of segments, each a bytearray.
+# Checksums and overlapping data are checked while reading. The image
+# can be written again as the records the firmware accepts: hex-intel
+# data records or S1 records with 16 bit addresses.
+
+import bisect
+import os
+
+# The firmware stores a record in its 90 character serialBuffer and
+# reports an overflow at the 90th character, so a record has at most 89
+# characters: ":ccaaaatt" + 2n + "ss" and "S1ccaaaa" + 2n + "ss" both
+# allow 39 data bytes.
+SERIALBUFSIZE = 90
+MAXRECORDDATA = (SERIALBUFSIZE - 1 - 11) // 2
+RECORDSIZE    = 16
+
+INTELHEX = 'intel'
+S1RECORD = 's1'
+BINARY   = 'binary'
+
+OVERLAP_ERROR = 'error'     # conflicting data is an error, equal data is accepted
+OVERLAP_LAST  = 'last'      # later data wins, as in the emulator RAM
+OVERLAP_FIRST = 'first'     # earlier data wins
+
+BINARYEXTENSIONS = ('.bin', '.rom', '.img')
+READCHUNK = 0x10000
+
+
+class ImageError(ValueError):
+    """Malformed record, checksum error or conflicting overlap in an image file."""
+
+
+class RomImage:
+    """
+    Sparse memory image. Segments are kept sorted, non-overlapping and
+    merged when adjacent, so a file with consecutive records ends up as
+    a single bytearray.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._blocks = []
+        self.sourceFormat = INTELHEX
+        self.startAddress = None        # entry point from a start address record
+
+    def __len__(self):
+        return sum(len(block) for block in self._blocks)
+
+    def segments(self):
+        """List of (start, memoryview) of the contiguous loaded ranges."""
+        return [(start, memoryview(block)) for start, block in zip(self._starts, self._blocks)]
+
+    def span(self):
+        """(first, last) address of the loaded data, None for an empty image."""
+        if not self._starts:
+            return None
+        return self._starts[0], self._starts[-1] + len(self._blocks[-1]) - 1
+
+    def setBytes(self, address, data, overlap=OVERLAP_ERROR):
+        if not data:
+            return
+        end = address + len(data)
+        starts, blocks = self._starts, self._blocks
+        # fast path: consecutive records extend the last segment
+        if starts and address == starts[-1] + len(blocks[-1]):
+            blocks[-1] += data
+            return
+        lo = bisect.bisect_right(starts, address) - 1
+        if lo < 0 or starts[lo] + len(blocks[lo]) < address:
+            lo += 1
+        hi = lo
+        while hi < len(starts) and starts[hi] <= end:
+            hi += 1
+        if lo == hi:
+            starts.insert(lo, address)
+            blocks.insert(lo, bytearray(data))
+            return
+        newStart = min(address, starts[lo])
+        newEnd = max(end, starts[hi - 1] + len(blocks[hi - 1]))
+        merged = bytearray(newEnd - newStart)
+        if overlap == OVERLAP_FIRST:
+            merged[address - newStart:end - newStart] = data
+        for start, block in zip(starts[lo:hi], blocks[lo:hi]):
+            first, last = max(start, address), min(start + len(block), end)
+            if overlap == OVERLAP_ERROR and first < last and \
+                    block[first - start:last - start] != data[first - address:last - address]:
+                raise ImageError("conflicting data at %Xh" % first)
+            merged[start - newStart:start - newStart + len(block)] = block
+        if overlap != OVERLAP_FIRST:
+            merged[address - newStart:end - newStart] = data
+        starts[lo:hi] = [newStart]
+        blocks[lo:hi] = [merged]
+
+    def get(self, address, length, fill=0xFF):
+        """length bytes from address, fill where nothing is loaded."""
+        result = bytearray([fill]) * length
+        end = address + length
+        for start, block in zip(self._starts, self._blocks):
+            first, last = max(start, address), min(start + len(block), end)
+            if first < last:
+                result[first - address:last - address] = block[first - start:last - start]
+        return bytes(result)
+
+    def records(self, fmt=INTELHEX, recordSize=RECORDSIZE):
+        """The image as firmware data records of at most recordSize bytes plus an end record."""
+        lines = []
+        for start, data in self.segments():
+            if start + len(data) > 0x10000:
+                raise ImageError("data at %Xh is beyond the 16 bit address range" %
+                                 max(start, 0x10000))
+            for offset in range(0, len(data), recordSize):
+                chunk = data[offset:offset + recordSize]
+                if fmt == S1RECORD:
+                    lines.append(s1Record(start + offset, chunk))
+                else:
+                    lines.append(intelRecord(start + offset, chunk))
+        lines.append("S9030000FC" if fmt == S1RECORD else intelRecord(0, b'', 1))
+        return lines
+
+
+# record encoding
+
+def intelRecord(address, data, recordType=0):
+    raw = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF, recordType]) + bytes(data)
+    return ":" + (raw + bytes([-sum(raw) & 0xFF])).hex().upper()
+
+
+def s1Record(address, data):
+    raw = bytes([len(data) + 3, (address >> 8) & 0xFF, address & 0xFF]) + bytes(data)
+    return "S1" + (raw + bytes([0xFF - (sum(raw) & 0xFF)])).hex().upper()
+
+
+def parseRecord(line):
+    """
+    Return (address, data) for a hex-intel or S1 data record as the
+    firmware reads it, None for other records and lines. Raises
+    ValueError on malformed records.
+    """
+    line = line.strip()
+    if line.startswith(':'):
+        raw = bytes.fromhex(line[1:])
+        if len(raw) < 5 or len(raw) != raw[0] + 5:
+            raise ValueError("bad record length: " + line)
+        if sum(raw) & 0xFF:
+            raise ValueError("bad checksum: " + line)
+        if raw[3] != 0:
+            return None
+        return (raw[1] << 8) + raw[2], raw[4:-1]
+    if line[:2].upper() == "S1":
+        raw = bytes.fromhex(line[2:])
+        if len(raw) < 4 or len(raw) != raw[0] + 1:
+            raise ValueError("bad record length: " + line)
+        if (sum(raw) & 0xFF) != 0xFF:
+            raise ValueError("bad checksum: " + line)
+        return (raw[1] << 8) + raw[2], raw[3:-1]
+    return None
+
+
+# readers
+
+def readIntelHex(lines, image=None, overlap=OVERLAP_ERROR):
+    """Read hex-intel lines (any iterable, e.g. an open file) into image."""
+    if image is None:
+        image = RomImage()
+    image.sourceFormat = INTELHEX
+    base = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if not line.startswith(':'):
+                raise ValueError("no record mark")
+            raw = bytes.fromhex(line[1:])
+            if len(raw) < 5 or len(raw) != raw[0] + 5:
+                raise ValueError("bad record length")
+            if sum(raw) & 0xFF:
+                raise ValueError("bad checksum")
+            recordType = raw[3]
+            data = raw[4:-1]
+            if recordType == 0:
+                image.setBytes(base + (raw[1] << 8) + raw[2], data, overlap)
+            elif recordType == 1:
+                break
+            elif recordType == 2:
+                base = int.from_bytes(data, 'big') << 4
+            elif recordType == 4:
+                base = int.from_bytes(data, 'big') << 16
+            elif recordType in (3, 5):
+                image.startAddress = int.from_bytes(data, 'big')
+        except ValueError as e:
+            raise ImageError("line {}: {}".format(number, e))
+    return image
+
+
+def readSRecord(lines, image=None, overlap=OVERLAP_ERROR):
+    """Read Motorola S-record lines (S1/S2/S3 data) into image."""
+    if image is None:
+        image = RomImage()
+    image.sourceFormat = S1RECORD
+    addressSize = {'0': 2, '1': 2, '2': 3, '3': 4, '5': 2, '6': 3, '7': 4, '8': 3, '9': 2}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line[:1].upper() != 'S' or line[1:2] not in addressSize:
+                raise ValueError("no S-record")
+            size = addressSize[line[1]]
+            raw = bytes.fromhex(line[2:])
+            if len(raw) < size + 2 or len(raw) != raw[0] + 1:
+                raise ValueError("bad record length")
+            if (sum(raw) & 0xFF) != 0xFF:
+                raise ValueError("bad checksum")
+            address = int.from_bytes(raw[1:1 + size], 'big')
+            if line[1] in '123':
+                image.setBytes(address, raw[1 + size:-1], overlap)
+            elif line[1] in '789':
+                image.startAddress = address
+                break
+        except ValueError as e:
+            raise ImageError("line {}: {}".format(number, e))
+    return image
+
+
+def readBinary(f, image=None, base=0, overlap=OVERLAP_ERROR):
+    """Read a binary file object into image at address base."""
+    if image is None:
+        image = RomImage()
+    image.sourceFormat = BINARY
+    buffer = bytearray(READCHUNK)
+    view = memoryview(buffer)
+    address = base
+    while True:
+        count = f.readinto(buffer)
+        if not count:
+            break
+        image.setBytes(address, view[:count], overlap)
+        address += count
+    return image
+
+
+def fileFormat(path):
+    """INTELHEX, S1RECORD or BINARY, by extension and first character."""
+    if os.path.splitext(path)[1].lower() in BINARYEXTENSIONS:
+        return BINARY
+    with open(path, 'rb') as f:
+        head = f.read(256).lstrip()
+    if head.startswith(b':'):
+        return INTELHEX
+    if head[:1] in (b'S', b's') and head[1:2].isdigit():
+        return S1RECORD
+    return BINARY
+
+
+def loadFile(path, fmt=None, base=0, overlap=OVERLAP_ERROR):
+    """Read an image file in a single pass; fmt None detects the format."""
+    if fmt is None:
+        fmt = fileFormat(path)
+    if fmt == BINARY:
+        with open(path, 'rb') as f:
+            return readBinary(f, base=base, overlap=overlap)
+    with open(path, 'r') as f:
+        if fmt == S1RECORD:
+            return readSRecord(f, overlap=overlap)
+        return readIntelHex(f, overlap=overlap)
+
+
+def uploadRecords(image, repack=False):
+    """The records to send for image: S1 for S-record files, hex-intel otherwise."""
+    fmt = S1RECORD if image.sourceFormat == S1RECORD else INTELHEX
+    return image.records(fmt, MAXRECORDDATA if repack else RECORDSIZE)
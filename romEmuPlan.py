@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+#
+# Upload planner for the ROM Emulator.
+#
+# ROM images often hold long runs of padding (FFh or 00h) and repeated
+# tables. Sent as records, every one of those bytes costs two hex
+# characters. The planner maps the image on the emulator RAM, sends runs
+# with the N (fill) command and blocks that already occur at a lower
+# address with the C (copy) command, and only the remaining bytes as
+# records. The plan is executed as: fills, records, copies (in order of
+# target address, so a copy may use the result of an earlier one).
+#
+# Copies never overlap their source: copyData() in ROMemu.ino copies
+# byte by byte, and it never returns from a copy down from 0000. Every
+# copy in a plan is a copy up, from a lower to a higher address.
+
+import romEmuImage
+import romEmuUpload
+import romEmuVerify
+
+RAMSIZE = romEmuVerify.RAMSIZE
+MINFILL = 24            # shortest run sent as N
+MINCOPY = 32            # shortest repeated block sent as C
+
+FILLWIRE = len("N0000-0000:00") + len(romEmuUpload.LF) + len("F") + len(romEmuUpload.LF)
+COPYWIRE = len("C0000-0000-0000") + len(romEmuUpload.LF)
+
+RECORD = 0
+FILLED = 1
+COPIED = 2
+
+
+def recordWireBytes(records):
+    return sum(len(record) + len(romEmuUpload.LF) for record in records)
+
+
+class UploadPlan:
+    """Fill and copy commands (RAM addresses) plus the records for the other bytes."""
+
+    def __init__(self):
+        self.fills = []             # (start, end, value), end inclusive
+        self.copies = []            # (start, end, target)
+        self.records = []
+        self.offset = 0             # F offset of the records
+        self.plainWireBytes = 0     # the image sent as records only
+
+    def wireBytes(self):
+        return (recordWireBytes(self.records) + FILLWIRE * len(self.fills) +
+                COPYWIRE * len(self.copies))
+
+    def saved(self):
+        return self.plainWireBytes - self.wireBytes()
+
+    def summary(self):
+        return "Plan: {} fills, {} copies, {} records, {} bytes on the wire instead of {} ({} saved)".format(
+            len(self.fills), len(self.copies), len(self.records), self.wireBytes(),
+            self.plainWireBytes, self.saved())
+
+    def upload(self, ser, window=romEmuUpload.DEFAULTWINDOW, out=print, progress=None, cancel=None,
+               binary=False, trace=None):
+        """Execute the plan on the emulator on ser; returns a romEmuUpload.UploadResult."""
+        filled = copied = failed = 0
+        for start, end, value in self.fills:
+            out("N%04X-%04X:%02X" % (start, end, value))
+            if not romEmuUpload.fillRange(ser, start, end, value, trace):
+                failed += 1
+            filled += end - start + 1
+        result = romEmuUpload.sendRecords(ser, self.records, window=window, out=out, progress=progress,
+                                          cancel=cancel, binary=binary, trace=trace, offset=self.offset)
+        copies = [] if result.cancelled else self.copies
+        for start, end, target in copies:
+            out("C%04X-%04X-%04X" % (start, end, target))
+            if not romEmuUpload.copyRange(ser, start, end, target, trace):
+                failed += 1
+            copied += end - start + 1
+        result.records += len(self.fills) + len(copies)
+        result.dataBytes += filled + copied
+        result.wireBytes += FILLWIRE * len(self.fills) + COPYWIRE * len(copies)
+        result.timeouts += failed
+        return result
+
+
+def ramMap(image, offset=0):
+    """The image as it ends up in the RAM: (ram, known), later data wins as in the RAM."""
+    ram = bytearray(RAMSIZE)
+    known = bytearray(RAMSIZE)
+    for start, data in romEmuVerify.ramBlocks(image, offset):
+        ram[start:start + len(data)] = data
+        known[start:start + len(data)] = b"\x01" * len(data)
+    return ram, known
+
+
+def findFills(ram, known, kind, minFill=MINFILL):
+    fills = []
+    address = 0
+    while address < RAMSIZE:
+        if not known[address]:
+            address += 1
+            continue
+        end = address + 1
+        while end < RAMSIZE and known[end] and ram[end] == ram[address]:
+            end += 1
+        if end - address >= minFill:
+            fills.append((address, end - 1, ram[address]))
+            kind[address:end] = bytes([FILLED]) * (end - address)
+        address = end
+    return fills
+
+
+def findCopies(ram, known, kind, minCopy=MINCOPY):
+    """
+    Blocks of at least minCopy bytes that are also found, complete, at a
+    lower address. Sources end before their target, so they never overlap.
+    """
+    copies = []
+    # known bytes before each address, to test a window in one step
+    knownBefore = [0] * (RAMSIZE + 1)
+    for address in range(RAMSIZE):
+        knownBefore[address + 1] = knownBefore[address] + known[address]
+
+    def complete(address):
+        return address + minCopy <= RAMSIZE and \
+            knownBefore[address + minCopy] - knownBefore[address] == minCopy
+
+    index = {}
+    indexed = 0                         # windows before this address are in index
+    address = 0
+    while address + minCopy <= RAMSIZE:
+        while indexed + minCopy <= address:
+            if complete(indexed):
+                index.setdefault(bytes(ram[indexed:indexed + minCopy]), indexed)
+            indexed += 1
+        if not complete(address) or FILLED in kind[address:address + minCopy]:
+            address += 1
+            continue
+        source = index.get(bytes(ram[address:address + minCopy]))
+        if source is None:
+            address += 1
+            continue
+        length = minCopy
+        while address + length < RAMSIZE and known[address + length] and \
+                kind[address + length] == RECORD and source + length < address and \
+                known[source + length] and ram[source + length] == ram[address + length]:
+            length += 1
+        if knownBefore[source + length] - knownBefore[source] != length:
+            # the RAM outside the image holds power-up noise, never copy from it
+            address += 1
+            continue
+        copies.append((source, source + length - 1, address))
+        kind[address:address + length] = bytes([COPIED]) * length
+        address += length
+    return copies
+
+
+def planUpload(image, offset=0, repack=False, minFill=MINFILL, minCopy=MINCOPY):
+    """
+    Plan the upload of image (record addresses, minus offset in the RAM)
+    with fills, copies and records. Returns an UploadPlan.
+    """
+    plan = UploadPlan()
+    plan.offset = offset
+    plan.plainWireBytes = recordWireBytes(romEmuImage.uploadRecords(image, repack))
+    ram, known = ramMap(image, offset)
+    kind = bytearray(RAMSIZE)
+    plan.fills = findFills(ram, known, kind, minFill)
+    plan.copies = findCopies(ram, known, kind, minCopy)
+    rest = romEmuImage.RomImage()
+    rest.sourceFormat = image.sourceFormat
+    address = 0
+    while address < RAMSIZE:
+        if not known[address] or kind[address] != RECORD:
+            address += 1
+            continue
+        end = address + 1
+        while end < RAMSIZE and known[end] and kind[end] == RECORD:
+            end += 1
+        # back to record addresses, split where they wrap at FFFFh
+        recordAddress = (address + offset) & 0xFFFF
+        size = min(end - address, 0x10000 - recordAddress)
+        rest.setBytes(recordAddress, ram[address:address + size])
+        if size < end - address:
+            rest.setBytes(0, ram[address + size:end])
+        address = end
+    plan.records = romEmuImage.uploadRecords(rest, repack)
+    return plan
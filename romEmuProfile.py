@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#
+# Responsiveness profile of the ROM Emulator terminal.
+#
+# With 'Profile' checked in the terminal, a GuiProfile collects timings:
+#
+# - screen: per received chunk, from the read of the scheduler to the
+#   end of the AppendText that shows it,
+# - loop: how much later than its interval the output timer fired, the
+#   lag of the event loop,
+# - decode, translate, append: the receive conversion in the reader
+#   thread, the control character translation and AppendText,
+# - the event handlers, by name.
+#
+# The status bar shows the main figures; the profile can be saved as JSON
+# (with the samples) or CSV (one row per series). A cProfile run of the
+# GUI thread can be taken for a chosen number of seconds on top of that.
+
+import cProfile
+import csv
+import collections
+import io
+import json
+import pstats
+import threading
+import time
+
+KEEP = 10000            # samples kept per series
+FIELDS = ['series', 'count', 'mean', 'median', 'p90', 'p99', 'max', 'total']
+STATUSSERIES = ['screen', 'loop']
+TOPFUNCTIONS = 15       # lines of the cProfile report shown
+
+
+class Series:
+    """Durations in seconds of one kind, with the time they were taken."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = collections.deque(maxlen=KEEP)     # (seconds since the start, duration)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, when, seconds):
+        self.samples.append((when, seconds))
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        durations = sorted(seconds for when, seconds in self.samples)
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    def asDict(self):
+        return {'series': self.name, 'count': self.count,
+                'mean': round(self.total / self.count, 6) if self.count else 0.0,
+                'median': round(self.percentile(0.5), 6), 'p90': round(self.percentile(0.9), 6),
+                'p99': round(self.percentile(0.99), 6), 'max': round(self.max, 6),
+                'total': round(self.total, 6)}
+
+
+class GuiProfile:
+    """Timings of the terminal; add() may be called from any thread."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.end = None
+        self.series = {}
+        self.lock = threading.Lock()
+        self.cprofile = None
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def add(self, name, seconds):
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                series = self.series[name] = Series(name)
+            series.add(self.now(), seconds)
+
+    def timed(self, name, function, *args):
+        """function(*args), its duration added to series name."""
+        start = time.monotonic()
+        try:
+            return function(*args)
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def finish(self):
+        self.end = self.now()
+
+    # reports
+
+    def table(self):
+        with self.lock:
+            return [series.asDict() for series in sorted(self.series.values(), key=lambda s: -s.total)]
+
+    def slowest(self):
+        """The handler with the most time, as (name, Series), or None."""
+        with self.lock:
+            handlers = [series for name, series in self.series.items() if name.startswith("On")]
+            if not handlers:
+                return None
+            return max(handlers, key=lambda s: s.total)
+
+    def status(self):
+        """One line for the status bar."""
+        parts = []
+        for name in STATUSSERIES:
+            series = self.series.get(name)
+            if series is not None:
+                parts.append("{} {:.1f}/{:.1f} ms".format(name, series.percentile(0.5) * 1000,
+                                                           series.max * 1000))
+        handler = self.slowest()
+        if handler is not None:
+            parts.append("{} {:.0f} ms total".format(handler.name, handler.total * 1000))
+        return "profile: " + (", ".join(parts) if parts else "no samples yet")
+
+    def summary(self):
+        end = self.end if self.end is not None else self.now()
+        lines = ["Profile of {:.1f} s (median/90%/99%/max in ms, total in s):".format(end)]
+        for row in self.table():
+            lines.append("  {:<18} {:>7} x {:>7.2f} {:>7.2f} {:>7.2f} {:>8.2f} {:>8.3f}".format(
+                row['series'], row['count'], row['median'] * 1000, row['p90'] * 1000,
+                row['p99'] * 1000, row['max'] * 1000, row['total']))
+        return lines
+
+    def writeJson(self, path):
+        with self.lock:
+            samples = {name: list(series.samples) for name, series in self.series.items()}
+        with open(path, 'w') as f:
+            json.dump({"elapsed": self.end if self.end is not None else self.now(),
+                       "series": self.table(), "samples": samples}, f, indent=1)
+
+    def writeCsv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for row in self.table():
+                writer.writerow(row)
+
+    def save(self, path):
+        """Write the profile as CSV for a .csv path, as JSON otherwise."""
+        if path.lower().endswith(".csv"):
+            self.writeCsv(path)
+        else:
+            self.writeJson(path)
+
+    # cProfile of the calling thread
+
+    def startCProfile(self):
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def stopCProfile(self, path=None):
+        """Stop the cProfile run, save it to path (pstats format); returns the top functions."""
+        if self.cprofile is None:
+            return []
+        self.cprofile.disable()
+        if path:
+            self.cprofile.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(self.cprofile, stream=text).sort_stats('cumulative').print_stats(TOPFUNCTIONS)
+        self.cprofile = None
+        return [line for line in text.getvalue().splitlines() if line.strip()]
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+#
+# Replay of a captured ROM Emulator session.
+#
+# The host side of a capture (romEmuFeed.py --capture, or 'Capture
+# Session...' in the terminal) is written again at its original times,
+# or faster with --speed, to the simulator of romEmuSim.py on a
+# pseudo-terminal, or to a real emulator on a port. What comes back is
+# compared with the captured replies, line by line, and the timing is
+# reported: how late the writes were, how long the replay took and the
+# bytes/s, next to the figures of the capture. A timing bug seen on
+# another bench can so be run again here, and a capture of a real
+# session can serve as a regression benchmark: the exit status is 1
+# when the replies differ, --output appends the figures to a JSON lines
+# file.
+#
+#   Usage: python3 romEmuReplay.py <captureFile> [<ttyPort>] [--speed 1] [--baud 9600] [--output replay.jsonl]
+
+import argparse
+import difflib
+import json
+import sys
+import threading
+import time
+
+import romEmuCapture
+import romEmuConnect
+import romEmuSim
+
+QUIETTIME = 1.0         # seconds without replies that end the replay
+
+
+class ReplayResult:
+    """Timing and replies of one replay."""
+
+    def __init__(self, capture, speed):
+        self.capture = capture
+        self.speed = speed
+        self.sentBytes = 0
+        self.receivedBytes = 0
+        self.elapsed = 0.0              # first write to the last reply or write
+        self.lastWrite = 0.0
+        self.maxLate = 0.0              # largest delay of a write after its time
+        self.replyLines = 0
+        self.differentLines = 0
+        self.firstDifference = None     # (line, captured, replayed)
+
+    def ok(self):
+        return self.differentLines == 0
+
+    def bytesPerSecond(self):
+        return self.sentBytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        lines = [self.capture.summary(),
+                 "Replayed {} bytes at {} in {:.2f} s ({:.0f} bytes/s), writes up to {:.1f} ms late".format(
+                     self.sentBytes, "{:g}x".format(self.speed) if self.speed else "full speed",
+                     self.elapsed, self.bytesPerSecond(), self.maxLate * 1000),
+                 "{} reply lines, {} differ from the capture".format(self.replyLines, self.differentLines)]
+        if self.firstDifference is not None:
+            lines.append("First difference at line {}: captured {!r}, replayed {!r}".format(*self.firstDifference))
+        return lines
+
+    def record(self):
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "captured": self.capture.started,
+                "baud": self.capture.baudrate, "speed": self.speed, "sentBytes": self.sentBytes,
+                "elapsed": round(self.elapsed, 4), "bytesPerSecond": round(self.bytesPerSecond(), 1),
+                "maxLate": round(self.maxLate, 4), "replyLines": self.replyLines,
+                "differentLines": self.differentLines}
+
+
+def replyLines(data):
+    """The non-empty lines of received bytes."""
+    text = data.decode('ascii', 'replace').replace('\r', '')
+    return [line for line in text.split('\n') if line.strip()]
+
+
+def compareReplies(result, captured, replayed):
+    capturedLines, replayedLines = replyLines(captured), replyLines(replayed)
+    result.replyLines = len(capturedLines)
+    matcher = difflib.SequenceMatcher(None, capturedLines, replayedLines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        result.differentLines += max(i2 - i1, j2 - j1)
+        if result.firstDifference is None:
+            result.firstDifference = (i1 + 1, capturedLines[i1] if i1 < i2 else None,
+                                      replayedLines[j1] if j1 < j2 else None)
+
+
+def replay(capture, ser, speed=1.0):
+    """
+    Write the TX chunks of capture to the open port ser, at their times
+    divided by speed (0: as fast as the port takes them), and read the
+    replies until the line is quiet. Returns a ReplayResult.
+    """
+    result = ReplayResult(capture, speed)
+    sent = [(seconds, data) for seconds, direction, data in capture.chunks if direction == romEmuCapture.TX]
+    received = bytearray()
+    lastReply = [0.0]
+    done = threading.Event()
+    timeout = ser.timeout
+    ser.timeout = 0.05
+
+    def reader():
+        while not done.is_set():
+            data = ser.read(ser.in_waiting or 1)
+            if data:
+                received.extend(data)
+                lastReply[0] = time.monotonic()
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    first = sent[0][0] if sent else 0.0
+    start = time.monotonic()
+    try:
+        for seconds, data in sent:
+            if speed:
+                due = start + (seconds - first) / speed
+                now = time.monotonic()
+                if due > now:
+                    time.sleep(due - now)
+                else:
+                    result.maxLate = max(result.maxLate, now - due)
+            ser.write(data)
+            result.sentBytes += len(data)
+        result.lastWrite = time.monotonic() - start
+        while time.monotonic() - max(lastReply[0], start + result.lastWrite) < QUIETTIME:
+            time.sleep(0.05)
+    finally:
+        done.set()
+        thread.join()
+        ser.timeout = timeout
+    result.elapsed = max(lastReply[0] - start, result.lastWrite)
+    result.receivedBytes = len(received)
+    compareReplies(result, capture.stream(romEmuCapture.RX), bytes(received))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured ROM Emulator session",
+                                     usage="python3 romEmuReplay.py <captureFile> [<ttyPort>] [options]")
+    parser.add_argument("captureFile")
+    parser.add_argument("port", nargs='?', default=None,
+                        help="emulator to replay to (default: the simulator on a pseudo-terminal)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="pace relative to the capture, 0 for as fast as possible (default %(default)s)")
+    parser.add_argument("--baud", type=int, default=None,
+                        help="line speed of the simulator, 0 for no limit (default: that of the capture)")
+    parser.add_argument("--fill", type=lambda s: int(s, 16), default=0xFF,
+                        help="initial RAM value of the simulator in hex (default FF)")
+    parser.add_argument("--output", help="append the figures to this JSON lines file")
+    args = parser.parse_args()
+
+    try:
+        capture = romEmuCapture.readCapture(args.captureFile)
+    except (OSError, romEmuCapture.CaptureError) as e:
+        print(args.captureFile + ": " + str(e))
+        return 1
+    runner = None
+    port = args.port
+    if port is None:
+        baud = args.baud if args.baud is not None else capture.baudrate or romEmuSim.DEFAULTBAUD
+        runner, port = romEmuSim.startSimulator(baud=baud, fill=args.fill)
+    try:
+        ser, connection = romEmuConnect.connect(port, baudrate=capture.baudrate or 9600)
+    except romEmuConnect.ConnectError as e:
+        print(str(e))
+        return 1
+    try:
+        result = replay(capture, ser, speed=max(0.0, args.speed))
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        ser.close()
+        if runner is not None:
+            runner.close()
+    print("\n".join(result.summary()))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result.record()) + "\n")
+    return 0 if result.ok() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
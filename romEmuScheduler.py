@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+#
+# Serial port scheduler for the ROM Emulator terminal.
+#
+# One PortScheduler owns the open port: a writer thread sends what is
+# queued and a reader thread hands on what is received. Nothing else
+# reads or writes the port. There are two queues:
+#
+# - interactive: typed keys, menu commands and the modem lines; these go
+#   first,
+# - bulk: the writes of a Session, a stand-in for the serial port that
+#   romEmuUpload.py, romEmuScript.py and romEmuDump.py use as they use a
+#   serial.Serial. Every write is sent whole, in the gaps between the
+#   interactive writes, so a typed key never ends up inside a record.
+#
+# While a session runs, the received bytes go to the session, and typed
+# text is held until a line feed: a part of a line would become the start
+# of the next record in the firmware command buffer. A session that
+# cannot take a reply it did not ask for (binary frames, scripts, memory
+# reads) holds the typed lines until it is closed; record uploads match
+# the replies by address and let them through.
+#
+# The depth of the queues and the time the writes waited are counted,
+# for the status bar of the terminal. With a capture set (a
+# romEmuCapture.CaptureWriter), every write and read is logged there.
+
+import collections
+import threading
+import time
+
+import serial
+
+INTERACTIVE = 0
+BULK        = 1
+QUEUENAMES  = ("interactive", "bulk")
+
+
+class QueueStats:
+    """Depth of one queue and the waits of its writes."""
+
+    def __init__(self):
+        self.depth = 0
+        self.writes = 0
+        self.bytes = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def written(self, size, wait):
+        self.writes += 1
+        self.bytes += size
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+
+    def averageWait(self):
+        return self.totalWait / self.writes if self.writes else 0.0
+
+    def summary(self, name):
+        return "{} {} queued, {} writes, wait {:.1f}/{:.1f} ms".format(
+            name, self.depth, self.writes, self.averageWait() * 1000, self.maxWait * 1000)
+
+
+class Write:
+    """A queued write: bytes, or a function(ser) that sets the modem lines."""
+
+    def __init__(self, data, queue, queued=None):
+        self.data = data
+        self.queue = queue
+        self.queued = queued or time.monotonic()
+        self.done = threading.Event()
+        self.error = None
+
+
+class Session:
+    """
+    The serial port as seen by a bulk transfer. Writes are queued as bulk
+    data and return when they are written; reads take the bytes the
+    reader thread received, with the timeout of the session. close()
+    gives the port back to the terminal.
+    """
+
+    def __init__(self, scheduler, interleave):
+        self.scheduler = scheduler
+        self.interleave = interleave    # typed lines may go out during the session
+        self.port = scheduler.ser.port
+        self.baudrate = scheduler.ser.baudrate
+        self.timeout = scheduler.ser.timeout
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, deadline):
+        """Wait for more data; False at the deadline. Raises SerialException when the port failed."""
+        if self.scheduler.error is not None:
+            raise serial.SerialException(self.scheduler.error)
+        if deadline is None:
+            self.condition.wait()
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        self.condition.wait(remaining)
+        return True
+
+    def deadline(self):
+        return None if self.timeout is None else time.monotonic() + self.timeout
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            return len(self.buffer)
+
+    def write(self, data):
+        self.scheduler.write(bytes(data), BULK)
+        return len(data)
+
+    def read(self, size=1):
+        deadline = self.deadline()
+        with self.condition:
+            while len(self.buffer) < size and self.wait(deadline):
+                pass
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def readline(self):
+        deadline = self.deadline()
+        with self.condition:
+            while b"\n" not in self.buffer and self.wait(deadline):
+                pass
+            end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+            data = bytes(self.buffer[:end])
+            del self.buffer[:end]
+        return data
+
+    def close(self):
+        self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PortScheduler:
+    """
+    Owner of the open serial port ser. receive(data) is called in the
+    reader thread with the bytes that no session takes.
+    """
+
+    def __init__(self, ser, receive):
+        self.ser = ser
+        self.receive = receive
+        self.queues = (collections.deque(), collections.deque())
+        self.stats = (QueueStats(), QueueStats())
+        self.lock = threading.Condition()
+        self.session = None
+        self.held = bytearray()         # typed text waiting for a line feed or the end of the session
+        self.heldSince = None
+        self.threads = []
+        self.alive = False
+        self.error = None
+        self.capture = None
+
+    def start(self):
+        self.alive = True
+        self.error = None
+        self.threads = [threading.Thread(target=self.writer), threading.Thread(target=self.reader)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop both threads; the port stays open."""
+        with self.lock:
+            self.alive = False
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def put(self, item):
+        with self.lock:
+            self.queues[item.queue].append(item)
+            self.stats[item.queue].depth = len(self.queues[item.queue])
+            self.lock.notify_all()
+
+    def write(self, data, queue=BULK):
+        """Queue data and wait until it is written; raises SerialException when the port fails."""
+        item = Write(data, queue)
+        self.put(item)
+        while not item.done.wait(0.5):
+            if self.error is not None or not self.alive:
+                raise serial.SerialException(self.error or "port closed")
+        if item.error is not None:
+            raise serial.SerialException(item.error)
+
+    def send(self, data):
+        """Queue typed or menu text, does not wait. During a session only whole lines go out."""
+        with self.lock:
+            if self.session is None:
+                self.put(Write(data, INTERACTIVE))
+                return
+            if not self.held:
+                self.heldSince = time.monotonic()
+            self.held += data
+            if self.session.interleave:
+                # a CR ends a command only with echo on, an LF always
+                self.sendHeld(self.held.rfind(b"\n") + 1)
+
+    def sendHeld(self, size):
+        if size > 0:
+            self.put(Write(bytes(self.held[:size]), INTERACTIVE, self.heldSince))
+            del self.held[:size]
+            self.heldSince = time.monotonic() if self.held else None
+
+    def control(self, function):
+        """Call function(ser) in the writer thread, e.g. to set RTS or DTR."""
+        self.put(Write(function, INTERACTIVE))
+
+    def open(self, interleave=False):
+        """Start a bulk transfer; returns its Session. Only one session at a time."""
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError("a transfer is running")
+            self.session = Session(self, interleave)
+            return self.session
+
+    def release(self, session):
+        with self.lock:
+            if self.session is session:
+                self.session = None
+                self.sendHeld(len(self.held))
+
+    def writer(self):
+        while True:
+            with self.lock:
+                while self.alive and not any(self.queues):
+                    self.lock.wait()
+                if not self.alive:
+                    break
+                queue = INTERACTIVE if self.queues[INTERACTIVE] else BULK
+                item = self.queues[queue].popleft()
+                self.stats[queue].depth = len(self.queues[queue])
+            try:
+                if callable(item.data):
+                    item.data(self.ser)
+                else:
+                    self.ser.write(item.data)
+                    capture = self.capture
+                    if capture is not None:
+                        capture.sent(item.data)
+            except (serial.SerialException, OSError) as e:
+                item.error = str(e)
+                self.fail(item.error)
+            if not callable(item.data):
+                with self.lock:
+                    self.stats[queue].written(len(item.data), time.monotonic() - item.queued)
+            item.done.set()
+
+    def reader(self):
+        while self.alive:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                self.fail(str(e))
+                break
+            if not data:
+                continue
+            capture = self.capture
+            if capture is not None:
+                capture.received(data)
+            session = self.session
+            if session is not None:
+                session.feed(data)
+            else:
+                self.receive(data)
+
+    def fail(self, error):
+        self.error = error
+        session = self.session
+        if session is not None:
+            session.wake()
+
+    def summary(self):
+        with self.lock:
+            return "; ".join(stats.summary(name) for name, stats in zip(QUEUENAMES, self.stats))
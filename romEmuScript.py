@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+#
+# Command scripts for the ROM Emulator.
+#
+# A script is a text file with one firmware command per line, e.g. a
+# list of M patches, N fills, C copies and K checks for a test setup.
+# Everything after a '#' is a comment. The commands are checked before
+# anything is sent, then sent pipelined as romEmuUpload.py sends records:
+# a few commands in flight, within the firmware buffers. Every reply is
+# parsed and checked, and the run stops at the first error:
+#
+#   Maaaa-dd              modify, the read back value must be dd
+#   Nssss-eeee:vv         fill
+#   Cssss-eeee-tttt       copy, source and target may not overlap
+#   Kssss-eeee[=hhhh]     checksum, with =hhhh the sum must be hhhh
+#   Fhhhh, F              address offset
+#   R0, R1                reset relay
+#   :... S1...            hex-intel and S1 data records
+#
+# N, C and K keep the firmware busy, so they are sent when all earlier
+# commands are answered, and the next command waits for their reply. An
+# F follows every N: the fill starts after its reply line.
+#
+#   Usage: python3 romEmuScript.py <scriptFile> [<ttyPort>] [--window 8] [--no-reset]
+
+import argparse
+import collections
+import re
+import sys
+import time
+
+import romEmuClient
+import romEmuConnect
+import romEmuImage
+import romEmuUpload
+
+LF = "\n"
+DEFAULTWINDOW = 8       # M replies are longer than the commands: the firmware is not the limit
+REPLYTIMEOUT  = 2.0
+
+HEX4 = "([0-9A-F]{4})"
+HEX2 = "([0-9A-F]{2})"
+MODIFY   = re.compile("^M" + HEX4 + "-" + HEX2 + "$")
+FILL     = re.compile("^N" + HEX4 + "-" + HEX4 + ":" + HEX2 + "$")
+COPY     = re.compile("^C" + HEX4 + "-" + HEX4 + "-" + HEX4 + "$")
+CHECKSUM = re.compile("^K" + HEX4 + "-" + HEX4 + "(?:=" + HEX4 + ")?$")
+OFFSET   = re.compile("^F(?:" + HEX4 + ")?$")
+RELAY    = re.compile("^R[01]?$")
+
+
+class ScriptError(ValueError):
+    """A line that is not a command scripts accept."""
+
+
+class ScriptCommand:
+    """A command of a script, with the parser and the check of its reply."""
+
+    def __init__(self, number, command, parser, check=None, exclusive=False, busy=0.0, sync="", send=None):
+        self.number = number            # line in the script
+        self.command = command
+        self.parser = parser            # function returning a new reply parser
+        self.check = check              # function(result): an error message or None
+        self.exclusive = exclusive
+        self.timeout = REPLYTIMEOUT + busy
+        self.wire = (send or command) + LF + (sync + LF if sync else "")
+
+
+# reply parsers, in the style of romEmuClient.py
+
+def offsetReply():
+    line = yield
+    if line.startswith("ERROR"):
+        raise romEmuClient.RomEmuError(line)
+    return line
+
+
+def parseCommand(text, number=0):
+    """The ScriptCommand for a line, None for an empty line; raises ScriptError."""
+    text = text.split("#", 1)[0].strip()
+    if not text:
+        return None
+    if text[0] in ":Ss":
+        try:
+            record = romEmuImage.parseRecord(text)
+        except ValueError as e:
+            raise ScriptError("line {}: {}".format(number, e))
+        if record is None:
+            if text[7:9] == "01" or text[:2].upper() in ("S0", "S5", "S9"):
+                return None             # header and end records
+            raise ScriptError("line {}: only hex-intel and S1 data records are sent".format(number))
+        return ScriptCommand(number, text, romEmuClient.recordReply,
+                             lambda reply: None if reply.ok else "sumcheck incorrect")
+    command = text.upper()
+    match = MODIFY.match(command)
+    if match:
+        address, value = int(match.group(1), 16), int(match.group(2), 16)
+        return ScriptCommand(number, command, romEmuClient.modifyReply,
+                             lambda reply: None if (reply.address, reply.new) == (address, value) else
+                             "%04X reads back %02X" % (reply.address, reply.new))
+    match = FILL.match(command)
+    if match:
+        start, end = int(match.group(1), 16), int(match.group(2), 16)
+        if start > end:
+            raise ScriptError("line {}: negative range in {}".format(number, command))
+        return ScriptCommand(number, command, romEmuClient.fillReply, exclusive=True,
+                             busy=(end - start + 1) * romEmuUpload.FILLTIME, sync="F")
+    match = COPY.match(command)
+    if match:
+        start, end, target = [int(group, 16) for group in match.groups()]
+        if start > end:
+            raise ScriptError("line {}: negative range in {}".format(number, command))
+        if target <= end and start <= target + end - start:
+            # copyData() picks the direction by start and target only
+            raise ScriptError("line {}: source and target of {} overlap".format(number, command))
+        if start == 0 and target <= start:
+            raise ScriptError("line {}: the firmware does not return from a copy down from 0000".format(number))
+        return ScriptCommand(number, command, romEmuClient.copyReply, exclusive=True,
+                             busy=(end - start + 1) * romEmuUpload.COPYTIME)
+    match = CHECKSUM.match(command)
+    if match:
+        start, end = int(match.group(1), 16), int(match.group(2), 16)
+        expected = int(match.group(3), 16) if match.group(3) else None
+        return ScriptCommand(number, command, romEmuClient.checksumReply,
+                             lambda reply: None if expected in (None, reply.sum) else
+                             "sum %04X, expected %04X" % (reply.sum, expected),
+                             exclusive=True, busy=((end - start) & 0xFFFF) * romEmuUpload.CHECKSUMTIME,
+                             send=command.split("=")[0])
+    if OFFSET.match(command):
+        return ScriptCommand(number, command, offsetReply)
+    if RELAY.match(command):
+        return ScriptCommand(number, command, romEmuClient.oneLine)
+    raise ScriptError("line {}: {} is not a script command".format(number, text))
+
+
+def readScript(lines):
+    """The ScriptCommands of the lines of a script; raises ScriptError."""
+    commands = []
+    for number, line in enumerate(lines, 1):
+        command = parseCommand(line, number)
+        if command is not None:
+            commands.append(command)
+    return commands
+
+
+def loadScript(path):
+    with open(path, 'r') as f:
+        return readScript(f)
+
+
+class ScriptResult:
+    """Counters and errors of one script run."""
+
+    def __init__(self):
+        self.sent      = 0
+        self.completed = 0
+        self.errors    = []             # (line, command, message)
+        self.elapsed   = 0.0
+        self.cancelled = False
+
+    def ok(self):
+        return not self.errors and not self.cancelled
+
+    def summary(self):
+        text = "{}{} commands, {} completed in {:.2f} s".format(
+            "Cancelled after " if self.cancelled else "", self.sent, self.completed, self.elapsed)
+        if self.errors:
+            number, command, message = self.errors[0]
+            text += ", stopped at line {}: {}: {}".format(number, command, message)
+        return text
+
+
+def runScript(ser, commands, window=DEFAULTWINDOW, out=print, progress=None, cancel=None):
+    """
+    Send the ScriptCommands to the emulator on ser, with at most window
+    commands and INFLIGHTBYTES bytes unanswered, and check the replies.
+    No command is sent after the first error or a cancel; the replies to
+    those in flight are still read. progress and cancel are as for
+    romEmuUpload.windowedUpload(). Returns a ScriptResult.
+    """
+    result = ScriptResult()
+    inFlight = collections.deque()      # [command, parser, bytes on the wire]
+    inFlightBytes = 0
+    index = 0
+    timeout = ser.timeout
+    start = time.monotonic()
+
+    # the replies are parsed with echo off
+    connection = romEmuConnect.Connection(ser.port)
+    if not romEmuConnect.probe(ser, connection):
+        result.errors.append((0, "F", "no reply from the emulator"))
+        return result
+    if connection.echo:
+        ser.write(("O" + LF).encode())
+    romEmuConnect.drain(ser)
+
+    def fail(command, message):
+        result.errors.append((command.number, command.command, message))
+        out("Line {}: {}: {}".format(command.number, command.command, message))
+
+    try:
+        while (index < len(commands) and not result.errors) or inFlight:
+            if cancel is not None and cancel.is_set() and index < len(commands) and not result.cancelled:
+                result.cancelled = True
+            sending = index < len(commands) and not result.errors and not result.cancelled
+            if sending:
+                command = commands[index]
+                size = len(command.wire)
+                if not inFlight or (not command.exclusive and not inFlight[-1][0].exclusive and
+                                    len(inFlight) < window and inFlightBytes + size <= romEmuUpload.INFLIGHTBYTES):
+                    out(command.command)
+                    parser = command.parser()
+                    next(parser)
+                    ser.write(command.wire.encode())
+                    inFlight.append([command, parser, size])
+                    inFlightBytes += size
+                    result.sent += 1
+                    index += 1
+                    if ser.in_waiting == 0:
+                        continue        # keep filling the window
+            if not inFlight:
+                continue
+            command, parser, size = inFlight[0]
+            ser.timeout = command.timeout
+            raw = ser.readline()
+            if not raw:
+                fail(command, "no reply")
+                break                   # out of step, the rest cannot be matched
+            line = raw.decode('ascii', 'replace').strip()
+            out(line)
+            try:
+                parser.send(line)
+                continue
+            except StopIteration as done:
+                message = command.check(done.value) if command.check is not None else None
+            except romEmuClient.RomEmuError as e:
+                message = str(e)
+            inFlight.popleft()
+            inFlightBytes -= size
+            if message is None:
+                result.completed += 1
+            else:
+                fail(command, message)
+            if progress is not None:
+                result.elapsed = time.monotonic() - start
+                progress(result, len(commands))
+    finally:
+        ser.timeout = timeout
+        if connection.echo:
+            ser.write(("O" + LF).encode())
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a command script on the ROM Emulator",
+                                     usage="python3 romEmuScript.py <scriptFile> [<ttyPort>] [options]")
+    parser.add_argument("scriptFile")
+    parser.add_argument("port", nargs='?', default='/dev/ttyACM0')
+    parser.add_argument("--window", type=int, default=DEFAULTWINDOW,
+                        help="commands in flight (default %(default)s)")
+    parser.add_argument("--no-reset", action="store_true", help="do not reset a running board")
+    parser.add_argument("--quiet", action="store_true", help="do not show the commands and replies")
+    args = parser.parse_args()
+
+    try:
+        commands = loadScript(args.scriptFile)
+    except (OSError, ScriptError) as e:
+        print(args.scriptFile + ": " + str(e))
+        return 1
+    try:
+        ser, connection = romEmuConnect.connect(args.port, reset=not args.no_reset)
+    except romEmuConnect.ConnectError as e:
+        print(str(e))
+        return 1
+    print(connection.summary())
+    try:
+        result = runScript(ser, commands, window=max(1, args.window),
+                           out=(lambda text: None) if args.quiet else print)
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        ser.close()
+    print(result.summary())
+    return 0 if result.ok() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
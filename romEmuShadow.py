@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+#
+# Shadow of the ROM Emulator RAM, kept on the host.
+#
+# After every upload the bytes written are stored per emulator, together
+# with the K checksum the firmware reports for the range holding them.
+# On the next upload the checksum is asked again; when it still matches,
+# only the records with bytes that differ from the shadow are sent. A
+# power cycle or a change by hand alters the checksum, which results in a
+# full upload.
+
+import json
+import os
+
+import serial.tools.list_ports
+
+import romEmuImage
+import romEmuUpload
+import romEmuVerify
+
+SHADOWDIR = os.path.join(os.path.expanduser("~"), ".romemu", "shadow")
+RAMSIZE   = 0x8000
+
+
+def shadowKey(port):
+    """Key for the shadow of the emulator on port: USB serial number, else port name."""
+    device = os.path.realpath(port)
+    for info in serial.tools.list_ports.comports():
+        if info.device in (port, device) and info.serial_number:
+            return "sn-" + info.serial_number
+    return "port-" + port.strip("/").replace("/", "_")
+
+
+class Shadow:
+    """RAM contents as last written by the host, with the checksum seen after it."""
+
+    def __init__(self, key, shadowDir=SHADOWDIR):
+        self.key = key
+        self.shadowDir = shadowDir
+        self.ram = bytearray(RAMSIZE)
+        self.known = bytearray(RAMSIZE)     # 1 where ram holds a written byte
+        self.checksum = None                # (start, end, sum, andOr) as reported by K
+
+    def path(self, extension):
+        return os.path.join(self.shadowDir, self.key + extension)
+
+    def load(self):
+        try:
+            with open(self.path(".bin"), 'rb') as f:
+                data = f.read()
+            with open(self.path(".json"), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if len(data) == 2 * RAMSIZE and len(meta.get("checksum") or ()) == 4:
+            self.ram[:] = data[:RAMSIZE]
+            self.known[:] = data[RAMSIZE:]
+            self.checksum = tuple(meta["checksum"])
+        return self
+
+    def save(self):
+        os.makedirs(self.shadowDir, exist_ok=True)
+        with open(self.path(".bin"), 'wb') as f:
+            f.write(self.ram + self.known)
+        with open(self.path(".json"), 'w') as f:
+            json.dump({"key": self.key, "checksum": self.checksum}, f)
+
+    def invalidate(self):
+        self.known[:] = bytes(RAMSIZE)
+        self.checksum = None
+
+    def knownRange(self):
+        """(start, end) of the written bytes, None if there are none."""
+        start = self.known.find(1)
+        if start < 0:
+            return None
+        return start, self.known.rfind(1)
+
+    def check(self, ser):
+        """True if the emulator still reports the checksum seen after the last upload."""
+        if self.checksum is None:
+            return False
+        start, end = self.checksum[:2]
+        return romEmuUpload.queryChecksum(ser, start, end) == tuple(self.checksum[2:])
+
+    def fingerprint(self, ser):
+        """Ask the checksum of the written range, to be checked on the next upload."""
+        self.checksum = None
+        span = self.knownRange()
+        if span is not None:
+            checksum = romEmuUpload.queryChecksum(ser, span[0], span[1])
+            if checksum is not None:
+                self.checksum = span + checksum
+
+    def differs(self, address, data):
+        for i, value in enumerate(data):
+            a = (address + i) & (RAMSIZE - 1)
+            if not self.known[a] or self.ram[a] != value:
+                return True
+        return False
+
+    def select(self, lines, offset=0):
+        """The records of lines that would change the RAM; other lines are kept."""
+        selected = []
+        for line in lines:
+            try:
+                record = romEmuImage.parseRecord(line)
+            except ValueError:
+                record = None
+            if record is None or self.differs(record[0] - offset, record[1]):
+                selected.append(line)
+        return selected
+
+    def update(self, lines, offset=0):
+        for line in lines:
+            try:
+                record = romEmuImage.parseRecord(line)
+            except ValueError:
+                continue
+            if record is None:
+                continue
+            address, data = record
+            for i, value in enumerate(data):
+                a = (address - offset + i) & (RAMSIZE - 1)
+                self.ram[a] = value
+                self.known[a] = 1
+
+
+def deltaUpload(ser, lines, key, offset=0, full=False, window=romEmuUpload.DEFAULTWINDOW, out=print,
+                progress=None, cancel=None, binary=False, plan=None, trace=None):
+    """
+    Upload lines to the emulator on ser, sending only the records that
+    differ from the shadow when the shadow is still valid. With binary,
+    the data is sent in binary frames if the firmware supports them. A
+    romEmuPlan.UploadPlan of the same data is used for a full upload.
+    trace, a romEmuTrace.UploadTrace, records the timing of the upload.
+    The shadow is updated afterwards. Returns the romEmuUpload.UploadResult.
+    """
+    shadow = Shadow(key).load()
+    lines = [line.strip() for line in lines if line.strip()]
+    if not full and shadow.check(ser):
+        selected = shadow.select(lines, offset)
+        out("Shadow valid, sending {} of {} records".format(len(selected), len(lines)))
+    else:
+        shadow.invalidate()
+        selected = lines
+        out("Shadow not valid, full upload")
+    if plan is not None and selected is lines:
+        out(plan.summary())
+        result = plan.upload(ser, window=window, out=out, progress=progress, cancel=cancel, binary=binary,
+                             trace=trace)
+    else:
+        result = romEmuUpload.sendRecords(ser, selected, window=window, out=out, progress=progress,
+                                          cancel=cancel, binary=binary, trace=trace, offset=offset)
+    if result.garbled and not result.cancelled:
+        romEmuVerify.repair(ser, lines, result, offset, window=window, out=out)
+    if result.errors or result.timeouts or result.cancelled:
+        shadow.invalidate()
+    else:
+        shadow.update(lines, offset)
+        shadow.fingerprint(ser)
+    shadow.save()
+    return result
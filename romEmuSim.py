@@ -0,0 +1,781 @@
+#!/usr/bin/python3
+#
+# ROMemu device simulator.
+#
+# Opens a pseudo-terminal and behaves like an Arduino Mega 2560 with the
+# ROMemu shield running ROMemu.ino v0.12.0, as seen over the serial line.
+# The slave side of the pty can be used by romEmuFeed.py and
+# romEmuTerminal.py like /dev/ttyACM0.
+#
+# The model covers the 32 kByte RAM (A15 is not connected, so addresses
+# mirror every 8000h), the 90 character command buffer with its overflow
+# message, the 64 byte receive and transmit buffers of the Arduino, echo,
+# the F offset and the operational commands. With a baud rate set, bytes
+# are moved at the speed of the real serial line (10 bits per byte) and
+# bytes arriving while the receive buffer is full are lost, as on the
+# board. Opening the port resets the simulated board (DTR auto-reset),
+# which keeps the RAM contents but clears echo, offset and relay. The
+# binary transfer mode (X command) can be switched off with --legacy to
+# simulate the v0.11.4 firmware. --errors simulates a noisy line: a part
+# of the bytes from the host is lost or has a bit flipped.
+#
+#   Usage: python3 romEmuSim.py [--baud 9600] [--link /tmp/ttyROMEMU] [--errors 0.001]
+
+import argparse
+import binascii
+import errno
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+VERSION = "v0.12.0"
+LEGACYVERSION = "v0.11.4"      # firmware without binary transfer mode
+
+SERIALBUFSIZE = 90
+RXBUFSIZE     = 64
+TXBUFSIZE     = 64
+RAMSIZE       = 0x8000
+RECORDSIZE    = 16
+DUMPPAGE      = 0x0100
+DEFAULTBAUD   = 9600
+CHECKSUMTIME  = 75e-6   # K reads each byte three times
+FILLTIME      = 35e-6   # N writes each byte
+COPYTIME      = 150e-6  # C reads and writes each byte
+
+STX = 0x02
+ACK = 0x06
+NAK = 0x15
+MAXFRAMEDATA = 56
+FRAMETIMEOUT = 0.1
+BINARYIDLE   = 5.0
+
+USAGE = [
+    "Operational commands:",
+    " Cssss-eeee-tttt - Copy data in range from ssss-eeee to tttt",
+    " D[ssss[-eeee]]- Dump memory from ssss to eeee",
+    " E             - Generate hex intel end record",
+    " Fhhhh         - AddressOffset; subtracted from hex intel addresses",
+    " Gssss-eeee    - Generate Motorola Exorciser S1 records",
+    " H             - This help text",
+    " :ssaaaatthhhh...hhcc - accepts hex intel record",
+    " ;ssss-eeee    - Generate hex intel data records",
+    " Kssss-eeee    - Generate checksums for address range",
+    " Maaaa-dd      - Modify memory",
+    " O             - Toggle echo",
+    " R[0|1]        - Switch the RESET relay",
+    " S1ccnnnndddd..ddss - accepts Motorola Exorciser S1 record",
+    " X             - Binary transfer mode, until an empty frame",
+    "Test commands:",
+    " A             - test 32 kByte RAM with 00h, 55h. AAh and FFh patterns",
+    " Bpp           - blink pin p (in hex)",
+    " Nssss-eeee:v  - fill a memory range with a value",
+    " Tp            - exercise port p",
+    " U             - view ports C, L, A, CS, OE, WR, ARDUINOONLINE",
+    " Wpp v         - Write pin (in hex) values 0, 1",
+    " ?             - This help text",
+]
+
+
+def hexByte(value):
+    return "%02X" % (value & 0xFF)
+
+
+def hexWord(value):
+    return "%04X" % (value & 0xFFFF)
+
+
+class RomEmuDevice:
+    """
+    Model of the ROMemu firmware. Bytes from the host are put in rx, the
+    firmware output collects in tx. step() runs the firmware as far as it
+    can get: it stalls while more than TXBUFSIZE bytes wait to be sent,
+    like Serial.print() does on the board.
+    """
+
+    def __init__(self, fill=None, seed=None, binary=True):
+        self.binarySupport = binary
+        self.version = VERSION if binary else LEGACYVERSION
+        if fill is None:
+            rng = random.Random(seed)       # SRAM powers up with noise
+            self.ram = bytearray(rng.getrandbits(8) for i in range(RAMSIZE))
+        else:
+            self.ram = bytearray([fill & 0xFF]) * RAMSIZE
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.rxLost = 0
+        self.reset()
+
+    def reset(self):
+        """Arduino reset: the RAM keeps its contents, the sketch state does not."""
+        self.serialBuffer = bytearray(SERIALBUFSIZE)
+        self.setBufPointer = 0
+        self.lastEndAddress = 0
+        self.addressOffset = 0
+        self.echo = False
+        self.relayOn = False
+        self.hung = False
+        self.asChars = bytearray(b' ' * 16)
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.wakeTime = 0.0
+        self.now = 0.0
+        self.binaryMode = False
+        self.lastByteTime = 0.0
+        self.task = self.setup()
+
+    # host side
+
+    def receive(self, data):
+        """Bytes arriving on the Arduino receive pin; excess bytes are lost."""
+        for b in data:
+            if len(self.rx) < RXBUFSIZE:
+                self.rx.append(b)
+            else:
+                self.rxLost += 1
+
+    def transmit(self, count=None):
+        """Take up to count bytes (all if None) from the transmit buffer."""
+        if count is None:
+            count = len(self.tx)
+        data = bytes(self.tx[:count])
+        del self.tx[:count]
+        return data
+
+    def idle(self):
+        return self.task is None and not self.rx
+
+    def step(self, now):
+        self.now = now
+        while not self.hung:
+            if len(self.tx) > TXBUFSIZE or now < self.wakeTime:
+                return
+            if self.task is not None:
+                try:
+                    delay = next(self.task)
+                except StopIteration:
+                    self.task = None
+                    continue
+                if delay:
+                    self.wakeTime = now + delay
+                continue
+            if not self.rx:
+                if self.binaryMode:
+                    self.binaryTimeouts()
+                return
+            inByte = self.rx.pop(0)
+            if self.binaryMode:
+                self.binaryCollector(inByte)
+            else:
+                self.commandCollector(inByte)
+
+    # Serial output
+
+    def print(self, text=""):
+        self.tx += text.encode('latin-1')
+
+    def println(self, text=""):
+        self.print(text + "\r\n")
+
+    # core routines
+
+    def setup(self):
+        yield 0.5
+        self.println("ROMemu " + self.version)
+        yield 1.0
+
+    def commandCollector(self, inByte):
+        if self.echo:
+            self.tx.append(inByte)
+        if inByte == 0x0D and not self.echo:
+            return                          # cr only works with echo on
+        if inByte in (0x0D, 0x2E, 0x0A):    # '\r', '.', '\n'
+            self.task = self.command()
+            return
+        self.serialBuffer[self.setBufPointer] = inByte
+        self.setBufPointer += 1
+        if self.setBufPointer >= SERIALBUFSIZE:
+            self.println("Serial buffer overflow. Cleanup.")
+            self.clearSerialBuffer()
+            self.setBufPointer = 0
+
+    def command(self):
+        handler = self.commandInterpreter()
+        if handler is not None:
+            yield from handler
+        self.clearSerialBuffer()
+        self.setBufPointer = 0
+
+    def commandInterpreter(self):
+        bufByte = self.serialBuffer[0]
+        handler = {
+            'A': self.ramTest,
+            'B': self.hang,
+            'C': self.copyData,
+            'D': self.dumpMemory,
+            'E': self.generateEndHIRecord,
+            'F': self.setOffset,
+            'G': self.generateExorciserIRecord,
+            'H': self.usage,
+            '?': self.usage,
+            'K': self.calcChecksum,
+            'M': self.modifyMem,
+            'N': self.fillMemory,
+            'O': self.echoManagement,
+            'R': self.setRelay,
+            'S': self.motoExorciserS1Interpreter,
+            'T': self.portTest,
+            'U': self.setValue,
+            'V': self.hang,
+            'W': self.writePin,
+            ':': self.hexIntelInterpreter,
+            ';': self.generateHexIntelRecords,
+            'X': self.enterBinaryMode if self.binarySupport else None,
+        }.get(chr(bufByte).upper())
+        if handler is None:
+            self.println(str(bufByte) + " unsupported")
+            return None
+        return handler()
+
+    # argument parsing, including the quirks of getNibble()
+
+    def bufChar(self, index):
+        if index < SERIALBUFSIZE:
+            return self.serialBuffer[index]
+        return 0
+
+    def getNibble(self, myChar):
+        nibble = myChar
+        if nibble > ord('F'):
+            nibble -= ord(' ')
+        nibble -= ord('0')
+        if nibble > 9:
+            nibble -= 7
+        return nibble
+
+    def get8BitValue(self, index):
+        data = self.getNibble(self.bufChar(index)) * 16
+        data += self.getNibble(self.bufChar(index + 1))
+        return data & 0xFF
+
+    def get16BitValue(self, index):
+        address = 0
+        for i in range(4):
+            address = address * 16 + self.getNibble(self.bufChar(index + i))
+        return address & 0xFFFF
+
+    # RAM access
+
+    def readByte(self, address):
+        return self.ram[address & (RAMSIZE - 1)]
+
+    def writeByte(self, address, value):
+        self.ram[address & (RAMSIZE - 1)] = value & 0xFF
+
+    def clearSerialBuffer(self):
+        self.serialBuffer[:] = bytes(SERIALBUFSIZE)
+
+    # commands
+
+    def usage(self):
+        self.println("-- ROM emulator " + self.version + " --")
+        for line in USAGE:
+            if self.binarySupport or not line.startswith(" X "):
+                self.println(line)
+
+    def setOffset(self):
+        if self.setBufPointer == 1:
+            self.println("F" + hexWord(self.addressOffset))
+            return
+        elif self.setBufPointer != 5:
+            self.println("ERROR F arg. size")
+            self.clearSerialBuffer()
+            return
+        self.addressOffset = self.get16BitValue(1)
+        self.println("Address offset: " + hexWord(self.addressOffset))
+
+    def modifyMem(self):
+        address = self.get16BitValue(1)
+        newData = self.get8BitValue(6)
+        oldData = self.readByte(address)
+        self.writeByte(address, newData)
+        checkData = self.readByte(address)
+        self.println("M:" + hexWord(address) + "-" + hexByte(oldData) + " > " + hexByte(checkData))
+
+    def copyData(self):
+        startAddress  = self.get16BitValue(1)
+        endAddress    = self.get16BitValue(6)
+        targetAddress = self.get16BitValue(11)
+        self.println("C:" + hexWord(startAddress) + "-" + hexWord(endAddress) + "-" + hexWord(targetAddress))
+        rangeSize = (endAddress - startAddress) & 0xFFFF
+        te = (targetAddress + rangeSize) & 0xFFFF
+        c = 0
+        if startAddress < targetAddress:
+            self.print("copy up " + hexWord(startAddress) + "-" + hexWord(endAddress) + " > " +
+                       hexWord(targetAddress) + "-" + hexWord(te) + " ")
+            s, t = startAddress, targetAddress
+            while s <= endAddress:
+                self.writeByte(t, self.readByte(s))
+                s += 1
+                t += 1
+                c += 1
+        else:
+            self.println("copy down " + hexWord(startAddress) + "-" + hexWord(endAddress) + " > " +
+                         hexWord(targetAddress) + "-" + hexWord(te))
+            e = endAddress
+            while e >= startAddress and e >= 0:
+                self.writeByte(te, self.readByte(e))
+                e -= 1
+                te = (te - 1) & 0xFFFF
+                c += 1
+            if startAddress == 0:
+                # e is unsigned in the firmware: it wraps to FFFF and the
+                # loop never ends, the board needs a reset
+                yield c * COPYTIME
+                self.hung = True
+                return
+        yield c * COPYTIME
+        self.println("%Xh bytes copied" % (c & 0xFFFF))
+
+    def fillMemory(self):
+        startAddress = self.get16BitValue(1)
+        endAddress   = self.get16BitValue(6)
+        value        = self.get8BitValue(11)
+        self.println("N:" + hexWord(startAddress) + "-" + hexWord(endAddress) + "-" + hexByte(value))
+        if startAddress > endAddress:
+            self.println("Error: negative range. Aborting.")
+            return
+        for s in range(startAddress, endAddress + 1):
+            self.writeByte(s, value)
+        yield (endAddress + 1 - startAddress) * FILLTIME
+
+    def setValue(self):
+        startAddress = self.get16BitValue(1)
+        endAddress   = self.get16BitValue(6)
+        value        = self.get8BitValue(11)
+        for i in range(startAddress, endAddress + 1):
+            self.writeByte(i, value)
+        self.println("S:" + hexWord(startAddress) + "-" + hexWord(endAddress) + " with " + hexByte(value))
+
+    def dumpMemory(self):
+        if self.setBufPointer == 1:
+            startAddress = self.lastEndAddress
+            endAddress = (startAddress + DUMPPAGE) & 0xFFFF
+        elif self.setBufPointer == 5:
+            startAddress = self.get16BitValue(1)
+            endAddress = (startAddress + DUMPPAGE) & 0xFFFF
+        elif self.setBufPointer == 10:
+            startAddress = self.get16BitValue(1)
+            endAddress = self.get16BitValue(6)
+        else:
+            self.println("unsupported")
+            return
+        self.lastEndAddress = endAddress
+        self.println(hexWord(startAddress) + "-" + hexWord(endAddress))
+        for i in range(startAddress, endAddress):
+            positionOnLine = i & 0x0F
+            if positionOnLine == 0:
+                self.print(hexWord(i) + ": ")
+            data = self.readByte(i)
+            self.print(hexByte(data))
+            self.asChars[positionOnLine] = data if 0x20 <= data <= 0x7E else 0x2E
+            if (i & 0x03) == 0x03:
+                self.print(" ")
+            if (i & 0x0F) == 0x0F:
+                self.println(" " + self.asChars.decode('latin-1'))
+                yield
+                if self.rx:                 # any input aborts the dump
+                    self.clearSerialBuffer()
+                    self.setBufPointer = 0
+                    break
+        self.println()
+
+    def generateExorciserIRecord(self):
+        startAddress = self.get16BitValue(1)
+        endAddress   = self.get16BitValue(6)
+        self.println(hexWord(startAddress) + "-" + hexWord(endAddress))
+        for i in range(startAddress, endAddress, RECORDSIZE):
+            sumCheckCount = RECORDSIZE + 3
+            line = "S1" + hexByte(RECORDSIZE + 3) + hexWord(i)
+            sumCheckCount += (i >> 8) + (i & 0xFF)
+            for j in range(RECORDSIZE):
+                data = self.readByte(i + j)
+                line += hexByte(data)
+                sumCheckCount += data
+            self.println(line + hexByte(0xFF - (sumCheckCount & 0xFF)))
+            yield
+        self.println("S9030000FC")
+
+    def generateHexIntelRecords(self):
+        startAddress = self.get16BitValue(1)
+        endAddress   = self.get16BitValue(6)
+        self.println(hexWord(startAddress) + "-" + hexWord(endAddress))
+        for i in range(startAddress, endAddress, RECORDSIZE):
+            sumCheckCount = -(RECORDSIZE + (i >> 8) + (i & 0xFF))
+            line = ":" + hexByte(RECORDSIZE) + hexWord(i) + "00"
+            for j in range(RECORDSIZE):
+                data = self.readByte(i + j)
+                line += hexByte(data)
+                sumCheckCount -= data
+            self.println(line + hexByte(sumCheckCount))
+            yield
+
+    def generateEndHIRecord(self):
+        self.println(":00000001FF")
+
+    def hexIntelInterpreter(self):
+        getNibble = self.getNibble
+        bufChar = self.bufChar
+        count = (getNibble(bufChar(1)) * 16 + getNibble(bufChar(2))) & 0xFFFF
+        sumCheck = count
+        addressMSB = (getNibble(bufChar(3)) * 16 + getNibble(bufChar(4))) & 0xFFFF
+        addressLSB = (getNibble(bufChar(5)) * 16 + getNibble(bufChar(6))) & 0xFFFF
+        sumCheck += addressMSB + addressLSB
+        baseAddress = ((addressMSB << 8) + addressLSB) & 0xFFFF
+        recordType = (getNibble(bufChar(7)) * 16 + getNibble(bufChar(8))) & 0xFFFF
+        if recordType == 1:                 # End of file record type
+            return
+        if recordType != 0:                 # ignore all but data records
+            return
+        sbOffset = 7
+        for i in range(count):
+            sbOffset = (i * 2) + 9
+            value = (getNibble(bufChar(sbOffset)) * 16 + getNibble(bufChar(sbOffset + 1))) & 0xFF
+            sumCheck += value
+            self.writeByte(baseAddress + i - self.addressOffset, value)
+        sbOffset += 2
+        sumCheckValue = (getNibble(bufChar(sbOffset)) * 16 + getNibble(bufChar(sbOffset + 1))) & 0xFFFF
+        sumCheck = (sumCheck + sumCheckValue) & 0xFF
+        if sumCheck == 0:
+            self.println(hexWord(baseAddress - self.addressOffset) + " Ok.")
+        else:
+            self.println("Sumcheck incorrect for " + hexWord(baseAddress))
+
+    def motoExorciserS1Interpreter(self):
+        recordType = self.serialBuffer[1]
+        if recordType == ord('9'):
+            sumCheckReceived = self.get8BitValue(8)
+            if sumCheckReceived == 0xFC:
+                self.println("End record Ok.")
+            else:
+                self.println("Sumcheck incorrect for end record received: " + hexByte(sumCheckReceived) +
+                             ", should be: FC")
+            return
+        if recordType != ord('1'):
+            return                          # Ignore all record types other than 'S1'
+        count = self.get8BitValue(2)
+        sumCheck = count
+        count = max(count - 3, 0)
+        baseAddressMSB = self.get8BitValue(4)
+        baseAddressLSB = self.get8BitValue(6)
+        sumCheck += baseAddressMSB + baseAddressLSB
+        baseAddress = baseAddressMSB * 256 + baseAddressLSB
+        sbOffset = 6
+        for i in range(count):
+            sbOffset = (i * 2) + 8
+            value = self.get8BitValue(sbOffset)
+            sumCheck += value
+            self.writeByte(baseAddress + i - self.addressOffset, value)
+        sbOffset += 2
+        sumCheckReceived = self.get8BitValue(sbOffset)
+        sumCheck = 0xFF & (0xFF - sumCheck)
+        if sumCheck == sumCheckReceived:
+            self.println(hexWord(baseAddress - self.addressOffset) + " Ok.")
+        else:
+            self.println("Sumcheck incorrect for " + hexWord(baseAddress) + " received: " +
+                         hexByte(sumCheckReceived) + ", calculated: " + hexByte(sumCheck))
+
+    # binary transfer mode
+
+    def enterBinaryMode(self):
+        self.println("Binary mode Ok.")
+        self.binaryMode = True
+        self.lastByteTime = self.now
+
+    def leaveBinaryMode(self):
+        self.binaryMode = False
+        self.clearSerialBuffer()
+        self.setBufPointer = 0
+
+    def binaryTimeouts(self):
+        if self.now - self.lastByteTime > FRAMETIMEOUT and self.setBufPointer > 0:
+            self.tx.append(NAK)             # incomplete frame
+            self.setBufPointer = 0
+        if self.now - self.lastByteTime > BINARYIDLE:
+            self.leaveBinaryMode()
+
+    def binaryCollector(self, inByte):
+        self.lastByteTime = self.now
+        if self.setBufPointer == 0:
+            if inByte == STX:               # skip everything between frames
+                self.serialBuffer[0] = inByte
+                self.setBufPointer = 1
+            return
+        self.serialBuffer[self.setBufPointer] = inByte
+        self.setBufPointer += 1
+        if self.setBufPointer == 2 and inByte > MAXFRAMEDATA:
+            self.tx.append(NAK)
+            self.setBufPointer = 0
+            return
+        if self.setBufPointer > 2 and self.setBufPointer == self.serialBuffer[1] + 6:
+            self.binaryInterpreter()
+            self.setBufPointer = 0
+
+    def binaryInterpreter(self):
+        count = self.serialBuffer[1]
+        crc = binascii.crc_hqx(bytes(self.serialBuffer[1:count + 4]), 0xFFFF)
+        if crc != (self.serialBuffer[count + 4] << 8) + self.serialBuffer[count + 5]:
+            self.tx.append(NAK)
+            return
+        if count == 0:                      # end frame
+            self.leaveBinaryMode()
+            self.tx.append(ACK)
+            return
+        baseAddress = (self.serialBuffer[2] << 8) + self.serialBuffer[3]
+        for i in range(count):
+            self.writeByte(baseAddress + i - self.addressOffset, self.serialBuffer[i + 4])
+        self.tx.append(ACK)
+
+    def calcChecksum(self):
+        startAddress = self.get16BitValue(1)
+        endAddress   = self.get16BitValue(6)
+        checkSum = 0
+        andOrChecksum = 0
+        for i in range(startAddress, endAddress + 1):
+            data = self.readByte(i)
+            checkSum += data
+            andOrChecksum = ((data & andOrChecksum) - (data | andOrChecksum)) & 0xFF
+        checkSum &= 0xFFFF                  # blockChecksum() returns an unsigned int
+        yield max(endAddress + 1 - startAddress, 0) * CHECKSUMTIME
+        self.println("Checksum block %Xh - %Xh : %Xh, %d, %d, and/or: %d" % (
+            startAddress, endAddress, checkSum, checkSum, checkSum & 0xFF, andOrChecksum))
+
+    def echoManagement(self):
+        if self.setBufPointer == 1:
+            self.echo = not self.echo
+            if self.echo:
+                self.println("echo on")
+        else:
+            self.println("unsupported")
+
+    def setRelay(self):
+        if self.setBufPointer == 1:
+            self.print("0" if self.relayOn else "1")
+        elif self.setBufPointer == 2:
+            if self.serialBuffer[1] == ord('1'):
+                self.relayOn = True
+            elif self.serialBuffer[1] == ord('0'):
+                self.relayOn = False
+            else:
+                self.print("? " + chr(self.serialBuffer[1]))
+        else:
+            self.println("unsupported")
+        self.println()
+
+    def ramTest(self):
+        self.println("32k Byte RAM test")
+        phases = ((" Phase 1: ?? > 0x00", 0x00), (" Phase 2: 0x00 > 0x55", 0x55),
+                  (" Phase 3: 0x55 > 0xAA", 0xAA), (" Phase 4: 0xAA > 0xFF", 0xFF))
+        for text, value in phases:
+            self.println(text)
+            self.ram[0:RAMSIZE - 1] = bytes([value]) * (RAMSIZE - 1)
+            yield
+        self.println("RAM test OK")
+
+    def portTest(self):
+        port = chr(self.serialBuffer[1]).upper()
+        if port in "ACDLH":
+            self.println("Testing PORT" + port)
+            self.hung = True                # endless loop on the board
+
+    def hang(self):
+        self.hung = True                    # blink and port view never return
+
+    def writePin(self):
+        return
+
+
+class PtyRunner:
+    """
+    Connects a RomEmuDevice to the master side of a pty and moves the
+    bytes at the speed of the simulated serial line (baud 0: no limit).
+    With errorRate, that part of the bytes from the host is dropped or
+    garbled.
+    """
+
+    def __init__(self, device, baud=DEFAULTBAUD, link=None, resetOnOpen=True, verbose=False, errorRate=0.0,
+                 seed=None):
+        self.device = device
+        self.baud = baud
+        self.errorRate = errorRate
+        self.rng = random.Random(seed)
+        self.resetOnOpen = resetOnOpen
+        self.verbose = verbose
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.portName = os.ttyname(slave)
+        os.close(slave)
+        os.set_blocking(self.master, False)
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.portName, link)
+        self.hostPending = bytearray()
+        self.connected = False
+        self.running = False
+
+    def close(self):
+        self.running = False
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+
+    def pollHost(self):
+        """Read from the host; returns False while the slave side is closed."""
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if e.errno == errno.EIO:
+                return False
+            raise
+        if self.errorRate:
+            data = self.noise(data)
+        self.hostPending += data
+        return True
+
+    def noise(self, data):
+        """data with some bytes dropped or with a bit flipped."""
+        noisy = bytearray()
+        for value in data:
+            if self.rng.random() >= self.errorRate:
+                noisy.append(value)
+            elif self.rng.random() < 0.5:
+                if self.verbose:
+                    print("dropped", bytes([value]))
+            else:
+                noisy.append(value ^ (1 << self.rng.randrange(8)))
+                if self.verbose:
+                    print("garbled", bytes([value]), bytes(noisy[-1:]))
+        return bytes(noisy)
+
+    def run(self):
+        self.running = True
+        bytesPerSecond = self.baud / 10.0
+        rxCredit = txCredit = 0.0
+        last = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            elapsed, last = now - last, now
+            connected = self.pollHost()
+            if connected != self.connected:
+                self.connected = connected
+                if connected and self.resetOnOpen:
+                    if self.verbose:
+                        print("Host connected, reset")
+                    self.device.reset()
+                if not connected or self.resetOnOpen:
+                    self.hostPending = bytearray()      # lost in the bootloader
+            if not connected:
+                time.sleep(0.05)
+                continue
+
+            if self.baud:
+                rxCredit = min(rxCredit + elapsed * bytesPerSecond, max(1.0, bytesPerSecond * 0.01))
+                txCredit = min(txCredit + elapsed * bytesPerSecond, max(1.0, bytesPerSecond * 0.01))
+                rxCount, txCount = int(rxCredit), int(txCredit)
+            else:
+                rxCount, txCount = None, None
+            while self.hostPending:
+                if rxCount is None:         # no limit, only what fits in the buffer
+                    count = RXBUFSIZE - len(self.device.rx)
+                else:
+                    count, rxCount = rxCount, 0
+                if count <= 0:
+                    break
+                chunk = self.hostPending[:count]
+                del self.hostPending[:count]
+                rxCredit -= len(chunk)
+                if self.verbose:
+                    print("rx", bytes(chunk))
+                if rxCount is None:
+                    self.device.receive(chunk)
+                    self.device.step(now)
+                else:
+                    # byte by byte as on the line, a burst of credit after a
+                    # slow loop does not overflow the receive buffer
+                    for i in range(len(chunk)):
+                        self.device.receive(chunk[i:i + 1])
+                        self.device.step(now)
+                if len(self.device.tx) > TXBUFSIZE:
+                    break
+
+            self.device.step(now)
+
+            if self.device.tx and txCount != 0:
+                data = self.device.transmit(txCount)
+                try:
+                    written = os.write(self.master, data)
+                except BlockingIOError:
+                    written = 0
+                if written < len(data):
+                    self.device.tx[0:0] = data[written:]
+                txCredit -= written
+                if self.verbose:
+                    print("tx", data[:written])
+
+            busy = self.hostPending or self.device.tx or not self.device.idle()
+            select.select([self.master], [], [], 0.001 if busy else 0.02)
+
+    def start(self):
+        """Run in a daemon thread; returns the port name."""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self.portName
+
+
+def startSimulator(baud=DEFAULTBAUD, fill=None, seed=None, resetOnOpen=True, binary=True):
+    """Start a simulated ROMemu in the background, returns (runner, portName)."""
+    runner = PtyRunner(RomEmuDevice(fill=fill, seed=seed, binary=binary), baud=baud, resetOnOpen=resetOnOpen)
+    return runner, runner.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ROMemu " + VERSION + " simulator on a pseudo-terminal")
+    parser.add_argument("--baud", type=int, default=DEFAULTBAUD,
+                        help="simulated line speed, 0 for no limit (default %(default)s)")
+    parser.add_argument("--link", help="create a symlink to the pty, e.g. /tmp/ttyROMEMU")
+    parser.add_argument("--fill", type=lambda s: int(s, 16), default=None,
+                        help="initial RAM value in hex (default: power-up noise)")
+    parser.add_argument("--no-reset", action="store_true",
+                        help="do not reset the board when the port is opened")
+    parser.add_argument("--legacy", action="store_true",
+                        help="simulate " + LEGACYVERSION + ", without binary transfer mode")
+    parser.add_argument("--errors", type=float, default=0.0, metavar="RATE",
+                        help="part of the received bytes that is lost or garbled, e.g. 0.001")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the line errors")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    runner = PtyRunner(RomEmuDevice(fill=args.fill, binary=not args.legacy), baud=args.baud, link=args.link,
+                       resetOnOpen=not args.no_reset, verbose=args.verbose, errorRate=args.errors,
+                       seed=args.seed)
+    print("ROMemu simulator on " + (args.link or runner.portName) +
+          (" ({} baud)".format(args.baud) if args.baud else " (no speed limit)"))
+    sys.stdout.flush()
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+#
+# Address-space planner for the ROM Emulator.
+#
+# The target CPU sees the emulator RAM through the pod, as the EPROM in
+# its socket: ROM address 0 at the base address of the socket, and only
+# as many bytes as the EPROM type has. The planner maps an image (CPU
+# addresses) on such a target profile. It works out the F offset, takes
+# the data in the window of the EPROM, and checks the rest:
+#
+# - data in a mirror of the window, where the CPU sees the same EPROM
+#   again (the address decoder of the socket covers 'decode' bytes), is
+#   folded into the window; conflicting copies are an error,
+# - data outside the decoded range that is an exact copy of the window
+#   (an image built as a full 64 kByte memory map) is a mirror as well,
+# - other data is never seen by the CPU: it is clipped, with a warning,
+#   or rejected.
+#
+# Only the bytes of the window are sent, so nothing wraps in the 32 kByte
+# RAM or ends up where the pod does not connect it.
+
+import romEmuImage
+import romEmuVerify
+
+# EPROM type: (size, pins)
+EPROMS = {
+    '2716':  (0x0800, 24),
+    '2732':  (0x1000, 24),
+    '2532':  (0x1000, 24),
+    '2764':  (0x2000, 28),
+    '27128': (0x4000, 28),
+    '27256': (0x8000, 28),
+}
+PODS = {24: 0x1000, 28: romEmuVerify.RAMSIZE}     # pins: largest window
+
+CLIP   = 'clip'         # data the CPU cannot see is left out, with a warning
+REJECT = 'reject'       # data the CPU cannot see is an error
+
+
+class SpaceError(ValueError):
+    """The profile is not possible, or the image does not fit it."""
+
+
+class TargetProfile:
+    """Where the target CPU sees the EPROM socket."""
+
+    def __init__(self, eprom=None, pod=None, base=0, decode=None):
+        if eprom is not None and eprom not in EPROMS:
+            raise SpaceError("unknown EPROM type {}, use one of {}".format(eprom, ", ".join(EPROMS)))
+        if pod is not None and pod not in PODS:
+            raise SpaceError("no {} pin pod, use 24 or 28".format(pod))
+        if eprom is None and pod is None:
+            raise SpaceError("give the EPROM type or the pod")
+        if eprom is not None:
+            self.size, pins = EPROMS[eprom]
+            if pod is not None and pod != pins:
+                raise SpaceError("a {} has {} pins, it does not fit the {} pin pod".format(eprom, pins, pod))
+            pod = pins
+        else:
+            self.size = PODS[pod]
+        self.eprom = eprom
+        self.pod = pod
+        if base % self.size:
+            raise SpaceError("base %04Xh is not a multiple of the EPROM size %04Xh" % (base, self.size))
+        self.base = base
+        self.decode = decode or self.size
+        if self.decode % self.size or self.decode & (self.decode - 1):
+            raise SpaceError("decoded range %04Xh is not a power of two multiple of %04Xh" %
+                             (self.decode, self.size))
+        self.decodeStart = base - base % self.decode
+
+    def window(self):
+        """(first, last) CPU address of the EPROM."""
+        return self.base, self.base + self.size - 1
+
+    def mirrored(self, address):
+        """True when the CPU sees the EPROM at address, in the window or a mirror of it."""
+        return self.decodeStart <= address < self.decodeStart + self.decode
+
+    def describe(self):
+        first, last = self.window()
+        text = "{} ({} pin pod) at %04X-%04X".format(self.eprom or "EPROM", self.pod) % (first, last)
+        if self.decode > self.size:
+            text += ", mirrored in %04X-%04X" % (self.decodeStart, self.decodeStart + self.decode - 1)
+        return text
+
+
+class SpacePlan:
+    """The image as the CPU sees it, and what was done with the other data."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.image = romEmuImage.RomImage()
+        self.offset = 0             # F offset for the records of image
+        self.mirrors = []           # (start, end) CPU addresses folded into the window
+        self.clipped = []           # (start, end) CPU addresses left out
+
+    def clippedBytes(self):
+        return sum(end - start + 1 for start, end in self.clipped)
+
+    def report(self):
+        """Lines describing the plan."""
+        lines = ["Target: " + self.profile.describe() + ", offset %04X" % self.offset]
+        for start, end in self.mirrors:
+            lines.append("Mirror %04X-%04X, seen in the window at %04X" %
+                         (start, end, self.profile.base + start % self.profile.size))
+        for start, end in self.clipped:
+            lines.append("Left out %04X-%04X, the CPU does not see it" % (start, end))
+        lines.append("{} bytes in the window, {} left out".format(len(self.image), self.clippedBytes()))
+        return lines
+
+
+def runs(image, accept):
+    """The parts of the image segments where accept(address) holds, as (address, data)."""
+    parts = []
+    for start, data in image.segments():
+        first = None
+        for index in range(len(data) + 1):
+            inside = index < len(data) and accept(start + index)
+            if inside and first is None:
+                first = index
+            elif not inside and first is not None:
+                parts.append((start + first, bytes(data[first:index])))
+                first = None
+    return parts
+
+
+def planSpace(image, profile, outside=CLIP):
+    """
+    Map image (CPU addresses) on profile; returns a SpacePlan. Raises
+    SpaceError for conflicting mirrors, and with outside=REJECT for data
+    the CPU does not see.
+    """
+    plan = SpacePlan(profile)
+    size = profile.size
+    rom = bytearray([0xFF]) * size
+    known = bytearray(size)
+    first, last = profile.window()
+
+    def inWindow(address):
+        return first <= address <= last
+
+    def fold(address, data, strict):
+        """Put data in the window; False when it conflicts and not strict."""
+        for index, value in enumerate(data):
+            romAddress = (address + index) % size
+            if known[romAddress] and rom[romAddress] != value:
+                if strict:
+                    raise SpaceError("%04X is %02Xh, its mirror %04X is %02Xh" %
+                                     (address + index, value, first + romAddress, rom[romAddress]))
+                return False
+        for index, value in enumerate(data):
+            rom[(address + index) % size] = value
+            known[(address + index) % size] = 1
+        return True
+
+    for address, data in runs(image, inWindow):
+        fold(address, data, True)
+    for address, data in runs(image, lambda a: profile.mirrored(a) and not inWindow(a)):
+        fold(address, data, True)
+        plan.mirrors.append((address, address + len(data) - 1))
+    for address, data in runs(image, lambda a: not profile.mirrored(a)):
+        copy = all(known[(address + index) % size] for index in range(len(data))) and \
+            fold(address, data, False)
+        if copy:
+            plan.mirrors.append((address, address + len(data) - 1))
+        elif outside == REJECT:
+            raise SpaceError("%04X-%04X is outside %s" % (address, address + len(data) - 1, profile.describe()))
+        else:
+            plan.clipped.append((address, address + len(data) - 1))
+
+    # records with CPU addresses and the base as F offset, when they fit in 16 bits
+    relocate = 0 if last <= 0xFFFF else first
+    plan.offset = first - relocate
+    plan.image.sourceFormat = image.sourceFormat
+    plan.image.startAddress = image.startAddress
+    address = 0
+    while address < size:
+        if not known[address]:
+            address += 1
+            continue
+        end = address + 1
+        while end < size and known[end]:
+            end += 1
+        plan.image.setBytes(first - relocate + address, rom[address:end])
+        address = end
+    return plan
+
+
+def ramOverflow(image, offset=0):
+    """
+    The (start, end) record addresses that do not fit the RAM with offset:
+    the firmware writes them at the address minus offset, modulo 32 kByte.
+    """
+    overflow = []
+    for start, data in image.segments():
+        ramAddress = (start - offset) & 0xFFFF
+        if ramAddress + len(data) > romEmuVerify.RAMSIZE:
+            first = start + max(0, romEmuVerify.RAMSIZE - ramAddress)
+            overflow.append((first, start + len(data) - 1))
+    return overflow
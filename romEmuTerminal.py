@@ -12,8 +12,10 @@
 # of HEX-intel files to the ROM Emulator and control 
 # the settings.
 #
-# Note self.serial writes to the Arduino and self.text_ctrl_output writes
-# to the terminal console.
+# Note self.scheduler writes to the Arduino and self.text_ctrl_output writes
+# to the terminal console. Only the scheduler (romEmuScheduler.py) touches
+# self.serial once it is open: typed keys and menu commands go first,
+# downloads, scripts and memory reads run in a session, in the gaps.
 #
 # Adapted from:
 #
@@ -35,6 +37,18 @@ import wx
 import wx.lib.newevent
 import wxSerialConfigDialog
 
+import romEmuCapture
+import romEmuConnect
+import romEmuDump
+import romEmuImage
+import romEmuPlan
+import romEmuProfile
+import romEmuScheduler
+import romEmuScript
+import romEmuShadow
+import romEmuTrace
+import romEmuVerify
+
 #try:
 #    unichr
 #except NameError:
@@ -316,14 +330,30 @@ class SerialConfigDialog(wx.Dialog):
 # access the GUI without crashing. wxMutexGuiEnter/wxMutexGuiLeave
 # could be used too, but an event is more elegant.
 
-SerialRxEvent, EVT_SERIALRX = wx.lib.newevent.NewEvent()
 SERIALRX = wx.NewEventType()
+DownloadProgressEvent, EVT_DOWNLOADPROGRESS = wx.lib.newevent.NewEvent()
+DownloadDoneEvent, EVT_DOWNLOADDONE = wx.lib.newevent.NewEvent()
+ScriptDoneEvent, EVT_SCRIPTDONE = wx.lib.newevent.NewEvent()
+MemoryReadDoneEvent, EVT_MEMORYREADDONE = wx.lib.newevent.NewEvent()
 
 # ----------------------------------------------------------------------
 
 ID_CLEAR    = wx.NewIdRef()
 ID_DOWNLOAD = wx.NewIdRef()
+ID_DELTA    = wx.NewIdRef()
+ID_REPACK   = wx.NewIdRef()
+ID_BINARY   = wx.NewIdRef()
+ID_FILLCOPY = wx.NewIdRef()
+ID_SCRIPT   = wx.NewIdRef()
+ID_MEMORY   = wx.NewIdRef()
+ID_TIMING   = wx.NewIdRef()
+ID_SAVETRACE = wx.NewIdRef()
+ID_PROFILE  = wx.NewIdRef()
+ID_CPROFILE = wx.NewIdRef()
+ID_SAVEPROFILE = wx.NewIdRef()
 ID_SAVEAS   = wx.NewIdRef()
+ID_LOG      = wx.NewIdRef()
+ID_CAPTURE  = wx.NewIdRef()
 ID_SETTINGS = wx.NewIdRef()
 ID_TERM     = wx.NewIdRef()
 ID_EXIT     = wx.NewIdRef()
@@ -340,6 +370,279 @@ LF = "\n"
 sendDelay = 0.05
 resetDelay = 0.5
 
+FLUSHINTERVAL = 50          # ms between the updates of the output window
+SCROLLBACK    = 256         # kB of text kept in the output window
+UNPRINTABLE   = {c: 0x2400 + c for c in list(range(0x20)) + [0x7F]}
+ROWSIZE       = 16          # bytes per row of the memory view
+MEMORYCHUNK   = 0x100       # bytes per ; command when the memory view reads the RAM
+PROFILESTATUS = 1.0         # s between the updates of the profile figures in the status bar
+CPROFILETIME  = 10          # default seconds of a cProfile run
+
+
+class OutputQueue:
+    """\
+    Text for the output window, written by the receiver and download
+    threads and taken by the GUI thread on a timer, so the window is
+    updated once per interval with everything received in between.
+    While profiling, the receiver gives the time each chunk was read.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+        self.stamps = []
+
+    def put(self, text, stamp=None):
+        with self.lock:
+            self.parts.append(text)
+            if stamp is not None:
+                self.stamps.append(stamp)
+
+    def take(self):
+        """Returns the queued text and the read times of its chunks."""
+        with self.lock:
+            parts, self.parts = self.parts, []
+            stamps, self.stamps = self.stamps, []
+        return ''.join(parts), stamps
+
+
+class MemoryBuffer:
+    """\
+    Host side copy of the emulator RAM, filled from the D dumps and the
+    ; and G records that pass by, and by the MemoryReadThread. Per byte
+    it keeps whether it is known and whether its last update changed
+    it, and the rows updated since the memory view was last refreshed.
+    """
+
+    def __init__(self, size=romEmuVerify.RAMSIZE):
+        self.size = size
+        self.data = bytearray(size)
+        self.known = bytearray(size)
+        self.changed = bytearray(size)
+        self.dirty = set()              # rows to redraw
+        self.partial = ''               # incomplete line received
+        self.lock = threading.Lock()
+
+    def update(self, address, data):
+        with self.lock:
+            for index, value in enumerate(data):
+                a = (address + index) % self.size
+                changed = 1 if self.known[a] and self.data[a] != value else 0
+                if not self.known[a] or changed != self.changed[a] or self.data[a] != value:
+                    self.dirty.add(a // ROWSIZE)
+                    self.data[a] = value
+                    self.known[a] = 1
+                    self.changed[a] = changed
+
+    def feedLine(self, line):
+        """Take the data of a D line or a hex-intel or S1 record, ignore other lines."""
+        dump = romEmuVerify.parseDumpLine(line)
+        if dump is not None:
+            self.update(*dump)
+        elif line[:1] == ':' or line[:2] in ('S1', 's1'):
+            try:
+                record = romEmuImage.parseRecord(line)
+            except ValueError:
+                return
+            if record is not None:
+                self.update(*record)
+
+    def feed(self, text):
+        """Received text, in pieces as they come from the port."""
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()[-256:]
+        for line in lines:
+            self.feedLine(line.strip())
+
+    def row(self, row):
+        """(data, known, changed) of a row."""
+        start = row * ROWSIZE
+        with self.lock:
+            return (self.data[start:start + ROWSIZE], self.known[start:start + ROWSIZE],
+                    self.changed[start:start + ROWSIZE])
+
+    def takeDirty(self):
+        """The ranges (first, last) of rows updated since the last call."""
+        with self.lock:
+            rows, self.dirty = sorted(self.dirty), set()
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row - 1:
+                ranges[-1][1] = row
+            else:
+                ranges.append([row, row])
+        return ranges
+
+    def clearChanges(self):
+        with self.lock:
+            self.dirty.update(a // ROWSIZE for a in range(self.size) if self.changed[a])
+            self.changed = bytearray(self.size)
+
+
+class MemoryList(wx.ListCtrl):
+    """\
+    Virtual list of the rows of a MemoryBuffer: the control asks for the
+    text of the visible rows only. Bytes that changed on their last read
+    are highlighted, bytes not read yet are shown as --.
+    """
+
+    def __init__(self, parent, memory):
+        wx.ListCtrl.__init__(self, parent, -1, style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_SINGLE_SEL)
+        self.memory = memory
+        self.InsertColumn(0, "Addr", width=56)
+        for column in range(ROWSIZE):
+            self.InsertColumn(column + 1, "%X" % column, width=30)
+        self.InsertColumn(ROWSIZE + 1, "ASCII", width=150)
+        self.SetItemCount(memory.size // ROWSIZE)
+        self.attrChanged = wx.ItemAttr()
+        self.attrChanged.SetBackgroundColour(wx.Colour(255, 214, 110))
+        self.attrUnknown = wx.ItemAttr()
+        self.attrUnknown.SetTextColour(wx.Colour(160, 160, 160))
+
+    def OnGetItemText(self, item, column):
+        if column == 0:
+            return "%04X" % (item * ROWSIZE)
+        data, known, changed = self.memory.row(item)
+        if column <= ROWSIZE:
+            return "%02X" % data[column - 1] if known[column - 1] else "--"
+        return ''.join(chr(value) if known[i] and 0x20 <= value < 0x7F else '.' for i, value in enumerate(data))
+
+    def OnGetItemColumnAttr(self, item, column):
+        if 1 <= column <= ROWSIZE and self.memory.row(item)[2][column - 1]:
+            return self.attrChanged
+        return self.OnGetItemAttr(item)
+
+    def OnGetItemAttr(self, item):
+        if not any(self.memory.row(item)[1]):
+            return self.attrUnknown
+        return None
+
+    def RefreshChanged(self):
+        """Redraw the rows updated since the last call; only the visible ones are drawn."""
+        for first, last in self.memory.takeDirty():
+            self.RefreshItems(first, last)
+
+
+class MemoryFrame(wx.Frame):
+    """\
+    Memory view of the terminal: the MemoryBuffer in a MemoryList, with a
+    range to read from the emulator and an address to go to.
+    """
+
+    def __init__(self, terminal, memory):
+        wx.Frame.__init__(self, terminal, -1, "Memory View", size=(780, 520))
+        self.terminal = terminal
+        self.memory = memory
+        self.label_range = wx.StaticText(self, -1, "Range")
+        self.text_start = wx.TextCtrl(self, -1, "0000", size=(60, -1))
+        self.text_end = wx.TextCtrl(self, -1, "7FFF", size=(60, -1))
+        self.button_read = wx.Button(self, -1, "Read")
+        self.label_goto = wx.StaticText(self, -1, "Go to")
+        self.text_goto = wx.TextCtrl(self, -1, "", size=(60, -1), style=wx.TE_PROCESS_ENTER)
+        self.button_clear = wx.Button(self, -1, "Clear Marks")
+        self.list_memory = MemoryList(self, memory)
+        self.list_memory.SetFont(wx.Font(9, wx.MODERN, wx.NORMAL, wx.NORMAL, 0, ""))
+
+        sizer_1 = wx.BoxSizer(wx.VERTICAL)
+        sizer_2 = wx.BoxSizer(wx.HORIZONTAL)
+        for control in (self.label_range, self.text_start, self.text_end, self.button_read,
+                        self.label_goto, self.text_goto, self.button_clear):
+            sizer_2.Add(control, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 4)
+        sizer_1.Add(sizer_2, 0, wx.EXPAND, 0)
+        sizer_1.Add(self.list_memory, 1, wx.EXPAND, 0)
+        self.SetSizer(sizer_1)
+        self.Layout()
+
+        self.button_read.Bind(wx.EVT_BUTTON, self.OnRead)
+        self.button_clear.Bind(wx.EVT_BUTTON, self.OnClearMarks)
+        self.text_goto.Bind(wx.EVT_TEXT_ENTER, self.OnGoto)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.refreshTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, terminal.Timed(self.OnRefresh), self.refreshTimer)
+        self.refreshTimer.Start(FLUSHINTERVAL)
+
+    def OnRead(self, event):
+        """Read the range from the emulator, in the background."""
+        try:
+            start = int(self.text_start.GetValue(), 16)
+            end = int(self.text_end.GetValue(), 16)
+        except ValueError:
+            return
+        if not 0 <= start <= end < self.memory.size:
+            return
+        self.terminal.ReadMemory(start, end + 1)
+
+    def OnGoto(self, event):
+        try:
+            row = (int(self.text_goto.GetValue(), 16) % self.memory.size) // ROWSIZE
+        except ValueError:
+            return
+        self.list_memory.EnsureVisible(row)
+        self.list_memory.Select(row)
+
+    def OnClearMarks(self, event):
+        self.memory.clearChanges()
+
+    def OnRefresh(self, event):
+        self.list_memory.RefreshChanged()
+
+    def OnClose(self, event):
+        self.refreshTimer.Stop()
+        self.terminal.memoryFrame = None
+        self.Destroy()
+
+# end of class MemoryFrame
+
+
+class MemoryReadThread(threading.Thread):
+    """\
+    Reads a range of the RAM into the MemoryBuffer with ; commands, a
+    chunk at a time, so the memory view fills while it reads. Records
+    with a wrong checksum are read again, as romEmuDump.py does.
+    """
+
+    def __init__(self, frame, ser, memory, start, end):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+        self.serial = ser
+        self.memory = memory
+        self.rangeStart = start
+        self.rangeEnd = end
+        self.cancel = threading.Event()
+
+    def run(self):
+        chunks = range(self.rangeStart, self.rangeEnd, MEMORYCHUNK)
+        failed = []
+        error = None
+        start = time.monotonic()
+        try:
+            for index, chunkStart in enumerate(chunks):
+                if self.cancel.is_set():
+                    break
+                chunkEnd = min(chunkStart + MEMORYCHUNK, self.rangeEnd)
+                for attempt in range(romEmuDump.RETRIES + 1):
+                    data = romEmuDump.readChunk(self.serial, chunkStart, chunkEnd)
+                    if data is not None:
+                        self.memory.update(chunkStart, data)
+                        break
+                else:
+                    failed.append(chunkStart)
+                elapsed = time.monotonic() - start
+                rate = (index + 1) / elapsed if elapsed > 0 else 0.0
+                wx.PostEvent(self.frame, DownloadProgressEvent(
+                    sent=index + 1, total=len(chunks), rate=rate,
+                    eta=(len(chunks) - index - 1) / rate if rate > 0 else 0.0, errors=len(failed), unit="chunks"))
+        except (serial.SerialException, OSError) as e:
+            error = str(e)
+        finally:
+            self.serial.close()
+            wx.PostEvent(self.frame, MemoryReadDoneEvent(
+                start=self.rangeStart, end=self.rangeEnd, failed=failed, error=error, elapsed=time.monotonic() - start))
+
+# end of class MemoryReadThread
+
+
 class TerminalSetup:
     """
     Placeholder for various terminal settings. Used to pass the
@@ -349,6 +652,8 @@ class TerminalSetup:
         self.echo = False
         self.unprintable = False
         self.newline = NEWLINE_CRLF
+        self.scrollback = SCROLLBACK    # kB
+        self.resetOnConnect = True      # reset the board when the port is opened
 
 
 class TerminalSettingsDialog(wx.Dialog):
@@ -363,6 +668,9 @@ class TerminalSettingsDialog(wx.Dialog):
         self.checkbox_echo = wx.CheckBox(self, -1, "Local Echo")
         self.checkbox_unprintable = wx.CheckBox(self, -1, "Show unprintable characters")
         self.radio_box_newline = wx.RadioBox(self, -1, "Newline Handling", choices=["CR only", "LF only", "CR+LF"], majorDimension=0, style=wx.RA_SPECIFY_ROWS)
+        self.label_scrollback = wx.StaticText(self, -1, "Scrollback (kB)")
+        self.spin_scrollback = wx.SpinCtrl(self, -1, "", min=16, max=65536)
+        self.checkbox_reset = wx.CheckBox(self, -1, "Reset board on connect")
         self.sizer_4_staticbox = wx.StaticBox(self, -1, "Input/Output")
         self.button_cancel = wx.Button(self, wx.ID_CANCEL, "")
         self.button_ok = wx.Button(self, wx.ID_OK, "")
@@ -374,6 +682,8 @@ class TerminalSettingsDialog(wx.Dialog):
         self.checkbox_echo.SetValue(True)
         self.checkbox_unprintable.SetValue(self.settings.unprintable)
         self.radio_box_newline.SetSelection(self.settings.newline)
+        self.spin_scrollback.SetValue(self.settings.scrollback)
+        self.checkbox_reset.SetValue(self.settings.resetOnConnect)
 
     def __set_properties(self):
         # begin wxGlade: TerminalSettingsDialog.__set_properties
@@ -392,6 +702,11 @@ class TerminalSettingsDialog(wx.Dialog):
         sizer_4.Add(self.checkbox_echo, 0, wx.ALL, 4)
         sizer_4.Add(self.checkbox_unprintable, 0, wx.ALL, 4)
         sizer_4.Add(self.radio_box_newline, 0, 0, 0)
+        sizer_5 = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_5.Add(self.label_scrollback, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 4)
+        sizer_5.Add(self.spin_scrollback, 0, wx.ALL, 4)
+        sizer_4.Add(sizer_5, 0, 0, 0)
+        sizer_4.Add(self.checkbox_reset, 0, wx.ALL, 4)
         sizer_2.Add(sizer_4, 0, wx.EXPAND, 0)
         sizer_3.Add(self.button_ok, 0, 0, 0)
         sizer_3.Add(self.button_cancel, 0, 0, 0)
@@ -410,6 +725,8 @@ class TerminalSettingsDialog(wx.Dialog):
         self.settings.echo = self.checkbox_echo.GetValue()
         self.settings.unprintable = self.checkbox_unprintable.GetValue()
         self.settings.newline = self.radio_box_newline.GetSelection()
+        self.settings.scrollback = self.spin_scrollback.GetValue()
+        self.settings.resetOnConnect = self.checkbox_reset.GetValue()
         self.EndModal(wx.ID_OK)
 
     def OnCancel(self, events):
@@ -419,6 +736,106 @@ class TerminalSettingsDialog(wx.Dialog):
 # end of class TerminalSettingsDialog
 
 
+class DownloadThread(threading.Thread):
+    """\
+    Sends the records of a file to the ROM Emulator while the GUI keeps
+    running. ser is a romEmuScheduler.Session, closed when the thread
+    ends; the replies, the progress and the end of the download are
+    posted to the frame as events. The reset relay is released also after
+    a cancel.
+    """
+
+    def __init__(self, frame, ser, lines, full, binary=False, plan=None, trace=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+        self.serial = ser
+        self.lines = lines
+        self.full = full
+        self.binary = binary
+        self.plan = plan
+        self.trace = trace
+        self.cancel = threading.Event()
+
+    def out(self, text):
+        self.frame.output.put(text + LF)
+
+    def progress(self, result, total):
+        rate = result.records / result.elapsed if result.elapsed > 0 else 0.0
+        eta = (total - result.records) / rate if rate > 0 else 0.0
+        wx.PostEvent(self.frame, DownloadProgressEvent(
+            sent=result.records, total=total, rate=rate, eta=eta, errors=result.errors, unit="records"))
+
+    def run(self):
+        result = None
+        error = None
+        try:
+            if RESETSW:
+                self.serial.write(("R1" + LF).encode())
+                time.sleep(resetDelay)
+                self.out("Relay on")
+            result = romEmuShadow.deltaUpload(
+                self.serial, self.lines, romEmuShadow.shadowKey(self.serial.port), full=self.full,
+                out=self.out, progress=self.progress, cancel=self.cancel, binary=self.binary,
+                plan=self.plan, trace=self.trace)
+            if self.trace is not None:
+                self.trace.finish()
+                for line in self.trace.summary():
+                    self.out(line)
+        except (serial.SerialException, OSError) as e:
+            error = str(e)
+        finally:
+            if RESETSW:
+                try:
+                    self.serial.write(("R0" + LF).encode())
+                    time.sleep(resetDelay)
+                    self.out("Relay off")
+                except (serial.SerialException, OSError):
+                    pass
+            self.serial.close()
+            wx.PostEvent(self.frame, DownloadDoneEvent(result=result, error=error))
+
+# end of class DownloadThread
+
+
+class ScriptThread(threading.Thread):
+    """\
+    Runs a command script (romEmuScript.py) while the GUI keeps running,
+    like the DownloadThread. The run stops at the first error.
+    """
+
+    def __init__(self, frame, ser, commands):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+        self.serial = ser
+        self.commands = commands
+        self.cancel = threading.Event()
+
+    def out(self, text):
+        self.frame.output.put(text + LF)
+
+    def progress(self, result, total):
+        rate = result.sent / result.elapsed if result.elapsed > 0 else 0.0
+        eta = (total - result.sent) / rate if rate > 0 else 0.0
+        wx.PostEvent(self.frame, DownloadProgressEvent(
+            sent=result.sent, total=total, rate=rate, eta=eta, errors=len(result.errors), unit="commands"))
+
+    def run(self):
+        result = None
+        error = None
+        try:
+            result = romEmuScript.runScript(self.serial, self.commands, out=self.out, progress=self.progress,
+                                            cancel=self.cancel)
+        except (serial.SerialException, OSError) as e:
+            error = str(e)
+        finally:
+            self.serial.close()
+            wx.PostEvent(self.frame, ScriptDoneEvent(result=result, error=error))
+
+# end of class ScriptThread
+
+
 class TerminalFrame(wx.Frame):
     """Simple terminal program for wxPython"""
 
@@ -427,8 +844,21 @@ class TerminalFrame(wx.Frame):
         self.serial.timeout = 0.5   # make sure that the alive event can be checked from time to time
         self.settings = TerminalSetup()  # placeholder for the settings
         self.settings.echo = True
-        self.thread = None
+        self.scheduler = None           # owns the port while it is open
+        self.decoder = None
         self.alive = threading.Event()
+        self.download = None            # DownloadThread while a download runs
+        self.trace = None               # timing of the last download
+        self.output = OutputQueue()     # text waiting for the output window
+        self.log = None                 # file the output is streamed to
+        self.capture = None             # CaptureWriter of the port traffic
+        self.memory = MemoryBuffer()    # RAM as seen in dumps, for the memory view
+        self.memoryFrame = None
+        self.profiler = None            # GuiProfile while Profile is checked
+        self.profile = None             # the last GuiProfile
+        self.profileStatus = ""
+        self.profileShown = 0.0
+        self.lastFlush = None
         # begin wxGlade: TerminalFrame.__init__
         kwds["style"] = wx.DEFAULT_FRAME_STYLE
         wx.Frame.__init__(self, *args, **kwds)
@@ -438,7 +868,20 @@ class TerminalFrame(wx.Frame):
         wxglade_tmp_menu = wx.Menu()
         wxglade_tmp_menu.Append(ID_CLEAR, "&Clear", "", wx.ITEM_NORMAL)
         wxglade_tmp_menu.Append(ID_DOWNLOAD, "&Download hex file...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_DELTA, "Download &changes only", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_REPACK, "&Repack records", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_BINARY, "&Binary transfer", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_FILLCOPY, "&Fill and copy", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_SCRIPT, "Run Scri&pt...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_MEMORY, "&Memory View...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_TIMING, "T&iming", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_SAVETRACE, "Save T&race As...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_PROFILE, "Pro&file", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_CPROFILE, "Run cPr&ofile...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_SAVEPROFILE, "Save Profile &As...", "", wx.ITEM_NORMAL)
         wxglade_tmp_menu.Append(ID_SAVEAS, "&Save Text As...", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.Append(ID_LOG, "&Log to File...", "", wx.ITEM_CHECK)
+        wxglade_tmp_menu.Append(ID_CAPTURE, "Capt&ure Session...", "", wx.ITEM_CHECK)
         wxglade_tmp_menu.AppendSeparator()
         wxglade_tmp_menu.Append(ID_TERM, "&Terminal Settings...", "", wx.ITEM_NORMAL)
         wxglade_tmp_menu.AppendSeparator()
@@ -457,45 +900,63 @@ class TerminalFrame(wx.Frame):
         self.frame_terminal_menubar.Append(wxglade_tmp_menu, "Help")
         
         self.SetMenuBar(self.frame_terminal_menubar)
+        self.frame_terminal_menubar.Check(ID_DELTA, True)
         # Menu Bar end
         self.text_ctrl_output = wx.TextCtrl(self, -1, "", style=wx.TE_MULTILINE | wx.TE_READONLY)
+        self.panel_download = wx.Panel(self, -1)
+        self.gauge_download = wx.Gauge(self.panel_download, -1, 1)
+        self.label_download = wx.StaticText(self.panel_download, -1, "")
+        self.button_cancel_download = wx.Button(self.panel_download, wx.ID_CANCEL, "")
+        self.statusbar = self.CreateStatusBar()
+        self.portStatus = ""
 
         self.__set_properties()
         self.__do_layout()
 
-        self.Bind(wx.EVT_MENU, self.OnClear, id=ID_CLEAR)
-        self.Bind(wx.EVT_MENU, self.OnDownload, id=ID_DOWNLOAD)
-        self.Bind(wx.EVT_MENU, self.OnSaveAs, id=ID_SAVEAS)
-        self.Bind(wx.EVT_MENU, self.OnTermSettings, id=ID_TERM)
-        self.Bind(wx.EVT_MENU, self.OnExit, id=ID_EXIT)
-        self.Bind(wx.EVT_MENU, self.OnRTS, id=ID_RTS)
-        self.Bind(wx.EVT_MENU, self.OnDTR, id=ID_DTR)
-        self.Bind(wx.EVT_MENU, self.OnPortSettings, id=ID_SETTINGS)
-        self.Bind(wx.EVT_MENU, self.OnHelp, id=ID_HELP)
-        self.Bind(wx.EVT_MENU, self.OnAbout, id=ID_ABOUT)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnClear), id=ID_CLEAR)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnDownload), id=ID_DOWNLOAD)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnRunScript), id=ID_SCRIPT)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnMemory), id=ID_MEMORY)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnSaveAs), id=ID_SAVEAS)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnLog), id=ID_LOG)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnCapture), id=ID_CAPTURE)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnSaveTrace), id=ID_SAVETRACE)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnProfile), id=ID_PROFILE)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnCProfile), id=ID_CPROFILE)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnSaveProfile), id=ID_SAVEPROFILE)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnTermSettings), id=ID_TERM)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnExit), id=ID_EXIT)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnRTS), id=ID_RTS)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnDTR), id=ID_DTR)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnPortSettings), id=ID_SETTINGS)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnHelp), id=ID_HELP)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnAbout), id=ID_ABOUT)
         # end wxGlade
         self.__attach_events()          # register events
+        self.flushTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.Timed(self.OnFlushOutput), self.flushTimer)
+        self.flushTimer.Start(FLUSHINTERVAL)
         self.OnPortSettings(None)       # call setup dialog on startup, opens port
         if not self.alive.is_set():
             self.Close()
 
     def StartThread(self):
-        """Start the receiver thread"""
-        self.thread = threading.Thread(target=self.ComPortThread)
-        self.thread.daemon = True
+        """Start the port scheduler, with its writer and receiver threads"""
+        self.decoder = codecs.getincrementaldecoder('UTF-8')('replace')
+        self.scheduler = romEmuScheduler.PortScheduler(self.serial, self.OnReceive)
+        self.scheduler.capture = self.capture
         self.alive.set()
-        self.thread.start()
-        self.serial.rts = True
-        self.serial.dtr = True
+        self.scheduler.start()
+        # RTS and DTR are left alone: asserting DTR again resets the board
         self.frame_terminal_menubar.Check(ID_RTS, self.serial.rts)
         self.frame_terminal_menubar.Check(ID_DTR, self.serial.dtr)
 
     def StopThread(self):
-        """Stop the receiver thread, wait until it's finished."""
-        if self.thread is not None:
-            self.alive.clear()          # clear alive event for thread
-            self.thread.join()          # wait until thread has finished
-            self.thread = None
+        """Stop the port scheduler, wait until its threads are finished."""
+        if self.scheduler is not None:
+            self.alive.clear()
+            self.scheduler.stop()
+            self.scheduler = None
 
     def __set_properties(self):
         # begin wxGlade: TerminalFrame.__set_properties
@@ -508,21 +969,32 @@ class TerminalFrame(wx.Frame):
         # begin wxGlade: TerminalFrame.__do_layout
         sizer_1 = wx.BoxSizer(wx.VERTICAL)
         sizer_1.Add(self.text_ctrl_output, 1, wx.EXPAND, 0)
+        sizer_download = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_download.Add(self.gauge_download, 1, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 4)
+        sizer_download.Add(self.label_download, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 4)
+        sizer_download.Add(self.button_cancel_download, 0, wx.ALL, 4)
+        self.panel_download.SetSizer(sizer_download)
+        sizer_1.Add(self.panel_download, 0, wx.EXPAND, 0)
+        self.panel_download.Hide()
         self.SetSizer(sizer_1)
         self.Layout()
         # end wxGlade
 
     def __attach_events(self):
         # register events at the controls
-        self.Bind(wx.EVT_MENU, self.OnClear, id=ID_CLEAR)
-        self.Bind(wx.EVT_MENU, self.OnSaveAs, id=ID_SAVEAS)
-        self.Bind(wx.EVT_MENU, self.OnExit, id=ID_EXIT)
-        self.Bind(wx.EVT_MENU, self.OnPortSettings, id=ID_SETTINGS)
-        self.Bind(wx.EVT_MENU, self.OnTermSettings, id=ID_TERM)
-        self.text_ctrl_output.Bind(wx.EVT_CHAR, self.OnKey)
-        self.Bind(wx.EVT_CHAR_HOOK, self.OnKey)
-        self.Bind(EVT_SERIALRX, self.OnSerialRead)
-        self.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnClear), id=ID_CLEAR)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnSaveAs), id=ID_SAVEAS)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnExit), id=ID_EXIT)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnPortSettings), id=ID_SETTINGS)
+        self.Bind(wx.EVT_MENU, self.Timed(self.OnTermSettings), id=ID_TERM)
+        self.text_ctrl_output.Bind(wx.EVT_CHAR, self.Timed(self.OnKey))
+        self.Bind(wx.EVT_CHAR_HOOK, self.Timed(self.OnKey))
+        self.Bind(EVT_DOWNLOADPROGRESS, self.Timed(self.OnDownloadProgress))
+        self.Bind(EVT_DOWNLOADDONE, self.Timed(self.OnDownloadDone))
+        self.Bind(EVT_SCRIPTDONE, self.Timed(self.OnScriptDone))
+        self.Bind(EVT_MEMORYREADDONE, self.Timed(self.OnMemoryReadDone))
+        self.button_cancel_download.Bind(wx.EVT_BUTTON, self.Timed(self.OnCancelDownload))
+        self.Bind(wx.EVT_CLOSE, self.Timed(self.OnClose))
 
     def OnExit(self, event):  # wxGlade: TerminalFrame.<event_handler>
         """Menu point Exit"""
@@ -530,8 +1002,17 @@ class TerminalFrame(wx.Frame):
 
     def OnClose(self, event):
         """Called on application shutdown."""
+        if self.download is not None:   # stop the download, releases the relay
+            self.download.cancel.set()
+            self.download.join(10)
         self.StopThread()               # stop reader thread
+        self.flushTimer.Stop()
         self.serial.close()             # cleanup
+        self.OnFlushOutput(None)
+        if self.log is not None:
+            self.log.close()
+        if self.capture is not None:
+            self.capture.close()
         self.Destroy()                  # close windows, exit app
 
     def OnSaveAs(self, event):  # wxGlade: TerminalFrame.<event_handler>
@@ -542,44 +1023,314 @@ class TerminalFrame(wx.Frame):
                 ".",
                 "",
                 "Text File|*.txt|All Files|*",
-                wx.SAVE) as dlg:
+                wx.FD_SAVE) as dlg:
             if dlg.ShowModal() == wx.ID_OK:
                 filename = dlg.GetPath()
                 with codecs.open(filename, 'w', encoding='utf-8') as f:
-                    text = self.text_ctrl_output.GetValue().encode("utf-8")
-                    f.write(text)
+                    f.write(self.text_ctrl_output.GetValue())
+
+    def OnLog(self, event):
+        """\
+        Menu point Log to File. Everything shown in the output window from
+        now on is appended to the file, also what has scrolled out of the
+        window. Unchecking the menu point closes the file.
+        """
+        if self.log is not None:
+            self.OnFlushOutput(None)
+            self.log.close()
+            self.log = None
+        if event.IsChecked():
+            with wx.FileDialog(
+                    None,
+                    "Log to File...",
+                    ".",
+                    "",
+                    "Text File|*.txt|All Files|*",
+                    wx.FD_SAVE) as dlg:
+                if dlg.ShowModal() == wx.ID_OK:
+                    try:
+                        self.log = codecs.open(dlg.GetPath(), 'a', encoding='utf-8')
+                    except OSError as e:
+                        with wx.MessageDialog(self, str(e), "Log File Error", wx.OK | wx.ICON_ERROR) as errDlg:
+                            errDlg.ShowModal()
+        self.frame_terminal_menubar.Check(ID_LOG, self.log is not None)
+
+    def OnCapture(self, event):
+        """\
+        Menu point Capture Session. Every byte sent and received from now on
+        is logged with its time, for romEmuReplay.py. Unchecking the menu
+        point closes the file.
+        """
+        if self.capture is not None:
+            if self.scheduler is not None:
+                self.scheduler.capture = None
+            self.capture.close()
+            self.capture = None
+        if event.IsChecked():
+            with wx.FileDialog(
+                    None,
+                    "Capture Session...",
+                    ".",
+                    "",
+                    "Capture File|*.cap|All Files|*",
+                    wx.FD_SAVE) as dlg:
+                if dlg.ShowModal() == wx.ID_OK:
+                    try:
+                        self.capture = romEmuCapture.CaptureWriter(dlg.GetPath(), self.serial.baudrate)
+                    except OSError as e:
+                        with wx.MessageDialog(self, str(e), "Capture File Error", wx.OK | wx.ICON_ERROR) as errDlg:
+                            errDlg.ShowModal()
+        if self.scheduler is not None:
+            self.scheduler.capture = self.capture
+        self.frame_terminal_menubar.Check(ID_CAPTURE, self.capture is not None)
+
+    def Timed(self, handler):
+        """handler, with its time added to the profile while Profile is checked."""
+        def timed(event):
+            profiler = self.profiler
+            if profiler is None:
+                return handler(event)
+            return profiler.timed(handler.__name__, handler, event)
+        return timed
+
+    def OnProfile(self, event):
+        """\
+        Menu point Profile. While checked, the time from the read of a
+        chunk to its display, the event loop lag and the time of every
+        handler are collected and shown in the status bar; unchecking shows
+        the summary in the output window.
+        """
+        if event.IsChecked():
+            self.profiler = self.profile = romEmuProfile.GuiProfile()
+            self.lastFlush = None
+            self.profileStatus = self.profiler.status()
+        elif self.profiler is not None:
+            profiler, self.profiler = self.profiler, None
+            profiler.finish()
+            self.portStatus = None      # redraw the status bar without the profile
+            self.WriteText(LF.join(profiler.summary()) + LF)
+
+    def OnCProfile(self, event):
+        """Run cProfile on the GUI thread for a number of seconds and save it, checks Profile."""
+        if self.profiler is not None and self.profiler.cprofile is not None:
+            return
+        seconds = wx.GetNumberFromUser("Profile the GUI thread for", "Seconds", "Run cProfile",
+                                       CPROFILETIME, 1, 600, self)
+        if seconds < 0:
+            return
+        with wx.FileDialog(
+                None,
+                "Save cProfile As...",
+                ".",
+                "",
+                "Profile File|*.prof|All Files|*",
+                wx.FD_SAVE) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            path = dlg.GetPath()
+        if self.profiler is None:
+            self.frame_terminal_menubar.Check(ID_PROFILE, True)
+            self.profiler = self.profile = romEmuProfile.GuiProfile()
+            self.lastFlush = None
+        profiler = self.profiler
+        profiler.startCProfile()
+        wx.CallLater(seconds * 1000, self.OnCProfileDone, profiler, path)
+
+    def OnCProfileDone(self, profiler, path):
+        try:
+            lines = profiler.stopCProfile(path)
+        except OSError as e:
+            lines = [path + ": " + str(e)]
+        self.WriteText(LF.join(["cProfile written to " + path] + lines) + LF)
+
+    def OnSaveProfile(self, event):
+        """Save the last profile, with Profile checked, as JSON or CSV."""
+        if self.profile is None:
+            with wx.MessageDialog(self, "No profile recorded, check Profile first",
+                                  "Save Profile", wx.OK | wx.ICON_INFORMATION) as dlg:
+                dlg.ShowModal()
+            return
+        with wx.FileDialog(
+                None,
+                "Save Profile As...",
+                ".",
+                "",
+                "JSON File|*.json|CSV File|*.csv",
+                wx.FD_SAVE) as dlg:
+            if dlg.ShowModal() == wx.ID_OK:
+                try:
+                    self.profile.save(dlg.GetPath())
+                except OSError as e:
+                    with wx.MessageDialog(self, str(e), "Profile File Error", wx.OK | wx.ICON_ERROR) as errDlg:
+                        errDlg.ShowModal()
+
+    def OnSaveTrace(self, event):
+        """Save the timing of the last download, with Timing checked, as JSON or CSV."""
+        if self.trace is None:
+            with wx.MessageDialog(self, "No timing recorded, check Timing before the download",
+                                  "Save Trace", wx.OK | wx.ICON_INFORMATION) as dlg:
+                dlg.ShowModal()
+            return
+        with wx.FileDialog(
+                None,
+                "Save Trace As...",
+                ".",
+                "",
+                "JSON File|*.json|CSV File|*.csv",
+                wx.FD_SAVE) as dlg:
+            if dlg.ShowModal() == wx.ID_OK:
+                self.trace.save(dlg.GetPath())
 
     def OnClear(self, event):  # wxGlade: TerminalFrame.<event_handler>
         """Clear contents of output window."""
         self.text_ctrl_output.Clear()
         
+    def PortOpen(self, report=True):
+        """\
+        True when the port is open. Otherwise, after a failed open in the
+        Port Settings, report says so in a message box.
+        """
+        if self.scheduler is not None:
+            return True
+        if report:
+            with wx.MessageDialog(self, "The port is not open, choose one in the Port Settings",
+                                  "Port Error", wx.OK | wx.ICON_ERROR) as dlg:
+                dlg.ShowModal()
+        return False
+
     def OnDownload(self, event):
-        """ Open a file"""
+        """ Open a file and start the download in a DownloadThread"""
+        if self.download is not None or not self.PortOpen():
+            return
         self.dirname = ''
         dlg = wx.FileDialog(self, "Choose a file", self.dirname, "", "*.*", wx.FD_OPEN)
         
         if dlg.ShowModal() == wx.ID_OK:
-            if RESETSW:
-                self.serial.write(("R1" + LF).encode())
-                time.sleep(resetDelay)
-                self.text_ctrl_output.AppendText(("Relay on" + LF).encode())
             self.filename = dlg.GetFilename()
             self.dirname = dlg.GetDirectory()
-            f = open(os.path.join(self.dirname, self.filename), 'r')
-            for line in f.readlines():
-                print(line.strip())
-                lineStrip = line.strip()
-                self.serial.write((lineStrip + LF).encode())
-                time.sleep(sendDelay)
-            f.close()
-            byteStr = ("File: '" + self.dirname + "/" + self.filename + "' downloaded.\r\n").encode()
-            self.text_ctrl_output.AppendText(byteStr)
-            if RESETSW:
-                self.serial.write(("R0" + LF).encode())
-                time.sleep(resetDelay)
-                self.text_ctrl_output.AppendText(("Relay off" + LF).encode())
+            try:
+                image = romEmuImage.loadFile(os.path.join(self.dirname, self.filename))
+                lines = romEmuImage.uploadRecords(image, self.frame_terminal_menubar.IsChecked(ID_REPACK))
+                plan = None
+                trace = None
+                if self.frame_terminal_menubar.IsChecked(ID_TIMING):
+                    trace = romEmuTrace.UploadTrace(self.serial.baudrate)
+                if self.frame_terminal_menubar.IsChecked(ID_FILLCOPY):
+                    plan = romEmuPlan.planUpload(image, repack=self.frame_terminal_menubar.IsChecked(ID_REPACK))
+            except (OSError, romEmuImage.ImageError) as e:
+                with wx.MessageDialog(self, str(e), "File Error", wx.OK | wx.ICON_ERROR) as errDlg:
+                    errDlg.ShowModal()
+                dlg.Destroy()
+                return
+            # record replies are matched by address, typed lines may go in between
+            binary = self.frame_terminal_menubar.IsChecked(ID_BINARY)
+            self.download = DownloadThread(self, self.scheduler.open(interleave=not binary), lines,
+                                           full=not self.frame_terminal_menubar.IsChecked(ID_DELTA),
+                                           binary=binary, plan=plan, trace=trace)
+            self.StartBackground(len(lines), "Starting download...")
         dlg.Destroy()
 
+    def OnRunScript(self, event):
+        """Open a command script and run it in a ScriptThread."""
+        if self.download is not None or not self.PortOpen():
+            return
+        with wx.FileDialog(self, "Choose a script", "", "", "Script|*.txt;*.scr|All Files|*",
+                           wx.FD_OPEN) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            self.scriptname = dlg.GetPath()
+        try:
+            commands = romEmuScript.loadScript(self.scriptname)
+        except (OSError, romEmuScript.ScriptError) as e:
+            with wx.MessageDialog(self, str(e), "Script Error", wx.OK | wx.ICON_ERROR) as errDlg:
+                errDlg.ShowModal()
+            return
+        self.download = ScriptThread(self, self.scheduler.open(), commands)
+        self.StartBackground(len(commands), "Starting script...")
+
+    def OnMemory(self, event):
+        """Show the memory view."""
+        if self.memoryFrame is None:
+            self.memoryFrame = MemoryFrame(self, self.memory)
+        self.memoryFrame.Show()
+        self.memoryFrame.Raise()
+
+    def ReadMemory(self, start, end):
+        """Read start up to end into the memory view in a MemoryReadThread."""
+        if self.download is not None or not self.PortOpen():
+            return
+        self.download = MemoryReadThread(self, self.scheduler.open(), self.memory, start, end)
+        self.StartBackground((end - start + MEMORYCHUNK - 1) // MEMORYCHUNK, "Reading memory...")
+
+    def OnMemoryReadDone(self, event):
+        """The memory read thread has finished."""
+        self.EndBackground()
+        if event.error is not None:
+            self.WriteText("Memory read error: " + event.error + LF)
+        else:
+            self.WriteText("Memory %04X-%04X read in %.1f s%s" % (
+                event.start, event.end - 1, event.elapsed,
+                ", failed at " + " ".join("%04X" % a for a in event.failed) if event.failed else "") + LF)
+
+    def StartBackground(self, total, label):
+        """Show the progress bar and start the download or script thread in self.download."""
+        self.gauge_download.SetRange(max(1, total))
+        self.gauge_download.SetValue(0)
+        self.label_download.SetLabel(label)
+        self.button_cancel_download.Enable(True)
+        self.panel_download.Show()
+        self.Layout()
+        self.frame_terminal_menubar.Enable(ID_DOWNLOAD, False)
+        self.frame_terminal_menubar.Enable(ID_SCRIPT, False)
+        self.frame_terminal_menubar.Enable(ID_SETTINGS, False)
+        self.download.start()
+
+    def EndBackground(self):
+        """The download or script thread has finished and closed its session."""
+        self.download.join()
+        self.download = None
+        self.panel_download.Hide()
+        self.Layout()
+        self.frame_terminal_menubar.Enable(ID_DOWNLOAD, True)
+        self.frame_terminal_menubar.Enable(ID_SCRIPT, True)
+        self.frame_terminal_menubar.Enable(ID_SETTINGS, True)
+
+    def OnDownloadProgress(self, event):
+        """Show the progress of the download or script thread."""
+        self.gauge_download.SetRange(max(1, event.total))
+        self.gauge_download.SetValue(min(event.sent, event.total))
+        self.label_download.SetLabel("{}/{} {}, {:.1f}/s, ETA {:.0f} s, {} errors".format(
+            event.sent, event.total, event.unit, event.rate, event.eta, event.errors))
+        self.panel_download.Layout()
+
+    def OnCancelDownload(self, event):
+        """Stop the download or the script after the records or commands in flight."""
+        if self.download is not None:
+            self.download.cancel.set()
+            self.button_cancel_download.Enable(False)
+            self.label_download.SetLabel("Cancelling...")
+
+    def OnDownloadDone(self, event):
+        """The download thread has finished."""
+        if self.download.trace is not None:
+            self.trace = self.download.trace
+        self.EndBackground()
+        if event.error is not None:
+            self.WriteText("Download error: " + event.error + LF)
+        elif event.result is not None:
+            self.WriteText(event.result.summary() + LF)
+            if not event.result.cancelled:
+                self.WriteText("File: '" + self.dirname + "/" + self.filename + "' downloaded." + LF)
+
+    def OnScriptDone(self, event):
+        """The script thread has finished."""
+        self.EndBackground()
+        if event.error is not None:
+            self.WriteText("Script error: " + event.error + LF)
+        elif event.result is not None:
+            self.WriteText(event.result.summary() + LF)
+            if event.result.ok():
+                self.WriteText("Script: '" + self.scriptname + "' done." + LF)
 
     def OnPortSettings(self, event):  # wxGlade: TerminalFrame.<event_handler>
         """
@@ -602,7 +1353,7 @@ class TerminalFrame(wx.Frame):
             # open port if not called on startup, open it on startup and OK too
             if result == wx.ID_OK or event is not None:
                 try:
-                    self.serial.open()
+                    self.OpenPort()
                 except serial.SerialException as e:
                     with wx.MessageDialog(self, str(e), "Serial Port Error", wx.OK | wx.ICON_ERROR)as dlg:
                         dlg.ShowModal()
@@ -623,6 +1374,20 @@ class TerminalFrame(wx.Frame):
                 self.alive.clear()
                 ok = True
 
+    def OpenPort(self):
+        """
+        Open the port. Without reset on connect DTR stays asserted, also
+        after closing, so a running board keeps running.
+        """
+        reset = self.settings.resetOnConnect
+        self.serial.rts = True
+        # Windows asserts DTR on open only when it is set; Linux always does
+        self.serial.dtr = reset or romEmuConnect.termios is not None
+        self.serial.open()
+        romEmuConnect.setHangup(self.serial, reset)
+        if reset:
+            romEmuConnect.pulseDtr(self.serial)
+
     def OnTermSettings(self, event):  # wxGlade: TerminalFrame.<event_handler>
         """\
         Menu point Terminal Settings. Show the settings dialog
@@ -634,41 +1399,95 @@ class TerminalFrame(wx.Frame):
 
     def OnKey(self, event):
         """\
-        Key event handler. If the key is in the ASCII range, write it to the
+        Key event handler. If the key is in the ASCII range, queue it for the
         serial port. Newline handling and local echo is also done here.
+        During a download the scheduler holds the text until a line feed.
         """
+        if not self.PortOpen(report=False):
+            event.Skip()
+            return
         code = event.GetUnicodeKey()
         if code < 256:   # XXX bug in some versions of wx returning only capital letters
             code = event.GetKeyCode()
         if code == 13:                      # is it a newline? (check for CR which is the RETURN key)
             if self.settings.echo:          # do echo if needed 
-                self.text_ctrl_output.AppendText('\n')
+                self.WriteText('\n')
             if self.settings.newline == NEWLINE_CR:  # these go to the ROM Emu
-                self.serial.write(b'\r')     # send CR
+                self.scheduler.send(b'\r')     # send CR
             elif self.settings.newline == NEWLINE_LF:
-                self.serial.write(b'\n')     # send LF
+                self.scheduler.send(b'\n')     # send LF
             elif self.settings.newline == NEWLINE_CRLF:
-                self.serial.write(b'\r\n')   # send CR+LF
+                self.scheduler.send(b'\r\n')   # send CR+LF
         else:
             char = unichr(code)
             if self.settings.echo:          # do echo if needed
                 self.WriteText(char)
-            self.serial.write(char.encode('UTF-8', 'replace'))         # send the character
+            self.scheduler.send(char.encode('UTF-8', 'replace'))       # send the character
         event.StopPropagation()
 
     def WriteText(self, text):
-        if self.settings.unprintable:
-            text = ''.join([c if (c >= ' ' and c != '\x7f') else unichr(0x2400 + ord(c)) for c in text])
-        self.text_ctrl_output.AppendText(text)
+        """Queue text for the output window, may be called from any thread."""
+        self.output.put(text)
 
-    def OnSerialRead(self, event):
-        """Handle input from the serial port."""
-        self.WriteText(event.data.decode('UTF-8', 'replace').replace('\r', '')) # remove \r from RomEmu output
+    def OnFlushOutput(self, event):
+        """\
+        Timer handler. Appends the queued text to the output window in one
+        go and removes the oldest text beyond the scrollback size. Shows
+        the queues of the port scheduler in the status bar, and while
+        profiling the main figures of the profile.
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            now = time.monotonic()
+            if self.lastFlush is not None:
+                profiler.add('loop', max(0.0, now - self.lastFlush - FLUSHINTERVAL / 1000.0))
+            self.lastFlush = now
+            if now - self.profileShown >= PROFILESTATUS:
+                self.profileShown = now
+                self.profileStatus = profiler.status()
+        status = self.scheduler.summary() if self.scheduler is not None else "Port not open"
+        if profiler is not None:
+            status = (status + "; " if status else "") + self.profileStatus
+        if status != self.portStatus:
+            self.portStatus = status
+            self.statusbar.SetStatusText(status)
+        text, stamps = self.output.take()
+        if not text:
+            return
+        if self.log is not None:
+            self.log.write(text)
+            self.log.flush()
+        if self.settings.unprintable:
+            if profiler is not None:
+                text = profiler.timed('translate', text.translate, UNPRINTABLE)
+            else:
+                text = text.translate(UNPRINTABLE)
+        limit = self.settings.scrollback * 1024
+        if len(text) >= limit:
+            self.text_ctrl_output.Clear()
+            text = text[-limit:]
+        if profiler is not None:
+            profiler.timed('append', self.text_ctrl_output.AppendText, text)
+            shown = time.monotonic()
+            for stamp in stamps:
+                profiler.add('screen', shown - stamp)
+        else:
+            self.text_ctrl_output.AppendText(text)
+        last = self.text_ctrl_output.GetLastPosition()
+        if last > limit:
+            # remove an extra tenth, so this is not done on every update, up to a line end
+            cut = last - limit + limit // 10
+            newline = self.text_ctrl_output.GetRange(cut, min(cut + 256, last)).find('\n')
+            if newline >= 0:
+                cut += newline + 1
+            self.text_ctrl_output.Remove(0, cut)
         
     def OnHelp(self, event):
         """Sends a 'H' to the ROM Emulator."""
+        if not self.PortOpen():
+            return
         helpString = 'H' + LF
-        self.serial.write(helpString.encode('UTF-8', 'replace'))
+        self.scheduler.send(helpString.encode('UTF-8', 'replace'))
 
     def OnAbout(self,e):
         # A message dialog box with an OK button. wx.OK is a standard ID in wxWidgets.
@@ -684,28 +1503,40 @@ https://electrickery.nl/digaud/arduino/romEmu/
         dlg.ShowModal() # Show it
         dlg.Destroy() # finally destroy it when finished.
 
-    def ComPortThread(self):
+    def OnReceive(self, b):
         """\
-        Thread that handles the incoming traffic. Does the basic input
-        transformation (newlines) and generates an SerialRxEvent
+        Called in the receiver thread of the scheduler with the incoming
+        traffic outside sessions. Does the basic input transformation
+        (newlines) and queues the text for the output window
         """
-        while self.alive.is_set():
-            b = self.serial.read(self.serial.in_waiting or 1)
-            if b:
-                # newline transformation
-                if self.settings.newline == NEWLINE_CR:
-                    b = b.replace(b'\r', b'\n')
-                elif self.settings.newline == NEWLINE_LF:
-                    pass
-                elif self.settings.newline == NEWLINE_CRLF:
-                    b = b.replace(b'\r\n', b'\n')
-                wx.PostEvent(self, SerialRxEvent(data=b))
+        profiler = self.profiler
+        stamp = time.monotonic() if profiler is not None else None
+        # newline transformation
+        if self.settings.newline == NEWLINE_CR:
+            b = b.replace(b'\r', b'\n')
+        elif self.settings.newline == NEWLINE_LF:
+            pass
+        elif self.settings.newline == NEWLINE_CRLF:
+            b = b.replace(b'\r\n', b'\n')
+        text = self.decoder.decode(b).replace('\r', '')  # remove \r from RomEmu output
+        if profiler is not None:
+            profiler.add('decode', time.monotonic() - stamp)
+        self.output.put(text, stamp)
+        self.memory.feed(text)      # dumps typed in the terminal fill the memory view
 
     def OnRTS(self, event):  # wxGlade: TerminalFrame.<event_handler>
-        self.serial.rts = event.IsChecked()
+        checked = event.IsChecked()
+        if not self.PortOpen():
+            self.frame_terminal_menubar.Check(ID_RTS, not checked)
+            return
+        self.scheduler.control(lambda ser: setattr(ser, 'rts', checked))
 
     def OnDTR(self, event):  # wxGlade: TerminalFrame.<event_handler>
-        self.serial.dtr = event.IsChecked()
+        checked = event.IsChecked()
+        if not self.PortOpen():
+            self.frame_terminal_menubar.Check(ID_DTR, not checked)
+            return
+        self.scheduler.control(lambda ser: setattr(ser, 'dtr', checked))
 
 # end of class TerminalFrame
 
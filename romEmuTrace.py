@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#
+# Timing of uploads to the ROM Emulator.
+#
+# An UploadTrace is handed to the uploaders in romEmuUpload.py. For every
+# record or frame it keeps the time it was written, how long the write
+# took, when its reply came and what the reply was. At the end it shows
+# a latency histogram and where the time went (writing, sleeping in the
+# legacy --delay mode, waiting for replies), and it can write the trace
+# as JSON or CSV to compare pacing settings and firmware versions.
+
+import csv
+import json
+import time
+
+BUCKETS = [0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500, 1.0]     # seconds
+BARWIDTH = 40
+FIELDS = ['seq', 'address', 'kind', 'dataBytes', 'wireBytes', 'sent', 'writeTime', 'replied',
+          'latency', 'result']
+
+
+class TraceEntry:
+    def __init__(self, seq, address, kind, dataBytes, wireBytes, sent, writeTime):
+        self.seq = seq
+        self.address = address
+        self.kind = kind            # 'record', 'frame', 'fill', 'copy'
+        self.dataBytes = dataBytes
+        self.wireBytes = wireBytes
+        self.sent = sent            # seconds since the start of the trace
+        self.writeTime = writeTime  # duration of ser.write()
+        self.replied = None
+        self.latency = None
+        self.result = None          # 'ok', 'sumcheck', 'overflow', 'nak', 'timeout', 'noreply'
+
+    def asDict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+
+class UploadTrace:
+    """Per record timing of one or more uploads over a line of baudrate."""
+
+    def __init__(self, baudrate=9600):
+        self.baudrate = baudrate
+        self.entries = []
+        self.sleepTime = 0.0
+        self.start = time.monotonic()
+        self.end = None
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def write(self, ser, data, address=None, kind='record', dataBytes=0):
+        """ser.write(data), timed; returns the TraceEntry for replied()."""
+        sent = self.now()
+        ser.write(data)
+        entry = TraceEntry(len(self.entries), address, kind, dataBytes, len(data), sent, self.now() - sent)
+        self.entries.append(entry)
+        return entry
+
+    def replied(self, entry, result):
+        entry.replied = self.now()
+        entry.result = result
+        if result not in ('timeout', 'noreply'):
+            entry.latency = entry.replied - entry.sent
+
+    def sleep(self, seconds):
+        """time.sleep(), counted as pacing time."""
+        time.sleep(seconds)
+        self.sleepTime += seconds
+
+    def finish(self):
+        self.end = self.now()
+
+    # reports
+
+    def latencies(self):
+        return sorted(entry.latency for entry in self.entries if entry.latency is not None)
+
+    def histogram(self):
+        latencies = self.latencies()
+        if not latencies:
+            return ["No replies"]
+        counts = [0] * (len(BUCKETS) + 1)
+        for latency in latencies:
+            bucket = 0
+            while bucket < len(BUCKETS) and latency >= BUCKETS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        lines = ["Reply latency:"]
+        lower = 0.0
+        for bucket, count in enumerate(counts):
+            upper = BUCKETS[bucket] if bucket < len(BUCKETS) else None
+            label = "{:>5.0f}-{:<5}ms".format(lower * 1000, "" if upper is None else "%.0f" % (upper * 1000))
+            bar = "#" * ((count * BARWIDTH + max(counts) - 1) // max(counts))
+            lines.append("  {} {:>6} {}".format(label, count, bar))
+            lower = upper
+        return lines
+
+    def percentile(self, fraction):
+        latencies = self.latencies()
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def summary(self):
+        end = self.end if self.end is not None else self.now()
+        dataBytes = sum(entry.dataBytes for entry in self.entries)
+        wireBytes = sum(entry.wireBytes for entry in self.entries)
+        writeTime = sum(entry.writeTime for entry in self.entries)
+        results = {}
+        for entry in self.entries:
+            results[entry.result] = results.get(entry.result, 0) + 1
+        # time the bytes need on the line to the emulator, 10 bits per byte;
+        # the replies come back at the same time
+        wireTime = wireBytes * 10.0 / self.baudrate
+        lines = [
+            "{} records, {} data bytes, {} on the wire ({:.0f}% overhead) in {:.2f} s".format(
+                len(self.entries), dataBytes, wireBytes,
+                100.0 * (wireBytes - dataBytes) / wireBytes if wireBytes else 0.0, end),
+            "Throughput {:.0f} data bytes/s, line use {:.0f}% of {} baud".format(
+                dataBytes / end if end > 0 else 0.0,
+                100.0 * wireBytes * 10 / self.baudrate / end if end > 0 else 0.0, self.baudrate),
+            "Time: {:.2f} s writing, {:.2f} s in fixed delays, {:.2f} s on the line, {:.2f} s other".format(
+                writeTime, self.sleepTime, wireTime, max(0.0, end - writeTime - self.sleepTime - wireTime)),
+            "Latency: median {:.1f} ms, 90% {:.1f} ms, 99% {:.1f} ms, max {:.1f} ms".format(
+                self.percentile(0.5) * 1000, self.percentile(0.9) * 1000, self.percentile(0.99) * 1000,
+                self.percentile(1.0) * 1000),
+            "Replies: " + ", ".join("{} {}".format(count, result or "none")
+                                    for result, count in sorted(results.items(), key=lambda r: str(r[0]))),
+        ]
+        return lines + self.histogram()
+
+    def writeJson(self, path):
+        with open(path, 'w') as f:
+            json.dump({"baudrate": self.baudrate, "sleepTime": self.sleepTime, "elapsed": self.end,
+                       "entries": [entry.asDict() for entry in self.entries]}, f, indent=1)
+
+    def writeCsv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for entry in self.entries:
+                writer.writerow(entry.asDict())
+
+    def save(self, path):
+        """Write the trace as CSV for a .csv path, as JSON otherwise."""
+        if path.lower().endswith(".csv"):
+            self.writeCsv(path)
+        else:
+            self.writeJson(path)
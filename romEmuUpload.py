@@ -0,0 +1,582 @@
+#!/usr/bin/python3
+#
+# Upload engine for the ROM Emulator.
+#
+# Records are paced by the replies of the ROMemu firmware ("xxxx Ok." or
+# "Sumcheck incorrect for xxxx") instead of fixed delays. A configurable
+# number of records is kept in flight. The amount of unacknowledged data
+# is limited by the Arduino receive buffer plus the firmware command
+# buffer (SERIALBUFSIZE in ROMemu.ino), so the board never drops bytes.
+#
+# Firmware v0.12.0 and later also accept binary frames after the X
+# command: STX, length, address (MSB first), the raw data bytes and a
+# CRC-16/CCITT over length, address and data. Every frame is answered
+# with a single ACK or NAK byte; an empty frame returns to command mode.
+#
+# Lost, garbled and rejected records are sent again, up to RETRIES times
+# each: every reply is matched to its record by the address in it, and
+# after a buffer overflow the firmware is resynchronised before the
+# records in flight are repeated. A larger window stays safe on a noisy
+# line.
+
+import binascii
+import collections
+import time
+
+import romEmuImage
+
+LF = "\r\n"
+
+SERIALBUFSIZE = 90      # command buffer in ROMemu.ino
+RXBUFSIZE     = 64      # receive buffer of the Arduino Mega HardwareSerial
+INFLIGHTBYTES = SERIALBUFSIZE + RXBUFSIZE
+DEFAULTWINDOW = 2
+CHECKSUMTIME  = 100e-6  # seconds per byte for K, with margin
+FILLTIME      = 50e-6   # seconds per byte for N, with margin
+COPYTIME      = 200e-6  # seconds per byte for C, with margin
+RETRIES       = 3       # resends of one record
+RESYNCTIME    = 0.2     # quiet line after an overflow or a NAK
+
+STX = 0x02
+ACK = 0x06
+NAK = 0x15
+MAXFRAMEDATA = 56       # a frame of 62 bytes fits in the Arduino receive buffer
+BINARYREPLY  = "Binary mode Ok."
+
+REPLY_OK       = 'ok'
+REPLY_SUMCHECK = 'sumcheck'
+REPLY_OVERFLOW = 'overflow'
+REPLY_UNSUPPORTED = 'unsupported'
+
+
+def classifyReply(reply):
+    """Return the kind of a firmware reply line, None if it is not a record reply."""
+    if reply.endswith(" Ok."):
+        return REPLY_OK
+    if reply.startswith("Sumcheck incorrect"):
+        return REPLY_SUMCHECK
+    if reply.startswith("Serial buffer overflow"):
+        return REPLY_OVERFLOW
+    if reply.endswith(" unsupported"):
+        return REPLY_UNSUPPORTED        # a record that lost its ':' or 'S'
+    return None
+
+
+def expectsReply(record):
+    """True if the firmware answers this record with an Ok or Sumcheck line."""
+    if record.startswith(':'):
+        return record[7:9] == "00"          # only data records are answered
+    if record[:2].upper() in ("S1", "S9"):
+        return True
+    return False
+
+
+def recordDataSize(record):
+    """Number of data bytes carried by a hex-intel or S1 record."""
+    try:
+        if record.startswith(':') and record[7:9] == "00":
+            return int(record[1:3], 16)
+        if record[:2].upper() == "S1":
+            return int(record[2:4], 16) - 3
+    except ValueError:
+        pass
+    return 0
+
+
+def recordAddress(record):
+    """Address field of a hex-intel or S-record, None if there is none."""
+    try:
+        if record.startswith(':'):
+            return int(record[3:7], 16)
+        if record[:1].upper() == 'S':
+            return int(record[4:8], 16)
+    except ValueError:
+        pass
+    return None
+
+
+def timedWrite(ser, data, trace=None, address=None, kind='record', dataBytes=0):
+    """ser.write(data), recorded in trace (a romEmuTrace.UploadTrace) if given."""
+    if trace is None:
+        ser.write(data)
+        return None
+    return trace.write(ser, data, address, kind, dataBytes)
+
+
+def timedReply(trace, entry, result):
+    if trace is not None and entry is not None:
+        trace.replied(entry, result)
+
+
+def parseChecksumReply(reply):
+    """
+    Parse the reply of the K command, e.g.
+    "Checksum block 0h - 7FFFh : FBC9h, 64457, 201, and/or: 25".
+    Returns (start, end, sum, andOr) or None.
+    """
+    if not reply.startswith("Checksum block "):
+        return None
+    try:
+        rangePart, valuePart = reply[len("Checksum block "):].split(" : ")
+        start, end = [int(a.strip().rstrip('h'), 16) for a in rangePart.split(" - ")]
+        values = valuePart.split(", ")
+        return start, end, int(values[1]), int(values[3].split(": ")[1])
+    except (ValueError, IndexError):
+        return None
+
+
+def queryChecksum(ser, start, end):
+    """Send Kssss-eeee and return (sum, andOr) as reported for that range, None on timeout."""
+    timeout = ser.timeout
+    # the firmware reads every byte three times, about 75 us per byte
+    ser.timeout = max(timeout or 0, 1.0 + (end - start + 1) * CHECKSUMTIME)
+    try:
+        ser.write(("K%04X-%04X" % (start, end) + LF).encode())
+        while True:
+            raw = ser.readline()
+            if not raw:
+                return None
+            checksum = parseChecksumReply(raw.decode('ascii', 'replace').strip())
+            if checksum is not None and checksum[:2] == (start, end):
+                return checksum[2], checksum[3]
+    finally:
+        ser.timeout = timeout
+
+
+def fillRange(ser, start, end, value, trace=None):
+    """
+    Fill the RAM from start to end (inclusive) with N. The firmware
+    replies before it fills, so an F is sent after it: its reply shows
+    that the fill is done. Returns False on a timeout.
+    """
+    timeout = ser.timeout
+    ser.timeout = max(timeout or 0, 1.0 + (end - start + 1) * FILLTIME)
+    try:
+        entry = timedWrite(ser, ("N%04X-%04X:%02X" % (start, end, value) + LF + "F" + LF).encode(), trace,
+                           start, 'fill', end - start + 1)
+        while True:
+            raw = ser.readline()
+            if not raw:
+                timedReply(trace, entry, 'timeout')
+                return False
+            if raw.startswith(b"F"):
+                timedReply(trace, entry, REPLY_OK)
+                return True
+    finally:
+        ser.timeout = timeout
+
+
+def copyRange(ser, start, end, target, trace=None):
+    """
+    Copy the RAM from start to end (inclusive) to target with C. Only
+    for ranges that do not overlap: the firmware copies byte by byte and
+    never returns from a copy down from 0000. Returns False on a timeout.
+    """
+    if start == 0 and target <= start:
+        raise ValueError("the firmware does not return from a copy down from 0000")
+    timeout = ser.timeout
+    ser.timeout = max(timeout or 0, 1.0 + (end - start + 1) * COPYTIME)
+    try:
+        entry = timedWrite(ser, ("C%04X-%04X-%04X" % (start, end, target) + LF).encode(), trace,
+                           target, 'copy', end - start + 1)
+        while True:
+            raw = ser.readline()
+            if not raw:
+                timedReply(trace, entry, 'timeout')
+                return False
+            if raw.rstrip().endswith(b"bytes copied"):
+                timedReply(trace, entry, REPLY_OK)
+                return True
+    finally:
+        ser.timeout = timeout
+
+
+class UploadResult:
+    """Counters of one upload, filled by windowedUpload() or binaryUpload()."""
+
+    def __init__(self):
+        self.records   = 0
+        self.dataBytes = 0
+        self.wireBytes = 0
+        self.errors    = 0
+        self.timeouts  = 0
+        self.retransmits = 0
+        self.garbled   = 0              # records answered with an error, or lost
+        self.elapsed   = 0.0
+        self.cancelled = False
+
+    def bytesPerSecond(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.dataBytes / self.elapsed
+
+    def summary(self):
+        return ("{}{} records, {} data bytes ({} on the wire) in {:.2f} s: {:.0f} bytes/s, "
+                "{} errors, {} timeouts, {} resent").format(
+                    "Cancelled after " if self.cancelled else "",
+                    self.records, self.dataBytes, self.wireBytes, self.elapsed,
+                    self.bytesPerSecond(), self.errors, self.timeouts, self.retransmits)
+
+
+def replyAddress(reply):
+    """The address in an Ok or Sumcheck reply, None if it has none."""
+    try:
+        if reply.endswith(" Ok."):
+            return int(reply.split()[0], 16)
+        if reply.startswith("Sumcheck incorrect for "):
+            return int(reply.split()[3], 16)
+    except (ValueError, IndexError):
+        pass
+    return None
+
+
+def resyncOffset(ser, offset, out=print):
+    """
+    Ask the offset with F and set it again when it is not offset: a
+    garbled record may have been taken as an F command. The command
+    buffer must be empty, the caller ends a broken line first. Returns
+    the offset the firmware had, None when F gets no reply.
+    """
+    ser.write(("F" + LF).encode())
+    while True:
+        raw = ser.readline()
+        if not raw:
+            return None
+        reply = raw.decode('ascii', 'replace').strip()
+        if len(reply) == 5 and reply[0] == "F":
+            break
+    try:
+        found = int(reply[1:], 16)
+    except ValueError:
+        found = None
+    if found != offset:
+        out("Offset was %s, set to %04X" % (reply[1:], offset))
+        ser.write(("F%04X" % offset + LF).encode())
+        ser.readline()
+    return found
+
+
+def windowedUpload(ser, records, window=DEFAULTWINDOW, out=print, progress=None, cancel=None, trace=None,
+                   offset=0, retries=RETRIES):
+    """
+    Send the records to the emulator on the open serial port ser, keeping
+    at most window records and INFLIGHTBYTES bytes unacknowledged. Every
+    reply is matched to its record by the address in it (offset is the F
+    offset, subtracted in the Ok replies), or else by the order. Records
+    with a Sumcheck or unsupported reply, records without a reply and
+    those in flight at a timeout are sent again, up to retries times
+    each. After a buffer overflow the firmware is resynchronised: an LF
+    ends the garbled command, the replies are read until the line is
+    quiet, and the offset is checked. ser.timeout bounds the wait for a
+    reply. progress, if given, is called with the UploadResult and the
+    number of records after every reply. Setting the threading.Event
+    cancel stops the upload after the records in flight. trace, a
+    romEmuTrace.UploadTrace, records the timing of every record. Returns
+    the UploadResult.
+    """
+    result = UploadResult()
+    pending = collections.deque((r.strip(), 0) for r in records if r.strip())   # (record, resends)
+    total = len(pending)
+    inFlight = []                       # [record, bytes on the wire, expects reply, trace entry, resends]
+    inFlightBytes = 0
+    silent = 0                          # timeouts in a row
+    start = time.monotonic()
+
+    def expected(item, kind):
+        address = recordAddress(item[0])
+        if address is not None and kind == REPLY_OK:
+            address = (address - offset) & 0xFFFF
+        return address
+
+    def again(items, why):
+        """Put items back in front of the pending records, or give up on them."""
+        for item in reversed(items):
+            timedReply(trace, item[3], why)
+            result.garbled += 1
+            if item[4] >= retries:
+                out("Giving up on " + item[0])
+                if why == 'timeout':
+                    result.timeouts += 1
+                else:
+                    result.errors += 1
+                continue
+            result.retransmits += 1
+            pending.appendleft((item[0], item[4] + 1))
+
+    def retire(count):
+        """Take the first count records off the in-flight list."""
+        nonlocal inFlightBytes
+        taken = inFlight[:count]
+        del inFlight[:count]
+        inFlightBytes -= sum(item[1] for item in taken)
+        return taken
+
+    def handle(reply):
+        """Match a reply; returns False for an overflow."""
+        kind = classifyReply(reply)
+        if kind is None:
+            return True
+        if kind == REPLY_OVERFLOW:
+            return False
+        answered = [i for i, item in enumerate(inFlight) if item[2]]
+        if not answered:
+            return True
+        index = answered[0]
+        address = replyAddress(reply)
+        if address is not None:
+            for i in answered:
+                if expected(inFlight[i], kind) == address:
+                    index = i
+                    break
+        taken = retire(index + 1)
+        # the firmware answers in order: earlier data records without a reply were lost
+        lost = [item for item in taken[:-1] if item[2]]
+        for item in taken[:-1]:
+            if not item[2]:
+                timedReply(trace, item[3], 'noreply')
+        again(lost, 'lost')
+        if kind == REPLY_OK:
+            timedReply(trace, taken[-1][3], kind)
+        else:
+            again(taken[-1:], kind)
+        return True
+
+    def resync():
+        out("Resynchronising")
+        timeout = ser.timeout
+        ser.timeout = RESYNCTIME
+        try:
+            ser.write(LF.encode())
+            while True:
+                raw = ser.readline()
+                if not raw:
+                    break
+                reply = raw.decode('ascii', 'replace').strip()
+                out(reply)
+                handle(reply)
+        finally:
+            ser.timeout = timeout
+        again(retire(len(inFlight)), REPLY_OVERFLOW)
+        if resyncOffset(ser, offset, out) != offset:
+            result.garbled += 1         # records may have gone to other addresses
+
+    while pending or inFlight:
+        if cancel is not None and cancel.is_set() and pending:
+            pending.clear()             # stop sending, collect the replies
+            result.cancelled = True
+        if not any(item[2] for item in inFlight):
+            for item in retire(len(inFlight)):
+                timedReply(trace, item[3], 'noreply')     # nothing left to wait for
+        if pending:
+            record, resends = pending[0]
+            size = len(record) + len(LF)
+            if not inFlight or (len(inFlight) < window and inFlightBytes + size <= INFLIGHTBYTES):
+                pending.popleft()
+                out(record)
+                entry = timedWrite(ser, (record + LF).encode(), trace, recordAddress(record), 'record',
+                                   recordDataSize(record))
+                inFlight.append([record, size, expectsReply(record), entry, resends])
+                inFlightBytes += size
+                if not resends:
+                    result.records += 1
+                    result.dataBytes += recordDataSize(record)
+                result.wireBytes += size
+                if ser.in_waiting == 0:
+                    continue            # keep filling the window
+        if not inFlight:
+            continue
+        raw = ser.readline()
+        if not raw:
+            out("Timeout waiting for reply")
+            silent += 1
+            if silent > retries:
+                out("No replies, upload stopped")
+                result.timeouts += len(inFlight) + len(pending)
+                break
+            again(retire(len(inFlight)), 'timeout')
+            continue
+        silent = 0
+        reply = raw.decode('ascii', 'replace').strip()
+        out(reply)
+        if not handle(reply):
+            resync()
+        if progress is not None:
+            result.elapsed = time.monotonic() - start
+            progress(result, total)
+
+    # every record ends with LF, so the buffer is empty; a changed offset
+    # means records went to other addresses, repair() finds them
+    if silent <= retries:
+        found = resyncOffset(ser, offset, out)
+        if found is None:
+            result.timeouts += 1
+        elif found != offset:
+            result.garbled += 1
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+# binary transfer mode
+
+def binaryFrame(address, data):
+    """The frame for data at address: STX, length, address, data and the CRC."""
+    body = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF]) + bytes(data)
+    crc = binascii.crc_hqx(body, 0xFFFF)
+    return bytes([STX]) + body + bytes([crc >> 8, crc & 0xFF])
+
+
+def recordFrames(records):
+    """
+    The data of the records as (address, data) for binary frames:
+    consecutive records are merged and split again at MAXFRAMEDATA.
+    """
+    blocks = []
+    for record in records:
+        parsed = romEmuImage.parseRecord(record)
+        if parsed is None:
+            continue
+        address, data = parsed
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == address:
+            blocks[-1][1].extend(data)
+        else:
+            blocks.append((address, bytearray(data)))
+    frames = []
+    for address, data in blocks:
+        for offset in range(0, len(data), MAXFRAMEDATA):
+            frames.append(((address + offset) & 0xFFFF, bytes(data[offset:offset + MAXFRAMEDATA])))
+    return frames
+
+
+def enterBinaryMode(ser):
+    """Send X; True if the firmware switched to binary mode, False for older firmware."""
+    ser.write(("X" + LF).encode())
+    while True:
+        raw = ser.readline()
+        if not raw:
+            return False
+        reply = raw.decode('ascii', 'replace').strip()
+        if reply == BINARYREPLY:
+            return True
+        if reply.endswith("unsupported"):
+            return False
+
+
+def leaveBinaryMode(ser):
+    """Send the empty frame that ends binary mode; True when it is acknowledged."""
+    ser.write(binaryFrame(0, b''))
+    while True:
+        reply = ser.read(1)
+        if not reply:
+            return False
+        if reply[0] == ACK:
+            return True
+
+
+def binaryUpload(ser, frames, window=DEFAULTWINDOW, out=print, progress=None, cancel=None, trace=None,
+                 retries=RETRIES):
+    """
+    Send (address, data) frames, see recordFrames(), in binary mode with
+    the same window and INFLIGHTBYTES limits as windowedUpload(). After a
+    NAK or a missing ACK the replies are read until the line is quiet and
+    all frames in flight are sent again, up to retries times each: a
+    garbled length byte can swallow the next frame, so the ACKs that
+    follow cannot be trusted. Frames that still fail count as errors
+    (NAK) or timeouts. Returns the UploadResult.
+    """
+    result = UploadResult()
+    pending = collections.deque((address, data, 0) for address, data in frames)
+    inFlight = []                       # (address, data, bytes on the wire, trace entry, resends)
+    inFlightBytes = 0
+    silent = 0
+    start = time.monotonic()
+
+    def again(why):
+        nonlocal inFlightBytes
+        timeout = ser.timeout
+        ser.timeout = RESYNCTIME
+        try:
+            while ser.read(64):
+                pass                    # the late ACKs and the NAK of a broken frame
+        finally:
+            ser.timeout = timeout
+        for address, data, size, entry, resends in reversed(inFlight):
+            timedReply(trace, entry, why)
+            if resends >= retries:
+                out("Giving up on %04X" % address)
+                if why == 'timeout':
+                    result.timeouts += 1
+                else:
+                    result.errors += 1
+                continue
+            result.retransmits += 1
+            pending.appendleft((address, data, resends + 1))
+        inFlight.clear()
+        inFlightBytes = 0
+
+    while pending or inFlight:
+        if cancel is not None and cancel.is_set() and pending:
+            pending.clear()             # stop sending, collect the replies
+            result.cancelled = True
+        if pending:
+            address, data, resends = pending[0]
+            frame = binaryFrame(address, data)
+            if not inFlight or (len(inFlight) < window and inFlightBytes + len(frame) <= INFLIGHTBYTES):
+                pending.popleft()
+                entry = timedWrite(ser, frame, trace, address, 'frame', len(data))
+                inFlight.append((address, data, len(frame), entry, resends))
+                inFlightBytes += len(frame)
+                if not resends:
+                    result.records += 1
+                    result.dataBytes += len(data)
+                result.wireBytes += len(frame)
+                if ser.in_waiting == 0:
+                    continue            # keep filling the window
+        if not inFlight:
+            continue
+        reply = ser.read(1)
+        if reply and reply[0] not in (ACK, NAK):
+            continue                    # not part of the binary protocol
+        if not reply:
+            out("Timeout waiting for ACK of %04X" % inFlight[0][0])
+            silent += 1
+            if silent > retries:
+                out("No replies, upload stopped")
+                result.timeouts += len(inFlight) + len(pending)
+                break
+            again('timeout')
+            continue
+        silent = 0
+        if reply[0] == NAK:
+            out("NAK for %04X" % inFlight[0][0])
+            again('nak')
+            continue
+        address, data, size, entry, resends = inFlight.pop(0)
+        inFlightBytes -= size
+        timedReply(trace, entry, REPLY_OK)
+        if progress is not None:
+            result.elapsed = time.monotonic() - start
+            progress(result, len(frames))
+
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+def sendRecords(ser, records, window=DEFAULTWINDOW, out=print, progress=None, cancel=None, binary=False,
+                trace=None, offset=0, retries=RETRIES):
+    """
+    Send records with windowedUpload(), or as binary frames with
+    binaryUpload() when binary is set and the firmware supports it.
+    offset is the F offset the firmware has set.
+    """
+    if binary and enterBinaryMode(ser):
+        out("Binary transfer")
+        result = binaryUpload(ser, recordFrames(records), window=window, out=out, progress=progress,
+                              cancel=cancel, trace=trace, retries=retries)
+        if not leaveBinaryMode(ser):
+            out("No ACK for the end frame")
+            result.timeouts += 1
+        return result
+    if binary:
+        out("Binary transfer not supported by the firmware, sending records")
+    return windowedUpload(ser, records, window=window, out=out, progress=progress, cancel=cancel,
+                          trace=trace, offset=offset, retries=retries)
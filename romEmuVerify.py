@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+#
+# Verify the ROM Emulator RAM against an image.
+#
+# The host computes the same values as blockChecksum() and andOrDiff() in
+# ROMemu.ino and compares them with the K replies. Blocks that differ are
+# split in two and checked again, until they are small enough to be
+# dumped with D and compared byte by byte. A correct RAM costs one K
+# command per image segment; a wrong byte is found in log2(size) steps.
+#
+# repair() uses it after an upload with garbled records: the firmware
+# writes the data of a record before it checks the sum, so a record with
+# a garbled count or address writes bytes elsewhere in the RAM.
+
+import time
+
+import romEmuImage
+import romEmuUpload
+
+LF = "\r\n"
+
+RAMSIZE   = 0x8000
+DUMPLIMIT = 32          # blocks up to this size are dumped instead of split
+MAXBLOCK  = RAMSIZE     # largest block checked with one K command
+
+
+def blockChecksum(data):
+    """Sum of the bytes as returned by blockChecksum() (an unsigned int, 16 bits)."""
+    return sum(data) & 0xFFFF
+
+
+def andOrDiff(data):
+    """The and/or value of andOrDiff(): P = (Q AND P) - (Q OR P) for every byte Q."""
+    checksum = 0
+    for value in data:
+        checksum = ((value & checksum) - (value | checksum)) & 0xFF
+    return checksum
+
+
+def expectedChecksum(data):
+    return blockChecksum(data), andOrDiff(data)
+
+
+def parseDumpLine(line):
+    """(address, data) of a full 16 byte line of D output, None for other lines."""
+    if len(line) < 6 + 4 * 9 or line[4:6] != ": ":
+        return None
+    try:
+        address = int(line[0:4], 16)
+        data = bytes.fromhex(line[6:6 + 4 * 9].replace(" ", ""))
+    except ValueError:
+        return None
+    if len(data) != 16:
+        return None
+    return address, data
+
+
+def readDump(ser, start, end):
+    """
+    Read the RAM from start up to (not including) end with D. The range
+    is widened to whole lines of 16 bytes. Returns None on a timeout.
+    """
+    first = start & ~0x0F
+    last = (end + 0x0F) & ~0x0F
+    ser.write(("D%04X-%04X" % (first, last & 0xFFFF) + LF).encode())
+    data = {}
+    while len(data) < (last - first) // 16:
+        raw = ser.readline()
+        if not raw:
+            return None
+        line = parseDumpLine(raw.decode('ascii', 'replace').rstrip("\r\n"))
+        if line is not None and first <= line[0] < last:
+            data[line[0]] = line[1]
+    dump = b"".join(data[a] for a in range(first, last, 16))
+    return dump[start - first:end - first]
+
+
+class VerifyResult:
+    """Outcome of verify(): the differing bytes and the commands it took."""
+
+    def __init__(self):
+        self.differences = []       # (RAM address, expected, actual)
+        self.checksums = 0
+        self.dumps = 0
+        self.bytesChecked = 0
+        self.failed = False         # a command got no reply
+
+    def ok(self):
+        return not self.differences and not self.failed
+
+    def summary(self):
+        if self.failed:
+            status = "incomplete, no reply from the emulator"
+        elif self.differences:
+            status = "{} bytes differ".format(len(self.differences))
+        else:
+            status = "Ok"
+        return "Verify {}: {} bytes checked with {} K and {} D commands".format(
+            status, self.bytesChecked, self.checksums, self.dumps)
+
+
+def verifyBlock(ser, start, data, result):
+    """Check data at RAM address start, splitting it while the checksums differ."""
+    pending = [(start, data)]
+    while pending and not result.failed:
+        start, data = pending.pop()
+        if len(data) <= DUMPLIMIT:
+            actual = readDump(ser, start, start + len(data))
+            result.dumps += 1
+            if actual is None:
+                result.failed = True
+                break
+            for i, (expected, value) in enumerate(zip(data, actual)):
+                if expected != value:
+                    result.differences.append((start + i, expected, value))
+            continue
+        reported = romEmuUpload.queryChecksum(ser, start, start + len(data) - 1)
+        result.checksums += 1
+        if reported is None:
+            result.failed = True
+        elif reported != expectedChecksum(data):
+            half = len(data) // 2
+            pending.append((start + half, data[half:]))
+            pending.append((start, data[:half]))
+
+
+def ramBlocks(image, offset=0):
+    """The image segments as (RAM address, data), split at the RAM size and MAXBLOCK."""
+    blocks = []
+    for address, data in image.segments():
+        address -= offset
+        while data:
+            ramAddress = address & (RAMSIZE - 1)
+            size = min(len(data), RAMSIZE - ramAddress, MAXBLOCK)
+            blocks.append((ramAddress, bytes(data[:size])))
+            address += size
+            data = data[size:]
+    return blocks
+
+
+def verify(ser, image, offset=0, out=print):
+    """Compare the emulator RAM with image (record addresses minus offset)."""
+    result = VerifyResult()
+    for start, data in ramBlocks(image, offset):
+        result.bytesChecked += len(data)
+        verifyBlock(ser, start, data, result)
+        if result.failed:
+            break
+    result.differences.sort()
+    for address, expected, actual in result.differences:
+        out("%04X: expected %02X, read %02X" % (address, expected, actual))
+    return result
+
+
+def differingBlocks(ser, image, offset=0, smallest=romEmuImage.RECORDSIZE, retries=romEmuUpload.RETRIES):
+    """
+    The (RAM address, data) blocks of image whose checksum differs, split
+    down to smallest bytes with K only: a D dump is long on a noisy line.
+    A K without a reply is sent again, up to retries times. Returns None
+    when it still gets none.
+    """
+    blocks = []
+    pending = list(reversed(ramBlocks(image, offset)))
+    while pending:
+        start, data = pending.pop()
+        for attempt in range(retries + 1):
+            reported = romEmuUpload.queryChecksum(ser, start, start + len(data) - 1)
+            if reported is not None:
+                break
+            ser.write(romEmuUpload.LF.encode())     # ends what is left of a garbled K
+            romEmuUpload.resyncOffset(ser, offset, out=lambda text: None)
+        else:
+            return None
+        if reported == expectedChecksum(data):
+            continue
+        if len(data) <= smallest:
+            blocks.append((start, data))
+            continue
+        half = len(data) // 2
+        pending.append((start + half, data[half:]))
+        pending.append((start, data[:half]))
+    return blocks
+
+
+def repair(ser, records, result, offset=0, window=romEmuUpload.DEFAULTWINDOW, out=print,
+           retries=romEmuUpload.RETRIES):
+    """
+    Check the data of records (record addresses minus offset in the RAM)
+    with differingBlocks() and send the records in differing blocks
+    again, for at most retries rounds. The resent records are added to
+    result, the UploadResult of the upload; when the RAM is right in the
+    end its errors and timeouts are cleared. Returns the differing
+    blocks, None when the emulator does not reply.
+    """
+    begin = time.monotonic()
+    image = romEmuImage.RomImage()
+    parsed = []
+    for record in records:
+        try:
+            block = romEmuImage.parseRecord(record)
+        except ValueError:
+            continue
+        if block is not None:
+            image.setBytes(block[0], block[1], romEmuImage.OVERLAP_LAST)
+            parsed.append((record, (block[0] - offset) & (RAMSIZE - 1), len(block[1])))
+    selected = []
+    for attempt in range(retries + 1):
+        blocks = differingBlocks(ser, image, offset, retries=retries)
+        if not blocks:
+            break
+        selected = [record for record, start, size in parsed
+                    if any(start < address + len(data) and address < start + size for address, data in blocks)]
+        if attempt == retries:
+            break
+        out("Repair: {} blocks differ, sending {} records again".format(len(blocks), len(selected)))
+        again = romEmuUpload.sendRecords(ser, selected, window=window, out=lambda text: None, offset=offset,
+                                         retries=retries)
+        result.retransmits += again.records + again.retransmits
+        result.wireBytes += again.wireBytes
+    if blocks is None:
+        out("Repair: no reply from the emulator")
+        result.timeouts += 1
+    elif blocks:
+        out("Repair: {} blocks still differ".format(len(blocks)))
+        result.errors += len(selected)
+    else:
+        result.errors = result.timeouts = 0
+    result.elapsed += time.monotonic() - begin
+    return blocks
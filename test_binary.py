@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+# Tests of the binary transfer mode (X command) against the simulator of
+# romEmuSim.py on a pseudo-terminal, so they need no board.
+#
+#   Usage: python3 -m pytest test_binary.py
+
+import random
+import time
+
+import pytest
+
+import romEmuConnect
+import romEmuImage
+import romEmuSim
+import romEmuUpload
+import romEmuVerify
+
+
+def connectSimulator(binary=True):
+    runner, port = romEmuSim.startSimulator(baud=0, fill=0, binary=binary)
+    ser, connection = romEmuConnect.connect(port)
+    return runner, ser
+
+
+@pytest.fixture
+def board():
+    runner, ser = connectSimulator()
+    yield ser
+    ser.close()
+    runner.close()
+
+
+@pytest.fixture
+def legacyBoard():
+    runner, ser = connectSimulator(binary=False)
+    yield ser
+    ser.close()
+    runner.close()
+
+
+def randomImage(size=2048, address=0x0100, seed=11):
+    rng = random.Random(seed)
+    image = romEmuImage.RomImage()
+    image.setBytes(address, bytes(rng.randrange(256) for i in range(size)))
+    return image
+
+
+def badFrame(address, data):
+    frame = bytearray(romEmuUpload.binaryFrame(address, data))
+    frame[-1] ^= 0xFF
+    return bytes(frame)
+
+
+class GarblingPort:
+    """A port that garbles the CRC of one write, the nth, once."""
+
+    def __init__(self, ser, nth):
+        self.ser = ser
+        self.nth = nth
+        self.writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes == self.nth:
+            data = data[:-1] + bytes([data[-1] ^ 0xFF])
+        return self.ser.write(data)
+
+
+def test_negotiation(board):
+    assert romEmuUpload.enterBinaryMode(board)
+    assert romEmuUpload.leaveBinaryMode(board)
+    board.write(("F" + romEmuUpload.LF).encode())
+    assert board.readline().strip() == b"F0000"        # back in command mode
+
+
+def test_legacy_fallback(legacyBoard):
+    assert not romEmuUpload.enterBinaryMode(legacyBoard)
+    image = randomImage(256)
+    messages = []
+    result = romEmuUpload.sendRecords(legacyBoard, romEmuImage.uploadRecords(image), binary=True,
+                                      out=messages.append)
+    assert "Binary transfer not supported by the firmware, sending records" in messages
+    assert result.errors == 0 and result.timeouts == 0
+    assert romEmuVerify.verify(legacyBoard, image, out=lambda text: None).ok()
+
+
+def test_nak_on_bad_crc(board):
+    assert romEmuUpload.enterBinaryMode(board)
+    board.write(badFrame(0x0200, bytes(range(16))))
+    assert board.read(1) == bytes([romEmuUpload.NAK])
+    board.write(romEmuUpload.binaryFrame(0x0200, bytes(range(16))))
+    assert board.read(1) == bytes([romEmuUpload.ACK])
+    assert romEmuUpload.leaveBinaryMode(board)
+
+
+def test_nak_on_incomplete_frame(board):
+    assert romEmuUpload.enterBinaryMode(board)
+    board.write(romEmuUpload.binaryFrame(0x0200, bytes(range(16)))[:10])
+    time.sleep(romEmuSim.FRAMETIMEOUT * 3)
+    assert board.read(1) == bytes([romEmuUpload.NAK])
+    assert romEmuUpload.leaveBinaryMode(board)
+
+
+def test_resend_in_flight(board):
+    image = randomImage()
+    frames = romEmuUpload.recordFrames(romEmuImage.uploadRecords(image))
+    assert romEmuUpload.enterBinaryMode(board)
+    result = romEmuUpload.binaryUpload(GarblingPort(board, 3), frames, window=4, out=lambda text: None)
+    assert romEmuUpload.leaveBinaryMode(board)
+    assert result.retransmits >= 1
+    assert result.errors == 0 and result.timeouts == 0
+    assert romEmuVerify.verify(board, image, out=lambda text: None).ok()
+
+
+def test_upload_and_verify(board):
+    image = randomImage(8192, 0x0000, seed=5)
+    result = romEmuUpload.sendRecords(board, romEmuImage.uploadRecords(image), binary=True,
+                                      out=lambda text: None)
+    assert result.errors == 0 and result.timeouts == 0
+    assert result.dataBytes == 8192
+    assert romEmuVerify.verify(board, image, out=lambda text: None).ok()